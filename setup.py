@@ -88,7 +88,7 @@ if "ucvm_setup_bootstrapped" not in os.environ:
 _HYPOCENTER_BASE = "http://hypocenter.usc.edu/research/ucvm/" + UCVM_INFORMATION["version"]
 _HYPOCENTER_MODEL_LIST = _HYPOCENTER_BASE + "/model_list.xml"
 
-INSTALL_REQUIRES = ["xmltodict", "humanize", "pyproj", "psutil", "matplotlib"]
+INSTALL_REQUIRES = ["xmltodict", "humanize", "pyproj", "psutil", "matplotlib", "Cython"]
 
 download_everything = os.environ["ucvm_download"] == "everything"
 download_minimum = os.environ["ucvm_download"] == "minimum"
@@ -281,8 +281,10 @@ setup(name=UCVM_INFORMATION["short_name"],
                                        'ucvm/tests/data/simple_mesh_ijk12_rotated.xml',
                                        'ucvm/tests/data/commands.db'])],
       install_requires=INSTALL_REQUIRES,
-      scripts=['ucvm/bin/ucvm_etree_create', 'ucvm/bin/ucvm_etree_create_mpi', 'ucvm/bin/ucvm_help',
-               'ucvm/bin/ucvm_mesh_create', 'ucvm/bin/ucvm_mesh_create_mpi', 'ucvm/bin/ucvm_model_manager',
+      scripts=['ucvm/bin/ucvm_etree_compact', 'ucvm/bin/ucvm_etree_create', 'ucvm/bin/ucvm_etree_create_mpi',
+               'ucvm/bin/ucvm_etree_merge', 'ucvm/bin/ucvm_help',
+               'ucvm/bin/ucvm_mesh_convert', 'ucvm/bin/ucvm_mesh_create', 'ucvm/bin/ucvm_mesh_create_mpi',
+               'ucvm/bin/ucvm_mesh_verify', 'ucvm/bin/ucvm_model_manager',
                'ucvm/bin/ucvm_plot_comparison', 'ucvm/bin/ucvm_plot_cross_section',
                'ucvm/bin/ucvm_plot_depth_profile', 'ucvm/bin/ucvm_plot_horizontal_slice', 'ucvm/bin/ucvm_query',
                'ucvm/bin/ucvm_run_tests'],
@@ -1,8 +1,9 @@
 """
 Data Product Reader Velocity Model
 
-This "velocity model" reads from an AWP mesh, an RWG mesh, or an e-tree. It then retrieves the
-material properties stored within the data structure. For meshes, this is trilinearly interpolated.
+This "velocity model" reads from an AWP mesh, an RWG mesh, an HDF5 mesh, or an e-tree. It then
+retrieves the material properties stored within the data structure. For meshes, this is trilinearly
+interpolated.
 
 Copyright:
     Southern California Earthquake Center
@@ -11,12 +12,14 @@ Developer:
     David Gill <davidgil@usc.edu>
 """
 # Python Imports
+import atexit
 import os
 import math
-import struct
+from collections import OrderedDict
 from typing import List
 
 # Package Imports
+import numpy as np
 import pyproj
 import xmltodict
 
@@ -26,11 +29,23 @@ from ucvm.src.shared import VelocityProperties
 from ucvm.src.shared.constants import UCVM_DEFAULT_PROJECTION, UCVM_DEPTH, UCVM_ELEVATION
 from ucvm.src.shared.properties import SeismicData, Point
 from ucvm.src.shared.errors import display_and_raise_error
+from ucvm.src.framework.mesh_common import HDF5MeshReader, get_z_offsets
 from ucvm_c_common import UCVMCCommon
 
+SLAB_READ_RATIO = 4         #: int: Read grid-aligned nodes as one slab if it is at most this many times larger.
+ALIGNED_TOLERANCE = 1e-6    #: float: Fraction of a cell within which a point is treated as lying on a node.
+
 
 class DataProductReaderVelocityModel(VelocityModel):
 
+    _products = OrderedDict()       #: OrderedDict: Open data products keyed by descriptor path, oldest use first.
+    max_open_products = 16          #: int: The number of products kept open before the oldest is closed.
+    etree_buffer_size = 64          #: int: The page cache size, in MB, of each open etree.
+    hdf5_cache_size = 64            #: int: The decompressed chunk cache size, in MB, of each open HDF5 mesh.
+
+    _GEOMETRY = ("source", "llcorner", "dims", "rotation", "projection", "origin_in_mesh_proj", "cos", "sin",
+                 "data_dir", "corners", "default_proj", "mesh_proj", "z_offsets")
+
     def __init__(self):
         self.source = ""
         self.llcorner = None
@@ -42,6 +57,11 @@ class DataProductReaderVelocityModel(VelocityModel):
         self.sin = 0.0
         self.data_dir = ""
         self.corners = ()
+        self.default_proj = None
+        self.mesh_proj = None
+        self.mappings = {}
+        self.etree = None
+        self.z_offsets = None
         super().__init__()
 
     def _initialize(self, xml_file) -> None:
@@ -55,6 +75,7 @@ class DataProductReaderVelocityModel(VelocityModel):
             Nothing
         """
         self.source = xml_file["mesh_name"] if "mesh_name" in xml_file else xml_file["etree_name"]
+        self.z_offsets = None
 
         if "initial_point" in xml_file:
             self.llcorner = Point(
@@ -73,15 +94,20 @@ class DataProductReaderVelocityModel(VelocityModel):
                 "z": int(xml_file["dimensions"]["z"]),
                 "spacing": int(xml_file["spacing"])
             }
+            # Meshes with depth-varying vertical spacing are located in z through the depth of each slice.
+            if xml_file.get("z_spacing") is not None:
+                self.z_offsets = get_z_offsets(xml_file, self.dims["z"], self.dims["spacing"])
             self.rotation = float(xml_file["rotation"])
             self.cos = float(math.cos(math.radians(self.rotation)))
             self.sin = float(math.sin(math.radians(self.rotation)))
 
             self.projection = xml_file["projection"]
+            self.default_proj = pyproj.Proj(UCVM_DEFAULT_PROJECTION)
+            self.mesh_proj = pyproj.Proj(self.projection)
 
             # Find the origin point.
             p1 = pyproj.Proj(self.llcorner.projection)
-            p2 = pyproj.Proj(self.projection)
+            p2 = self.mesh_proj
             ll_x, ll_y = pyproj.transform(p1, p2, self.llcorner.x_value, self.llcorner.y_value)
             self.origin_in_mesh_proj = [ll_x, ll_y]
 
@@ -106,268 +132,285 @@ class DataProductReaderVelocityModel(VelocityModel):
                 (float(xml_file["corners"]["br"]["x"]), float(xml_file["corners"]["br"]["y"]))
             )
 
-    def _awp_query(self, data: List[SeismicData]) -> None:
+    def _get_mapping(self, file_name: str) -> np.memmap:
         """
-        Query function for an AWP-style mesh (IJK-12).
+        Returns the read-only memory map of a mesh file in the data directory. Each file is mapped
+        once per instance and re-used by all subsequent queries.
 
         Args:
-            data (`obj`:List of `obj`:SeismicData): The list of SeismicData objects for which material properties need
-                to be retrieved.
+            file_name (str): The name of the mesh file within the data directory.
 
         Returns:
-            Nothing
+            The file mapped as an array of little-endian 32-bit floats.
         """
-        p1 = pyproj.Proj(UCVM_DEFAULT_PROJECTION)
-        p2 = pyproj.Proj(self.projection)
+        path = os.path.join(self.data_dir, file_name)
+        if path not in self.mappings:
+            self.mappings[path] = np.memmap(path, dtype="<f4", mode="r")
+        return self.mappings[path]
 
-        lons_to_convert = []
-        lats_to_convert = []
+    def _get_grid_points(self, data: List[SeismicData]) -> (np.ndarray, dict, dict):
+        """
+        Finds the grid cell containing each point, and the position of the point within that cell, for the
+        whole list of points at once. This is the same calculation as UCVMCCommon.calculate_grid_point.
 
-        for i in range(len(data)):
-            lons_to_convert.append(data[i].converted_point.x_value)
-            lats_to_convert.append(data[i].converted_point.y_value)
+        Args:
+            data (`obj`:List of `obj`:SeismicData): The list of SeismicData objects to locate within the mesh.
 
-        converted_x, converted_y = pyproj.transform(p1, p2, lons_to_convert, lats_to_convert)
+        Returns:
+            A tuple of the boolean array that is True where the point lies within the mesh, the dictionary of
+            integer cell coordinates, and the dictionary of the percentages within each cell.
+        """
+        converted_x, converted_y = pyproj.transform(self.default_proj, self.mesh_proj,
+                                                    [x.converted_point.x_value for x in data],
+                                                    [x.converted_point.y_value for x in data])
 
-        fin = open(os.path.join(self.data_dir, self.source + ".awp"), "rb")
+        temp_utm_e = np.array(converted_x, dtype=np.float64).reshape(-1) - self.origin_in_mesh_proj[0]
+        temp_utm_n = np.array(converted_y, dtype=np.float64).reshape(-1) - self.origin_in_mesh_proj[1]
 
         values = {
-            "tsw": 0.0,
-            "tnw": 0.0,
-            "tne": 0.0,
-            "tse": 0.0,
-            "bsw": 0.0,
-            "bnw": 0.0,
-            "bne": 0.0,
-            "bse": 0.0
+            "x": self.cos * temp_utm_e - self.sin * temp_utm_n,
+            "y": self.sin * temp_utm_e + self.cos * temp_utm_n,
+            "z": np.array([x.converted_point.z_value for x in data], dtype=np.float64)
         }
-
-        values_matprop = {
-            "tsw": 0.0,
-            "tnw": 0.0,
-            "tne": 0.0,
-            "tse": 0.0,
-            "bsw": 0.0,
-            "bnw": 0.0,
-            "bne": 0.0,
-            "bse": 0.0
+        intervals = {
+            "x": self.dims["x"] * self.dims["spacing"] / (self.dims["x"] - 1),
+            "y": self.dims["y"] * self.dims["spacing"] / (self.dims["y"] - 1),
+            "z": float(self.dims["spacing"])
         }
 
-        v = {
-            "vs": 0.0,
-            "vp": 0.0,
-            "density": 0.0
+        coords = {}
+        percentages = {}
+        inside = np.ones(len(data), dtype=bool)
+
+        with np.errstate(invalid="ignore"):
+            for key in ("x", "y", "z"):
+                if key == "z" and self.z_offsets is not None:
+                    cell = np.searchsorted(self.z_offsets, values[key], side="right") - 1.0
+                    cell[~np.isfinite(values[key])] = np.nan
+                elif key == "z":
+                    cell = np.floor(values[key] / intervals[key])
+                else:
+                    cell = np.floor(values[key] / (self.dims[key] * self.dims["spacing"]) * (self.dims[key] - 1))
+                inside &= np.isfinite(cell) & (cell >= 0) & (cell <= self.dims[key] - 2)
+                coords[key] = np.where(inside, cell, 0).astype(np.int64)
+                if key == "z" and self.z_offsets is not None:
+                    below = self.z_offsets[coords[key]]
+                    gap = self.z_offsets[np.minimum(coords[key] + 1, self.dims[key] - 1)] - below
+                    percentages[key] = ((values[key] - below) / np.where(gap > 0, gap, 1)).astype(np.float32)
+                else:
+                    percentages[key] = (np.fmod(values[key], intervals[key]) / intervals[key]).astype(np.float32)
+
+        return inside, coords, percentages
+
+    @staticmethod
+    def _trilinear_interpolate(corners: dict, percentages: dict) -> np.ndarray:
+        """
+        Trilinearly interpolates the eight corner values of each cell. This is UCVMCCommon.trilinear_interpolate
+        applied to whole arrays, and like it works in single precision.
+
+        Args:
+            corners (dict): The corner values keyed by "tsw", "tse", "tnw", "tne", "bsw", "bse", "bnw", "bne".
+            percentages (dict): The position of each point within its cell, keyed by "x", "y", and "z".
+
+        Returns:
+            The interpolated values as an array of 32-bit floats.
+        """
+        x_p, y_p, z_p = percentages["x"], percentages["y"], percentages["z"]
+        one = np.float32(1)
+
+        tx1 = (one - x_p) * corners["tsw"] + x_p * corners["tse"]
+        tx2 = (one - x_p) * corners["tnw"] + x_p * corners["tne"]
+        bx1 = (one - x_p) * corners["bsw"] + x_p * corners["bse"]
+        bx2 = (one - x_p) * corners["bnw"] + x_p * corners["bne"]
+
+        ty = (one - y_p) * tx1 + y_p * tx2
+        by = (one - y_p) * bx1 + y_p * bx2
+
+        return (one - z_p) * ty + z_p * by
+
+    @staticmethod
+    def _get_corner_offsets(x_stride: int, y_stride: int, z_stride: int) -> dict:
+        """
+        Returns the offset of each of the eight corners of a cell from its top south-west corner.
+
+        Args:
+            x_stride (int): The distance between consecutive x values in the file.
+            y_stride (int): The distance between consecutive y values in the file.
+            z_stride (int): The distance between consecutive z values in the file.
+
+        Returns:
+            The offsets keyed by "tsw", "tse", "tnw", "tne", "bsw", "bse", "bnw", "bne".
+        """
+        return {
+            "tsw": 0, "tse": x_stride, "tnw": y_stride, "tne": y_stride + x_stride,
+            "bsw": z_stride, "bse": z_stride + x_stride, "bnw": z_stride + y_stride,
+            "bne": z_stride + y_stride + x_stride
         }
 
-        for i in range(len(converted_x)):
-            temp_utm_e = converted_x[i] - self.origin_in_mesh_proj[0]
-            temp_utm_n = converted_y[i] - self.origin_in_mesh_proj[1]
-
-            new_point_utm_n = self.sin * temp_utm_e + self.cos * temp_utm_n
-            new_point_utm_e = self.cos * temp_utm_e - self.sin * temp_utm_n
-
-            coords, percentages = UCVMCCommon.calculate_grid_point(
-                self.dims["x"] * self.dims["spacing"],
-                self.dims["y"] * self.dims["spacing"],
-                self.dims["z"] * self.dims["spacing"],
-                new_point_utm_e,
-                new_point_utm_n,
-                data[i].converted_point.z_value,
-                self.dims["x"],
-                self.dims["y"],
-                self.dims["spacing"]
+    @staticmethod
+    def _read_nodes(mesh: np.ndarray, indices: np.ndarray) -> np.ndarray:
+        """
+        Reads the mesh values at the given node indices. When the nodes are dense within the range they span,
+        as they are for a slice or sub-volume at the mesh's own spacing, the whole range is read as one slab.
+
+        Args:
+            mesh (np.ndarray): The mapped mesh file.
+            indices (np.ndarray): The node indices to read.
+
+        Returns:
+            The values at those nodes.
+        """
+        if len(indices) == 0:
+            return mesh[indices]
+
+        start = int(indices.min())
+        end = int(indices.max()) + 1
+
+        if end - start <= SLAB_READ_RATIO * len(indices):
+            return np.array(mesh[start:end])[indices - start]
+
+        return mesh[indices]
+
+    def _get_mesh_values(self, mesh: np.ndarray, base: np.ndarray, offsets: dict, percentages: dict) -> np.ndarray:
+        """
+        Returns the mesh values at each point. Points that lie on a grid node, to within ALIGNED_TOLERANCE of a
+        cell, are read directly, and only the rest are trilinearly interpolated from the eight corners of their
+        cells.
+
+        Args:
+            mesh (np.ndarray): The mapped mesh file, either one value per node or one row of values per node.
+            base (np.ndarray): The index of the top south-west corner of each point's cell.
+            offsets (dict): The corner offsets from _get_corner_offsets.
+            percentages (dict): The position of each point within its cell, keyed by "x", "y", and "z".
+
+        Returns:
+            The values at each point as 32-bit floats.
+        """
+        values = np.empty((len(base),) + mesh.shape[1:], dtype=np.float32)
+        aligned = np.ones(len(base), dtype=bool)
+        nodes = base.copy()
+
+        # Projection round trips leave points a hair off the node they were generated from, on either side.
+        for axis, corner in (("x", "tse"), ("y", "tnw"), ("z", "bsw")):
+            upper = percentages[axis] >= 1 - ALIGNED_TOLERANCE
+            aligned &= (percentages[axis] <= ALIGNED_TOLERANCE) | upper
+            nodes[upper] += offsets[corner]
+
+        values[aligned] = self._read_nodes(mesh, nodes[aligned])
+
+        interpolated = ~aligned
+        if np.any(interpolated):
+            base = base[interpolated]
+            values[interpolated] = self._trilinear_interpolate(
+                {key: mesh[base + offset] for key, offset in offsets.items()},
+                {key: value[interpolated].reshape((-1,) + (1,) * (mesh.ndim - 1))
+                 for key, value in percentages.items()}
             )
 
-            # Check to see if we are outside of the model boundaries.
-            if coords["x"] < 0 or coords["y"] < 0 or coords["z"] < 0 or \
-               coords["x"] > self.dims["x"] - 2 or coords["y"] > self.dims["y"] - 2 or \
-               coords["z"] > self.dims["z"] - 2:
+        return values
+
+    def _set_mesh_velocity_data(self, data: List[SeismicData], inside: np.ndarray, properties: dict,
+                                prefix: str) -> None:
+        """
+        Sets the interpolated material properties on each SeismicData object within the mesh and sets the
+        properties to None for those outside of it.
+
+        Args:
+            data (`obj`:List of `obj`:SeismicData): The list of SeismicData objects.
+            inside (np.ndarray): True where the point is within the mesh.
+            properties (dict): The "vp", "vs", and "density" arrays for the points within the mesh.
+            prefix (str): The source prefix (e.g. "awp").
+
+        Returns:
+            Nothing
+        """
+        source = prefix + ": " + self.source
+        values = zip(properties["vp"].tolist(), properties["vs"].tolist(), properties["density"].tolist())
+
+        for i in range(len(data)):
+            if not inside[i]:
                 self._set_velocity_properties_none(data[i])
                 continue
 
-            values["tsw"] = (coords["z"]) * \
-                            (self.dims["y"] * self.dims["x"]) + \
-                            (coords["y"] * self.dims["x"]) + coords["x"]
-            values["tse"] = (coords["z"]) * \
-                            (self.dims["y"] * self.dims["x"]) + \
-                            (coords["y"] * self.dims["x"]) + (coords["x"] + 1)
-            values["tnw"] = (coords["z"]) * \
-                            (self.dims["y"] * self.dims["x"]) + \
-                            ((coords["y"] + 1) * self.dims["x"]) + coords["x"]
-            values["tne"] = (coords["z"]) * \
-                            (self.dims["y"] * self.dims["x"]) + \
-                            ((coords["y"] + 1) * self.dims["x"]) + (coords["x"]) + 1
-            values["bsw"] = (coords["z"] + 1) * \
-                            (self.dims["y"] * self.dims["x"]) + \
-                            (coords["y"] * self.dims["x"]) + coords["x"]
-            values["bse"] = (coords["z"] + 1) * \
-                            (self.dims["y"] * self.dims["x"]) + \
-                            (coords["y"] * self.dims["x"]) + (coords["x"] + 1)
-            values["bnw"] = (coords["z"] + 1) * \
-                            (self.dims["y"] * self.dims["x"]) + \
-                            ((coords["y"] + 1) * self.dims["x"]) + coords["x"]
-            values["bne"] = (coords["z"] + 1) * \
-                            (self.dims["y"] * self.dims["x"]) + \
-                            ((coords["y"] + 1) * self.dims["x"]) + (coords["x"] + 1)
-
-            for prop_given in ["vp", "vs", "density"]:
-                add = 0 if prop_given == "vp" else 4 if prop_given == "vs" else 8
-                for key in values.keys():
-                    fin.seek(values[key] * 12 + add)
-                    values_matprop[key] = struct.unpack("<f", fin.read(4))[0]
-
-                v[prop_given] = UCVMCCommon.trilinear_interpolate(
-                    values_matprop["tsw"], values_matprop["tse"], values_matprop["tnw"],
-                    values_matprop["tne"], values_matprop["bsw"], values_matprop["bse"],
-                    values_matprop["bnw"], values_matprop["bne"],
-                    percentages["x"], percentages["y"], percentages["z"]
-                )
-                v[str(prop_given) + "_source"] = "awp: " + self.source
-
+            vp, vs, density = next(values)
             data[i].set_velocity_data(
-                VelocityProperties(
-                    v["vp"], v["vs"], v["density"], None, None,
-                    v["vp_source"], v["vs_source"], v["density_source"], None, None
-                )
+                VelocityProperties(vp, vs, density, None, None, source, source, source, None, None)
             )
 
-    def _rwg_query(self, data: List[SeismicData]):
+    def _awp_query(self, data: List[SeismicData], mesh=None, prefix: str="awp") -> None:
         """
-        Query function for a RWG style mesh.
+        Query function for an AWP-style mesh (IJK-12).
 
         Args:
             data (`obj`:List of `obj`:SeismicData): The list of SeismicData objects for which material properties need
                 to be retrieved.
+            mesh: The mesh as an array of (Vp, Vs, density) rows. By default the mapped .awp file.
+            prefix (str): The source prefix (e.g. "awp").
 
         Returns:
             Nothing
         """
-        p1 = pyproj.Proj(UCVM_DEFAULT_PROJECTION)
-        p2 = pyproj.Proj(self.projection)
+        inside, coords, percentages = self._get_grid_points(data)
+        percentages = {key: value[inside] for key, value in percentages.items()}
 
-        lons_to_convert = []
-        lats_to_convert = []
+        # Each grid point is stored as Vp, Vs, and density, with x varying fastest and z slowest.
+        if mesh is None:
+            mesh = self._get_mapping(self.source + ".awp").reshape(-1, 3)
+        base = coords["z"][inside] * (self.dims["y"] * self.dims["x"]) + \
+            coords["y"][inside] * self.dims["x"] + coords["x"][inside]
 
-        for i in range(len(data)):
-            lons_to_convert.append(data[i].converted_point.x_value)
-            lats_to_convert.append(data[i].converted_point.y_value)
+        values = self._get_mesh_values(
+            mesh, base, self._get_corner_offsets(1, self.dims["x"], self.dims["y"] * self.dims["x"]), percentages
+        )
 
-        converted_x, converted_y = pyproj.transform(p1, p2, lons_to_convert, lats_to_convert)
+        self._set_mesh_velocity_data(data, inside, {
+            prop: values[:, index] for index, prop in enumerate(("vp", "vs", "density"))
+        }, prefix)
 
-        fin_vp = open(os.path.join(self.data_dir, self.source + ".rwgvp"), "rb")
-        fin_vs = open(os.path.join(self.data_dir, self.source + ".rwgvs"), "rb")
-        fin_dn = open(os.path.join(self.data_dir, self.source + ".rwgdn"), "rb")
+    def _hdf5_query(self, data: List[SeismicData]) -> None:
+        """
+        Query function for an HDF5 mesh. The nodes are in the same order as an AWP mesh, but stored in compressed
+        chunks, which are decompressed as needed and cached.
 
-        values = {
-            "tsw": 0.0,
-            "tnw": 0.0,
-            "tne": 0.0,
-            "tse": 0.0,
-            "bsw": 0.0,
-            "bnw": 0.0,
-            "bne": 0.0,
-            "bse": 0.0
-        }
+        Args:
+            data (`obj`:List of `obj`:SeismicData): The list of SeismicData objects for which material properties need
+                to be retrieved.
 
-        values_matprop = {
-            "tsw": 0.0,
-            "tnw": 0.0,
-            "tne": 0.0,
-            "tse": 0.0,
-            "bsw": 0.0,
-            "bnw": 0.0,
-            "bne": 0.0,
-            "bse": 0.0
-        }
+        Returns:
+            Nothing
+        """
+        path = os.path.join(self.data_dir, self.source + ".h5")
+        if path not in self.mappings:
+            self.mappings[path] = HDF5MeshReader(path, self.hdf5_cache_size * 1024 * 1024)
 
-        v = {
-            "vs": 0.0,
-            "vp": 0.0,
-            "density": 0.0
-        }
+        self._awp_query(data, self.mappings[path], "hdf5")
 
-        for i in range(len(converted_x)):
-            temp_utm_e = converted_x[i] - self.origin_in_mesh_proj[0]
-            temp_utm_n = converted_y[i] - self.origin_in_mesh_proj[1]
-
-            new_point_utm_n = self.sin * temp_utm_e + self.cos * temp_utm_n
-            new_point_utm_e = self.cos * temp_utm_e - self.sin * temp_utm_n
-
-            coords, percentages = UCVMCCommon.calculate_grid_point(
-                self.dims["x"] * self.dims["spacing"],
-                self.dims["y"] * self.dims["spacing"],
-                self.dims["z"] * self.dims["spacing"],
-                new_point_utm_e,
-                new_point_utm_n,
-                data[i].converted_point.z_value,
-                self.dims["x"],
-                self.dims["y"],
-                self.dims["spacing"]
-            )
+    def _rwg_query(self, data: List[SeismicData]):
+        """
+        Query function for a RWG style mesh.
 
-            # Check to see if we are outside of the model boundaries.
-            if coords["x"] < 0 or coords["y"] < 0 or coords["z"] < 0 or \
-               coords["x"] > self.dims["x"] - 2 or coords["y"] > self.dims["y"] - 2 or \
-               coords["z"] > self.dims["z"] - 2:
-                self._set_velocity_properties_none(data[i])
-                continue
+        Args:
+            data (`obj`:List of `obj`:SeismicData): The list of SeismicData objects for which material properties need
+                to be retrieved.
 
-            values["tsw"] = (coords["y"] * (self.dims["z"] * self.dims["x"])) + \
-                            (coords["z"] * self.dims["x"]) + coords["x"]
-            values["tse"] = (coords["y"] * (self.dims["z"] * self.dims["x"])) + \
-                            (coords["z"] * self.dims["x"]) + coords["x"] + 1
-            values["tnw"] = ((coords["y"] + 1) * (self.dims["z"] * self.dims["x"])) + \
-                            (coords["z"] * self.dims["x"]) + coords["x"]
-            values["tne"] = ((coords["y"] + 1) * (self.dims["z"] * self.dims["x"])) + \
-                            (coords["z"] * self.dims["x"]) + coords["x"] + 1
-            values["bsw"] = (coords["y"] * (self.dims["z"] * self.dims["x"])) + \
-                            ((coords["z"] + 1) * self.dims["x"]) + coords["x"]
-            values["bse"] = (coords["y"] * (self.dims["z"] * self.dims["x"])) + \
-                            ((coords["z"] + 1) * self.dims["x"]) + coords["x"] + 1
-            values["bnw"] = ((coords["y"] + 1) * (self.dims["z"] * self.dims["x"])) + \
-                            ((coords["z"] + 1) * self.dims["x"]) + coords["x"]
-            values["bne"] = ((coords["y"] + 1) * (self.dims["z"] * self.dims["x"])) + \
-                            ((coords["z"] + 1) * self.dims["x"]) + coords["x"] + 1
-
-            for key in values.keys():
-                fin_vp.seek(values[key] * 4)
-                values_matprop[key] = struct.unpack("<f", fin_vp.read(4))[0]
-            v["vp"] = UCVMCCommon.trilinear_interpolate(
-                values_matprop["tsw"], values_matprop["tse"], values_matprop["tnw"],
-                values_matprop["tne"], values_matprop["bsw"], values_matprop["bse"],
-                values_matprop["bnw"], values_matprop["bne"],
-                percentages["x"], percentages["y"], percentages["z"]
-            ) * 1000
-            v["vp_source"] = "rwg: " + self.source
-
-            for key in values.keys():
-                fin_vs.seek(values[key] * 4)
-                values_matprop[key] = struct.unpack("<f", fin_vs.read(4))[0]
-            v["vs"] = UCVMCCommon.trilinear_interpolate(
-                values_matprop["tsw"], values_matprop["tse"], values_matprop["tnw"],
-                values_matprop["tne"], values_matprop["bsw"], values_matprop["bse"],
-                values_matprop["bnw"], values_matprop["bne"],
-                percentages["x"], percentages["y"], percentages["z"]
-            ) * 1000
-            v["vs_source"] = "rwg: " + self.source
-
-            for key in values.keys():
-                fin_dn.seek(values[key] * 4)
-                values_matprop[key] = struct.unpack("<f", fin_dn.read(4))[0]
-            v["density"] = UCVMCCommon.trilinear_interpolate(
-                values_matprop["tsw"], values_matprop["tse"], values_matprop["tnw"],
-                values_matprop["tne"], values_matprop["bsw"], values_matprop["bse"],
-                values_matprop["bnw"], values_matprop["bne"],
-                percentages["x"], percentages["y"], percentages["z"]
-            ) * 1000
-            v["density_source"] = "rwg: " + self.source
+        Returns:
+            Nothing
+        """
+        inside, coords, percentages = self._get_grid_points(data)
+        percentages = {key: value[inside] for key, value in percentages.items()}
 
-            data[i].set_velocity_data(
-                VelocityProperties(
-                    v["vp"], v["vs"], v["density"], None, None,
-                    v["vp_source"], v["vs_source"], v["density_source"], None, None
-                )
-            )
+        # Each property is in its own file in km/s or g/cm^3, with x varying fastest and y slowest.
+        base = coords["y"][inside] * (self.dims["z"] * self.dims["x"]) + \
+            coords["z"][inside] * self.dims["x"] + coords["x"][inside]
+        offsets = self._get_corner_offsets(1, self.dims["z"] * self.dims["x"], self.dims["x"])
+
+        properties = {}
+        for prop, extension in (("vp", ".rwgvp"), ("vs", ".rwgvs"), ("density", ".rwgdn")):
+            properties[prop] = self._get_mesh_values(
+                self._get_mapping(self.source + extension), base, offsets, percentages
+            ).astype(np.float64) * 1000
+
+        self._set_mesh_velocity_data(data, inside, properties, "rwg")
 
     def _etree_query(self, data: List[SeismicData]):
         """
@@ -380,28 +423,37 @@ class DataProductReaderVelocityModel(VelocityModel):
         Returns:
             Nothing
         """
-        obj = os.path.join(self.data_dir, self.source + ".e").encode("ASCII")
-        etree = UCVMCCommon.c_etree_open(obj, 0)
-        metadata = UCVMCCommon.c_etree_getappmeta(etree)
-        dims = (metadata["dims"][0], metadata["dims"][1], metadata["dims"][2])
-        ticks = (metadata["ticks"][0], metadata["ticks"][1], metadata["ticks"][2])
-
-        for datum in data:
-            properties = UCVMCCommon.c_etree_query(etree, datum.converted_point.x_value,
-                                                   datum.converted_point.y_value,
-                                                   datum.converted_point.z_value, self.corners,
-                                                   dims, ticks)
-            if properties is not None:
+        if self.etree is None:
+            obj = os.path.join(self.data_dir, self.source + ".e").encode("ASCII")
+            etree = UCVMCCommon.c_etree_open(obj, 0, self.etree_buffer_size)
+            metadata = UCVMCCommon.c_etree_getappmeta(etree)
+            self.etree = (
+                etree,
+                (metadata["dims"][0], metadata["dims"][1], metadata["dims"][2]),
+                (metadata["ticks"][0], metadata["ticks"][1], metadata["ticks"][2])
+            )
+
+        etree, dims, ticks = self.etree
+
+        lons = np.array([x.converted_point.x_value for x in data], dtype=np.float64)
+        lats = np.array([x.converted_point.y_value for x in data], dtype=np.float64)
+        depths = np.array([x.converted_point.z_value for x in data], dtype=np.float64)
+        properties = np.zeros((len(data), 3), dtype=np.float32)
+        found = np.zeros(len(data), dtype=np.uint8)
+
+        # Query by depth, then latitude, then longitude so neighbouring queries hit the same octants.
+        UCVMCCommon.c_etree_query_batch(etree, lons, lats, depths, self.corners, dims, ticks, properties, found,
+                                        np.lexsort((lons, lats, depths)))
+
+        source = "etree: " + self.source
+        for datum, is_found, (vp, vs, density) in zip(data, found.tolist(), properties.tolist()):
+            if is_found:
                 datum.set_velocity_data(
-                    VelocityProperties(properties[0], properties[1], properties[2], None, None,
-                                       "etree: " + self.source, "etree: " + self.source,
-                                       "etree: " + self.source, None, None)
+                    VelocityProperties(vp, vs, density, None, None, source, source, source, None, None)
                 )
             else:
                 self._set_velocity_properties_none(datum)
 
-        UCVMCCommon.c_etree_close(etree)
-
     def _query(self, data: List[SeismicData], **kwargs):
         """
         This is the method that all models override. It handles querying the velocity model
@@ -417,20 +469,100 @@ class DataProductReaderVelocityModel(VelocityModel):
         if "params" not in kwargs:
             display_and_raise_error(21)
 
-        try:
-            with open(kwargs["params"], "r") as fd:
-                xml_in = xmltodict.parse(fd.read())
-                self.data_dir = xml_in["root"]["out_dir"]
-        except FileNotFoundError:
-            with open(kwargs["params"] + ".xml", "r") as fd:
-                xml_in = xmltodict.parse(fd.read())
-                self.data_dir = xml_in["root"]["out_dir"]
-
-        self._initialize(xml_in["root"])
+        product = self._get_product(kwargs["params"])
+        for key in self._GEOMETRY:
+            setattr(self, key, product["geometry"][key])
+        self.mappings = product["mappings"]
+        self.etree = product["etree"]
 
-        if xml_in["root"]["format"] == "awp":
+        if product["format"] == "awp":
             self._awp_query(data)
-        elif xml_in["root"]["format"] == "rwg":
+        elif product["format"] == "rwg":
             self._rwg_query(data)
-        elif xml_in["root"]["format"] == "etree":
+        elif product["format"] == "hdf5":
+            self._hdf5_query(data)
+        elif product["format"] == "etree":
             self._etree_query(data)
+            product["etree"] = self.etree
+
+        return True
+
+    def _get_product(self, path: str) -> dict:
+        """
+        Returns the registry entry for the data product described by the XML file at path. The descriptor is
+        parsed and the geometry is computed once per process; the entry is rebuilt if the descriptor changes.
+        Opening a new product closes the least recently used one when more than max_open_products are open.
+
+        Args:
+            path (str): The path to the XML descriptor, with or without the ".xml" extension.
+
+        Returns:
+            The product dictionary with "modified", "format", "geometry", "mappings", and "etree" keys.
+        """
+        if not os.path.exists(path) and os.path.exists(path + ".xml"):
+            path += ".xml"
+
+        key = os.path.abspath(path)
+        modified = os.path.getmtime(path)
+
+        if key in self._products:
+            if self._products[key]["modified"] == modified:
+                self._products.move_to_end(key)
+                return self._products[key]
+            self._close_product(self._products.pop(key))
+
+        with open(path, "r") as fd:
+            xml_in = xmltodict.parse(fd.read())
+
+        self.data_dir = xml_in["root"]["out_dir"]
+        self.default_proj = None
+        self.mesh_proj = None
+        self._initialize(xml_in["root"])
+
+        self._products[key] = {
+            "modified": modified,
+            "format": xml_in["root"]["format"],
+            "geometry": {attribute: getattr(self, attribute) for attribute in self._GEOMETRY},
+            "mappings": {},
+            "etree": None
+        }
+
+        while len(self._products) > self.max_open_products:
+            self._close_product(self._products.popitem(last=False)[1])
+
+        return self._products[key]
+
+    @classmethod
+    def _close_product(cls, product: dict) -> None:
+        """
+        Closes the files held open by a product's registry entry.
+
+        Args:
+            product (dict): The product dictionary returned by _get_product.
+
+        Returns:
+            Nothing
+        """
+        # The mappings are unmapped once the last array referring to them is released.
+        for mapping in product["mappings"].values():
+            if isinstance(mapping, HDF5MeshReader):
+                mapping.close()
+        product["mappings"].clear()
+
+        if product["etree"] is not None:
+            UCVMCCommon.c_etree_close(product["etree"][0])
+            product["etree"] = None
+
+    @classmethod
+    def close_products(cls) -> None:
+        """
+        Closes every open data product in this process. Subsequent queries re-open them as needed.
+
+        Returns:
+            Nothing
+        """
+        while len(cls._products) > 0:
+            cls._close_product(cls._products.popitem()[1])
+
+
+atexit.register(DataProductReaderVelocityModel.close_products)
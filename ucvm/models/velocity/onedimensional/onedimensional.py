@@ -24,6 +24,7 @@ import sys
 from typing import List
 
 # Package Imports
+import numpy as np
 import xmltodict
 
 # UCVM Imports
@@ -36,6 +37,8 @@ from ucvm.src.shared.errors import display_and_raise_error
 
 class OneDimensionalVelocityModel(VelocityModel):
 
+    _parsed_models = {}     #: dict: Parsed models keyed by path and interpolation, invalidated by mtime.
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
@@ -125,58 +128,91 @@ class OneDimensionalVelocityModel(VelocityModel):
         layers.append(layers[-1])
 
     @classmethod
-    def _get_velocity_data(cls, depth: float, layers: list, interpolate: bool, name: str, format_str: str) \
-            -> VelocityProperties:
+    def _load_model(cls, xml_file: str, interpolation: str=None) -> dict:
         """
-        Given a list of layers and depth, this function returns the velocity data for the
-        1D model.
+        Returns the parsed 1D model stored in xml_file. The model is parsed once into arrays of
+        layer tops and material properties and cached until the file's modification time changes.
 
         Args:
-            depth (float): The depth for which we want the properties.
-            layers (list): The layers of the velocity model.
-            interpolate (bool): True if we should use linear interpolation, false if not.
-            name (str): The name of the model.
+            xml_file (str): The path to the .mdl file.
+            interpolation (str): "linear" or "none" to override the model's interpolation, or None
+                                 to use the interpolation specified in the file.
 
         Returns:
-            The :obj:`VelocityProperties` for this model at the specified depth.
+            The parsed model dictionary, with "name", "format", "interpolation", "depths",
+            "properties", and "same" keys.
         """
-        previous_layer = None
-        current_layer = None
-        for layer in layers:
-            previous_layer = current_layer
-            current_layer = layer
-            if layer[0] > depth:
-                break
+        modified = os.path.getmtime(xml_file)
+        key = (os.path.abspath(xml_file), interpolation)
+
+        if key in cls._parsed_models and cls._parsed_models[key]["modified"] == modified:
+            return cls._parsed_models[key]
 
-        name_to_use = name if not interpolate else name + " (interpolated)"
+        with open(xml_file, "r") as fd:
+            model_1d = xmltodict.parse(fd.read())
 
-        if previous_layer == current_layer:
-            # This is the last layer so return the properties.
-            return VelocityProperties(current_layer[1], current_layer[2], current_layer[3],
-                                      current_layer[4], current_layer[5], name_to_use, name_to_use,
-                                      name_to_use, name_to_use, name_to_use)
+        parsed_model = {
+            "name": str(model_1d["root"]["name"]).strip().lower(),
+            "format": str(model_1d["root"]["format"]).strip().lower(),
+            "interpolation": str(model_1d["root"]["interpolation"]).strip().lower()
+                             if interpolation is None else interpolation,
+            "modified": modified
+        }
+
+        layers = []
+        if parsed_model["format"] == "bbp":
+            cls._parse_bbp_model(str(model_1d["root"]["data"]), layers, parsed_model["interpolation"] == "linear")
+        else:
+            cls._parse_scec_model(model_1d["root"]["data"], layers)
+
+        # Missing properties (e.g. no Q in the model) are NaN in the arrays and None once returned.
+        parsed_model["depths"] = np.array([layer[0] for layer in layers], dtype=np.float64)
+        parsed_model["properties"] = np.array(
+            [[np.nan if x is None else x for x in layer[1:]] for layer in layers], dtype=np.float64
+        )
+        # True where a layer is identical to the one above it, which marks the last layer.
+        parsed_model["same"] = np.array([False] + [layers[i] == layers[i - 1] for i in range(1, len(layers))])
+
+        cls._parsed_models[key] = parsed_model
+        return parsed_model
+
+    @classmethod
+    def _get_velocity_data(cls, depths: np.ndarray, parsed_model: dict) -> List[VelocityProperties]:
+        """
+        Given an array of depths and a parsed model, this function returns the velocity data for the
+        1D model at each depth. The layers are found for all the depths at once.
+
+        Args:
+            depths (np.ndarray): The depths for which we want the properties.
+            parsed_model (dict): The parsed model returned by _load_model.
+
+        Returns:
+            A list of :obj:`VelocityProperties` for this model at the specified depths.
+        """
+        interpolate = parsed_model["interpolation"] == "linear"
+        name_to_use = parsed_model["name"] if not interpolate else parsed_model["name"] + " (interpolated)"
+        layer_depths = parsed_model["depths"]
+        properties = parsed_model["properties"]
+
+        # The layer below each depth. Depths beyond the bottom use the last two (identical) layers.
+        current = np.minimum(np.searchsorted(layer_depths, depths, side="right"), len(layer_depths) - 1)
+        previous = current - 1
+        last = parsed_model["same"][current]
 
-        # Otherwise, we need to either return the properties of the previous layer if no
-        # interpolation or we need to interpolate.
         if interpolate:
-            percentage = (depth - previous_layer[0]) / (current_layer[0] - previous_layer[0])
-            return VelocityProperties(
-                percentage * (current_layer[1] - previous_layer[1]) + previous_layer[1]
-                if previous_layer[1] is not None else None,
-                percentage * (current_layer[2] - previous_layer[2]) + previous_layer[2]
-                if previous_layer[2] is not None else None,
-                percentage * (current_layer[3] - previous_layer[3]) + previous_layer[3]
-                if previous_layer[3] is not None else None,
-                percentage * (current_layer[4] - previous_layer[4]) + previous_layer[4]
-                if previous_layer[4] is not None else None,
-                percentage * (current_layer[5] - previous_layer[5]) + previous_layer[5]
-                if previous_layer[5] is not None else None,
-                name_to_use, name_to_use, name_to_use, name_to_use, name_to_use
-            )
+            with np.errstate(divide="ignore", invalid="ignore"):
+                percentage = (depths - layer_depths[previous]) / (layer_depths[current] - layer_depths[previous])
+                values = percentage[:, np.newaxis] * (properties[current] - properties[previous]) + properties[previous]
         else:
-            return VelocityProperties(previous_layer[1], previous_layer[2], previous_layer[3],
-                                      previous_layer[4], previous_layer[5], name_to_use,
-                                      name_to_use, name_to_use, name_to_use, name_to_use)
+            values = properties[previous]
+
+        values[last] = properties[current[last]]
+
+        return [
+            VelocityProperties(*[None if np.isnan(x) else x for x in row],
+                               name_to_use, name_to_use, name_to_use, name_to_use, name_to_use)
+            for row in values.tolist()
+        ]
 
     def _query(self, data: List[SeismicData], **kwargs) -> bool:
         """
@@ -229,31 +265,16 @@ class OneDimensionalVelocityModel(VelocityModel):
         if xml_file is None:
             display_and_raise_error(13, (kwargs["params"],))
 
-        with open(xml_file, "r") as fd:
-            model_1d = xmltodict.parse(fd.read())
-
-        parsed_model = {
-            "name": str(model_1d["root"]["name"]).strip().lower(),
-            "format": str(model_1d["root"]["format"]).strip().lower(),
-            "interpolation": str(model_1d["root"]["interpolation"]).strip().lower()
-                             if interpolation is None else interpolation,
-            "layers": []
-        }
-
-        if parsed_model["format"] == "bbp":
-            self._parse_bbp_model(str(model_1d["root"]["data"]), parsed_model["layers"],
-                                  parsed_model["interpolation"] == "linear")
-        else:
-            self._parse_scec_model(model_1d["root"]["data"], parsed_model["layers"])
+        parsed_model = self._load_model(xml_file, interpolation)
 
+        in_model = [i for i in range(0, len(data)) if data[i].converted_point.z_value >= 0]
         for i in range(0, len(data)):
             if data[i].converted_point.z_value < 0:
                 self._set_velocity_properties_none(data[i])
-            else:
-                data[i].set_velocity_data(
-                    self._get_velocity_data(data[i].converted_point.z_value, parsed_model["layers"],
-                                            parsed_model["interpolation"] == "linear",
-                                            parsed_model["name"], parsed_model["format"])
-                )
+
+        if len(in_model) > 0:
+            depths = np.array([data[i].converted_point.z_value for i in in_model], dtype=np.float64)
+            for i, velocity_properties in zip(in_model, self._get_velocity_data(depths, parsed_model)):
+                data[i].set_velocity_data(velocity_properties)
 
         return True
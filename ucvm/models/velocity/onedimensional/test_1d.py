@@ -20,6 +20,7 @@ from ucvm.src.shared.test import UCVMTestCase
 from ucvm.src.framework.ucvm import UCVM
 from ucvm.src.shared.properties import SeismicData, Point, VelocityProperties
 from ucvm.src.shared.test import assert_velocity_properties
+from ucvm.src.shared.functions import calculate_scaled_density, calculate_scaled_vs
 
 
 class OneDimensionalVelocityModelTest(UCVMTestCase):
@@ -97,3 +98,47 @@ class OneDimensionalVelocityModelTest(UCVMTestCase):
         )
 
         self._test_end()
+
+    def test_onedimensional_scec_depth(self) -> None:
+        """
+        Tests the 1D model for a SCEC format depth query, including the linear interpolation between layers.
+
+        Returns:
+            Nothing
+        """
+        self._test_start("1D SCEC format test")
+
+        UCVM.query(self.data["depth"], "1d[SCEC]", ["velocity"])
+
+        vp = [5000, 5500]
+        density = [calculate_scaled_density(x) for x in vp]
+        vs = [calculate_scaled_vs(vp[i], density[i]) for i in range(0, 2)]
+
+        assert_velocity_properties(
+            self,
+            self.data["depth"][0],
+            VelocityProperties(vp[0], vs[0], density[0], None, None,
+                               "scec 1d (interpolated)", "scec 1d (interpolated)", "scec 1d (interpolated)",
+                               "scec 1d (interpolated)", "scec 1d (interpolated)")
+        )
+
+        query = [SeismicData(Point(-118, 34, 3000))]
+        UCVM.query(query, "1d[SCEC]", ["velocity"])
+
+        assert_velocity_properties(
+            self,
+            query[0],
+            VelocityProperties((vp[0] + vp[1]) / 2, (vs[0] + vs[1]) / 2, (density[0] + density[1]) / 2, None, None,
+                               "scec 1d (interpolated)", "scec 1d (interpolated)", "scec 1d (interpolated)",
+                               "scec 1d (interpolated)", "scec 1d (interpolated)")
+        )
+        assert_velocity_properties(
+            self,
+            self.data["depth"][3],
+            VelocityProperties(7800, calculate_scaled_vs(7800, calculate_scaled_density(7800)),
+                               calculate_scaled_density(7800), None, None,
+                               "scec 1d (interpolated)", "scec 1d (interpolated)", "scec 1d (interpolated)",
+                               "scec 1d (interpolated)", "scec 1d (interpolated)")
+        )
+
+        self._test_end()
@@ -19,15 +19,17 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 # Cython Imports
+cimport cython
 from libc.math cimport atan, pow, sin, sqrt, tan, cos, floor, fmod
 from libc.stdint cimport uintptr_t, int32_t, uint32_t
+from libc.stdlib cimport malloc, free
 
 cdef struct ucvm_epayload_t:
     float Vp
     float Vs
     float density
 
-cdef extern from "etree.h":
+cdef extern from "etree.h" nogil:
     struct etree_t:
         int error
         pass
@@ -45,14 +47,124 @@ cdef extern from "etree.h":
     char* etree_getappmeta(etree_t*)
     int etree_setappmeta(etree_t *, const char *)
     int etree_insert(etree_t *, etree_addr_t, const void *);
+    int etree_initcursor(etree_t *, etree_addr_t)
+    int etree_getcursor(etree_t *, etree_addr_t *, const char *, void *)
+    int etree_advcursor(etree_t *)
+    int etree_stopcursor(etree_t *)
     int etree_close(etree_t *)
 
+cdef int _bilinear_geo2xy(double lon, double lat, double *corner_x, double *corner_y, double dim_x,
+                          double dim_y, double *x_out, double *y_out) nogil:
+    cdef int i = 0, k = 0
+    cdef double x = 0, y = 0, x0 = 0, y0 = 0, dx = 0, dy = 0
+    cdef double j[4]
+    cdef double j1[4]
+    cdef double j2[4]
+    cdef double jinv[4]
+    cdef double xce = 0, yce = 0
+    cdef double res = 1, d = 0, p = 0, q = 0
+
+    cdef double csii[4]
+    cdef double ethai[4]
+
+    csii[0] = -1.0
+    csii[1] = -1.0
+    csii[2] = 1.0
+    csii[3] = 1.0
+
+    ethai[0] = -1.0
+    ethai[1] = 1.0
+    ethai[2] = 1.0
+    ethai[3] = -1.0
+
+    j1[0] = 0
+    j1[1] = 0
+    j1[2] = 0
+    j1[3] = 0
+
+    for i in range(4):
+        j1[0] += corner_x[i] * csii[i]
+        j1[1] += corner_x[i] * ethai[i]
+        j1[2] += corner_y[i] * csii[i]
+        j1[3] += corner_y[i] * ethai[i]
+        xce += corner_x[i] * csii[i] * ethai[i]
+        yce += corner_y[i] * csii[i] * ethai[i]
+
+    while res > 0.000000000001 and k <= 10:
+        k += 1
+        j2[0] = y * xce
+        j2[1] = x * xce
+        j2[2] = y * yce
+        j2[3] = x * yce
+
+        j[0] = 0.25 * (j1[0] + j2[0])
+        j[1] = 0.25 * (j1[1] + j2[1])
+        j[2] = 0.25 * (j1[2] + j2[2])
+        j[3] = 0.25 * (j1[3] + j2[3])
+
+        d = (j[0] * j[3]) - (j[2] * j[1])
+        jinv[0] = j[3] / d
+        jinv[1] = -j[1] / d
+        jinv[2] = -j[2] / d
+        jinv[3] = j[0] / d
+
+        x0 = 0
+        y0 = 0
+
+        for i in range(4):
+            x0 += corner_x[i] * (.25 * (1 + (csii[i]  * x)) * (1 + (ethai[i] * y)))
+            y0 += corner_y[i] * (.25 * (1 + (csii[i]  * x)) * (1 + (ethai[i] * y)))
+
+        p = lon - x0
+        q = lat - y0
+
+        dx = (jinv[0] * p) + (jinv[1] * q)
+        dy = (jinv[2] * p) + (jinv[3] * q)
+
+        x += dx
+        y += dy
+
+        res = dx * dx + dy * dy
+
+    if k > 10:
+        return -1
+
+    x_out[0] = (x + 1) * dim_x / 2.0
+    y_out[0] = (y + 1) * dim_y / 2.0
+
+    return 0
+
+cdef inline bint _less_msb(uint32_t a, uint32_t b) nogil:
+    return a < b and a < (a ^ b)
+
+cdef int _compare_locational(etree_addr_t *a, etree_addr_t *b) nogil:
+    # Compares the locational codes of two octants: the bits of their z, y, and x ticks interleaved, most
+    # significant first, with a parent before its children. The dimension with the highest differing bit
+    # decides, and z wins a tie, then y.
+    cdef uint32_t a_tick = a.z
+    cdef uint32_t b_tick = b.z
+    cdef uint32_t difference = a.z ^ b.z
+
+    if _less_msb(difference, a.y ^ b.y):
+        a_tick = a.y
+        b_tick = b.y
+        difference = a.y ^ b.y
+    if _less_msb(difference, a.x ^ b.x):
+        a_tick = a.x
+        b_tick = b.x
+        difference = a.x ^ b.x
+
+    if difference != 0:
+        return -1 if a_tick < b_tick else 1
+
+    return a.level - b.level
+
 class UCVMCCommon:
 
     @staticmethod
-    def c_etree_open(char *path, int mode):
+    def c_etree_open(char *path, int mode, int buffer_size=64):
         cdef int32_t imode = mode
-        cdef int32_t bufsize = 64
+        cdef int32_t bufsize = buffer_size
         cdef int32_t payloadsize = 0
         cdef int32_t dimensions = 3
         return <uintptr_t>etree_open(path, imode, bufsize, payloadsize, dimensions)
@@ -102,6 +214,174 @@ class UCVMCCommon:
 
         return etree_insert(<etree_t *>opened_etree, addr, &payload)
 
+    @staticmethod
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def c_etree_insert_batch(uintptr_t opened_etree, long long[:, ::1] addresses, float[:, ::1] payloads) -> int:
+        """
+        Inserts many octants at once. The inserts run without the GIL, in the order given, so octants
+        that are sorted by address are appended to the etree's pages in order.
+
+        Args:
+            opened_etree (uintptr_t): The etree handle from c_etree_open.
+            addresses (long long[:, ::1]): The x, y, and z ticks and the level of each octant.
+            payloads (float[:, ::1]): The Vp, Vs, and density of each octant.
+
+        Returns:
+            The number of octants that could not be inserted, such as those that were already in the etree.
+        """
+        cdef etree_t *etree = <etree_t *>opened_etree
+        cdef etree_addr_t addr
+        cdef ucvm_epayload_t payload
+        cdef Py_ssize_t i
+        cdef int failed = 0
+
+        if addresses.shape[0] != payloads.shape[0] or addresses.shape[1] != 4 or payloads.shape[1] != 3:
+            raise ValueError("There must be four address values and three payload values for each octant.")
+
+        with nogil:
+            for i in range(addresses.shape[0]):
+                addr.x = addresses[i, 0]
+                addr.y = addresses[i, 1]
+                addr.z = addresses[i, 2]
+                addr.level = addresses[i, 3]
+
+                payload.Vp = payloads[i, 0]
+                payload.Vs = payloads[i, 1]
+                payload.density = payloads[i, 2]
+
+                if etree_insert(etree, addr, &payload) != 0:
+                    failed += 1
+
+        return failed
+
+    @staticmethod
+    def c_etree_copy(uintptr_t source_etree, uintptr_t destination_etree) -> (int, int):
+        """
+        Copies every octant, and the application metadata, of one etree into another. The octants are
+        read with a cursor, which visits them in the order of their locational codes, so they are
+        appended to the destination in order and fill its pages.
+
+        Args:
+            source_etree (uintptr_t): The etree to copy, from c_etree_open.
+            destination_etree (uintptr_t): The new, empty etree, from c_etree_open, with the schema registered.
+
+        Returns:
+            The number of octants copied and the number that could not be inserted.
+        """
+        cdef etree_t *source = <etree_t *>source_etree
+        cdef etree_t *destination = <etree_t *>destination_etree
+        cdef etree_addr_t addr
+        cdef ucvm_epayload_t payload
+        cdef char *appmeta = etree_getappmeta(source)
+        cdef long long copied = 0, failed = 0
+
+        if appmeta != NULL:
+            etree_setappmeta(destination, appmeta)
+
+        addr.x = 0
+        addr.y = 0
+        addr.z = 0
+        addr.t = 0
+        addr.level = 0
+        addr.tree_type = 0
+
+        with nogil:
+            if etree_initcursor(source, addr) == 0:
+                while True:
+                    if etree_getcursor(source, &addr, "*", &payload) != 0:
+                        break
+                    if etree_insert(destination, addr, &payload) != 0:
+                        failed += 1
+                    copied += 1
+                    if etree_advcursor(source) != 0:
+                        break
+                etree_stopcursor(source)
+
+        return copied, failed
+
+    @staticmethod
+    def c_etree_merge(sources: list, uintptr_t destination_etree) -> (int, int):
+        """
+        Merges etrees whose octants do not overlap into another. Each etree is read with a cursor, in the
+        order of the locational codes, and the first octant of all of them is appended to the destination
+        each time, so the merged etree is written in order, as c_etree_copy writes one etree. The
+        application metadata of the first etree is copied.
+
+        Args:
+            sources (list): The etrees to merge, from c_etree_open.
+            destination_etree (uintptr_t): The new, empty etree, from c_etree_open, with the schema registered.
+
+        Returns:
+            The number of octants merged and the number that could not be inserted.
+        """
+        cdef etree_t *destination = <etree_t *>destination_etree
+        cdef int count = len(sources)
+        cdef etree_t **etrees = <etree_t **>malloc(count * sizeof(etree_t *))
+        cdef etree_addr_t *addrs = <etree_addr_t *>malloc(count * sizeof(etree_addr_t))
+        cdef ucvm_epayload_t *payloads = <ucvm_epayload_t *>malloc(count * sizeof(ucvm_epayload_t))
+        cdef char *started = <char *>malloc(count * sizeof(char))
+        cdef char *active = <char *>malloc(count * sizeof(char))
+        cdef etree_addr_t root
+        cdef char *appmeta
+        cdef long long merged = 0, failed = 0
+        cdef int i = 0, first = 0
+
+        if etrees == NULL or addrs == NULL or payloads == NULL or started == NULL or active == NULL:
+            free(etrees)
+            free(addrs)
+            free(payloads)
+            free(started)
+            free(active)
+            raise MemoryError("Could not allocate the etree cursors.")
+
+        for i in range(count):
+            etrees[i] = <etree_t *><uintptr_t>sources[i]
+
+        if count > 0:
+            appmeta = etree_getappmeta(etrees[0])
+            if appmeta != NULL:
+                etree_setappmeta(destination, appmeta)
+
+        root.x = 0
+        root.y = 0
+        root.z = 0
+        root.t = 0
+        root.level = 0
+        root.tree_type = 0
+
+        with nogil:
+            for i in range(count):
+                started[i] = etree_initcursor(etrees[i], root) == 0
+                active[i] = started[i] and etree_getcursor(etrees[i], &addrs[i], "*", &payloads[i]) == 0
+
+            while True:
+                first = -1
+                for i in range(count):
+                    if active[i] and (first < 0 or _compare_locational(&addrs[i], &addrs[first]) < 0):
+                        first = i
+                if first < 0:
+                    break
+
+                if etree_insert(destination, addrs[first], &payloads[first]) != 0:
+                    failed += 1
+                merged += 1
+
+                active[first] = etree_advcursor(etrees[first]) == 0 and \
+                                etree_getcursor(etrees[first], &addrs[first], "*", &payloads[first]) == 0
+
+            for i in range(count):
+                if started[i]:
+                    etree_stopcursor(etrees[i])
+
+        free(etrees)
+        free(addrs)
+        free(payloads)
+        free(started)
+        free(active)
+
+        return merged, failed
+
     @staticmethod
     def c_etree_query(uintptr_t opened_etree, float lon, float lat, float depth, corners: tuple,
                       dims: tuple, ticks: tuple) -> (float, float, float):
@@ -125,84 +405,84 @@ class UCVMCCommon:
         else:
             return None
 
+    @staticmethod
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def c_etree_query_batch(uintptr_t opened_etree, double[::1] lons, double[::1] lats, double[::1] depths,
+                            corners: tuple, dims: tuple, ticks: tuple, float[:, ::1] properties,
+                            unsigned char[::1] found, Py_ssize_t[::1] order) -> int:
+        """
+        Queries the etree at many points at once. The conversion to etree coordinates and the octant
+        search run without the GIL, in the sequence given by order, so that sorting the points by
+        locality keeps the etree's page cache warm.
+
+        Args:
+            opened_etree (uintptr_t): The etree handle from c_etree_open.
+            lons (double[::1]): The longitudes of the points.
+            lats (double[::1]): The latitudes of the points.
+            depths (double[::1]): The depths of the points.
+            corners (tuple): The four corners of the etree as in c_etree_query.
+            dims (tuple): The dimensions of the etree as in c_etree_query.
+            ticks (tuple): The ticks of the etree as in c_etree_query.
+            properties (float[:, ::1]): Filled with Vp, Vs, and density for each point that was found.
+            found (unsigned char[::1]): Set to 1 for each point that was found and 0 otherwise.
+            order (Py_ssize_t[::1]): The order in which to query the points.
+
+        Returns:
+            The number of points that could not be converted to etree coordinates. These are not found.
+        """
+        cdef etree_t *etree = <etree_t *>opened_etree
+        cdef etree_addr_t addr
+        cdef ucvm_epayload_t payload
+        cdef double corner_x[4]
+        cdef double corner_y[4]
+        cdef double dim_x = dims[0], dim_y = dims[1], dim_z = dims[2]
+        cdef double tick_x = ticks[0], tick_y = ticks[1], tick_z = ticks[2]
+        cdef double x = 0, y = 0
+        cdef Py_ssize_t i, index
+        cdef int failed = 0
+
+        for i in range(4):
+            corner_x[i] = corners[i][0]
+            corner_y[i] = corners[i][1]
+
+        with nogil:
+            for i in range(order.shape[0]):
+                index = order[i]
+                found[index] = 0
+
+                # Coordinates are rounded to single precision, as c_etree_query does.
+                if _bilinear_geo2xy(<float>lons[index], <float>lats[index], corner_x, corner_y, dim_x, dim_y,
+                                    &x, &y) != 0:
+                    failed += 1
+                    continue
+
+                addr.x = <long>(x / dim_x * tick_x)
+                addr.y = <long>(y / dim_y * tick_y)
+                addr.z = <long>(<float>depths[index] / dim_z * tick_z)
+                addr.level = 31
+
+                if etree_search(etree, addr, NULL, "*", &payload) == 0:
+                    properties[index, 0] = payload.Vp
+                    properties[index, 1] = payload.Vs
+                    properties[index, 2] = payload.density
+                    found[index] = 1
+
+        return failed
+
     @staticmethod
     def c_etree_bilinear_geo2xy(float lon, float lat, corners: tuple, dims: tuple) -> (float, float):
-        cdef int i = 0, k = 0
-        cdef double x = 0, y = 0, x0 = 0, y0 = 0, dx = 0, dy = 0
-        cdef double j[4]
-        cdef double j1[4]
-        cdef double j2[4]
-        cdef double jinv[4]
-        cdef double xce = 0, yce = 0
-        cdef double res = 1, d = 0, p = 0, q = 0
-
-        cdef double csii[4]
-        cdef double ethai[4]
-
-        csii[0] = -1.0
-        csii[1] = -1.0
-        csii[2] = 1.0
-        csii[3] = 1.0
-
-        ethai[0] = -1.0
-        ethai[1] = 1.0
-        ethai[2] = 1.0
-        ethai[3] = -1.0
-
-        j1[0] = 0
-        j1[1] = 0
-        j1[2] = 0
-        j1[3] = 0
+        cdef double corner_x[4]
+        cdef double corner_y[4]
+        cdef double x = 0, y = 0
+        cdef int i = 0
 
         for i in range(4):
-            j1[0] += corners[i][0] * csii[i]
-            j1[1] += corners[i][0] * ethai[i]
-            j1[2] += corners[i][1] * csii[i]
-            j1[3] += corners[i][1] * ethai[i]
-            xce += corners[i][0] * csii[i] * ethai[i]
-            yce += corners[i][1] * csii[i] * ethai[i]
-
-        while res > 0.000000000001 and k <= 10:
-            k += 1
-            j2[0] = y * xce
-            j2[1] = x * xce
-            j2[2] = y * yce
-            j2[3] = x * yce
-
-            j[0] = 0.25 * (j1[0] + j2[0])
-            j[1] = 0.25 * (j1[1] + j2[1])
-            j[2] = 0.25 * (j1[2] + j2[2])
-            j[3] = 0.25 * (j1[3] + j2[3])
-
-            d = (j[0] * j[3]) - (j[2] * j[1])
-            jinv[0] = j[3] / d
-            jinv[1] = -j[1] / d
-            jinv[2] = -j[2] / d
-            jinv[3] = j[0] / d
-
-            x0 = 0
-            y0 = 0
-
-            for i in range(4):
-                x0 += corners[i][0] * (.25 * (1 + (csii[i]  * x)) * (1 + (ethai[i] * y)))
-                y0 += corners[i][1] * (.25 * (1 + (csii[i]  * x)) * (1 + (ethai[i] * y)))
-
-            p = lon - x0
-            q = lat - y0
-
-            dx = (jinv[0] * p) + (jinv[1] * q)
-            dy = (jinv[2] * p) + (jinv[3] * q)
-
-            x += dx
-            y += dy
-
-            res = dx * dx + dy * dy
-
-        if k > 10:
-            raise Exception("Could not convert lon, lat to XY.")
+            corner_x[i] = corners[i][0]
+            corner_y[i] = corners[i][1]
 
-        x = (x + 1) * dims[0] / 2.0
-        y = (y + 1) * dims[1] / 2.0
+        if _bilinear_geo2xy(lon, lat, corner_x, corner_y, dims[0], dims[1], &x, &y) != 0:
+            raise Exception("Could not convert lon, lat to XY.")
 
         return (x, y)
 
@@ -31,12 +31,24 @@ sys.argv = sys.argv[:-1]
 
 print("Installing C components of UCVM...")
 
+# Build from the Cython source when Cython is available. The checked-in common.c is generated from common.pyx
+# (cython -3 --module-name ucvm_c_common common.pyx) and must be regenerated whenever common.pyx changes.
+try:
+    from Cython.Build import cythonize
+    _SOURCE = "common.pyx"
+except ImportError:
+    cythonize = None
+    _SOURCE = "common.c"
+
 ext_modules = [
-    Extension("ucvm_c_common", ["common.c"], libraries=["etree"],
+    Extension("ucvm_c_common", [_SOURCE], libraries=["etree"],
               library_dirs=[os.path.join(_LOCAL_LIBRARY_PATH, "euclid3", "lib")],
               include_dirs=[os.path.join(_LOCAL_LIBRARY_PATH, "euclid3", "include")])
 ]
 
+if cythonize is not None:
+    ext_modules = cythonize(ext_modules, compiler_directives={"language_level": 3})
+
 setup(
     name="ucvm_c_common",
     ext_modules=ext_modules
@@ -21,14 +21,18 @@ limitations under the License.
 # Python Imports
 import os
 import sys
-import struct
 import math
+import itertools
+import multiprocessing
 import time
+import zlib
 from multiprocessing import current_process
 from typing import List
 
 # Package Imports
+import h5py
 import humanize
+import numpy as np
 import xmltodict
 import pyproj
 
@@ -37,18 +41,40 @@ from ucvm.src.framework.ucvm import UCVM
 from ucvm.src.shared.constants import UCVM_DEFAULT_PROJECTION
 from ucvm.src.shared.functions import ask_and_validate, is_number, is_valid_proj4_string, \
     is_acceptable_value, get_utm_zone_for_lon
-from ucvm.src.shared.properties import SeismicData, VelocityProperties
+from ucvm.src.shared.properties import SeismicData
 from ucvm.src.framework.mesh_common import InternalMesh, AWPInternalMeshIterator, \
-    RWGInternalMeshIterator
+    RWGInternalMeshIterator, ColumnInternalMeshIterator, MeshWriter, MPIMeshWriter, HDF5MeshWriter, \
+    MPIHDF5MeshWriter, MeshQA, get_aligned_chunk_size, read_hdf5_points, get_mesh_blocks, write_mesh_blocks, \
+    HDF5_DATASETS
+from ucvm.src.framework.journal import ExtractionJournal, subtract_ranges
+from ucvm.src.framework.chunk_tuner import ChunkTuner, MAX_CHUNK_SIZE, resize_seismicdata_array
+from ucvm.src.framework.mesh_manifest import MeshManifest, get_manifest_path
 
+CHECKPOINT_ROUNDS = 16      #: int: Write rounds between MPI mesh checkpoints (sync and journal update).
+CHUNKS_PER_PROCESS = 8      #: int: The fewest chunks each local worker gets, so that the pool can balance load.
 
-def mesh_extract_mpi(information: dict, start_end: tuple) -> bool:
+
+def mesh_extract_mpi(information: dict, start_end: tuple, chunk_size: int=None, aggregators: int=None,
+                     stripe_size: int=None, resume: bool=False, qa_indices: bool=False,
+                     memory_budget: int=None) -> bool:
     """
     Extracts the parameters for the MPI process.
 
     Args:
         information (dict): The dictionary containing the metadata defining the extraction.
         start_end (tuple): The tuple defining the start and end poing.
+        chunk_size (int): If given, start_end is the whole range to extract on every rank, and the ranks pull
+            chunks of chunk_size points from a shared counter until the range is done. Otherwise each rank
+            extracts just its own start_end range.
+        aggregators (int): If given, the ranks write together with collective MPI-IO, gathering the data on this
+            many aggregator ranks (0 lets MPI-IO decide). Otherwise each rank writes its own chunks.
+        stripe_size (int): If given, chunks are sized to whole stripes of this many bytes.
+        resume (bool): True to skip the chunks that the mesh's journal records as complete, and whose data in the
+            mesh still matches the checksum in the journal. Otherwise a new journal is started.
+        qa_indices (bool): True to dump the indices of the points counted in the QA report.
+        memory_budget (int): The memory, in bytes, that one rank's chunk may use. The number of points queried at
+            once is chosen within it by a ChunkTuner on each rank. By default a third of the available memory, split
+            between the ranks on the node.
 
     Returns:
         True, when successful. Raises an error if the extraction fails.
@@ -58,120 +84,380 @@ def mesh_extract_mpi(information: dict, start_end: tuple) -> bool:
     comm = MPI.COMM_WORLD
     rank = comm.Get_rank()
 
+    files = _get_mpi_output_files(information)
+    point_size = 4 if information["format"] == "rwg" else 12
+
+    if rank == 0:
+        journal = ExtractionJournal(os.path.join(information["out_dir"], information["mesh_name"] + ".journal"),
+                                    information)
+        if resume:
+            completed = _get_verified_ranges(files, point_size, journal.load())
+            print("[Node %d] Resuming. %s grid points were already extracted." % (
+                rank, humanize.intcomma(sum(end - start for start, end in completed))
+            ), flush=True)
+        else:
+            journal.start()
+            completed = []
+    else:
+        journal = None
+        completed = None
+
+    remaining = subtract_ranges(start_end, comm.bcast(completed, root=0))
+
     internal_mesh = InternalMesh(information)
-    max_pts = 250000
+    if len(remaining) > 0:
+        _load_models(information, internal_mesh, RWGInternalMeshIterator if information["format"] == "rwg" else
+                     AWPInternalMeshIterator, remaining[0][0])
 
-    sd_array = [SeismicData() for _ in range(0, max_pts)]
+    if stripe_size is not None and chunk_size is not None:
+        chunk_size = get_aligned_chunk_size(chunk_size, point_size, stripe_size)
 
-    print(
-        "[Node %d] Responsible for extracting %d grid points. We can extract %d at once.\nStarting extraction..." % (
-            rank, start_end[1] - start_end[0], max_pts
-        ), flush=True
-    )
+    node = comm.Split_type(MPI.COMM_TYPE_SHARED)
+    tuner = ChunkTuner(memory_budget, node.Get_size(),
+                       maximum=chunk_size or sum(end - start for start, end in remaining))
+    node.Free()
+    sd_array = []
+
+    if stripe_size is None:
+        next_size = tuner.next_size
+    else:
+        # Whole stripes keep the pieces that start on a stripe boundary ending on one.
+        next_size = lambda: get_aligned_chunk_size(tuner.next_size(), point_size, stripe_size)
+
+    window = None
+    if chunk_size is None:
+        print(
+            "[Node %d] Responsible for extracting %d grid points, starting with %d at once.\n"
+            "Starting extraction..." % (rank, sum(end - start for start, end in remaining), tuner.size),
+            flush=True
+        )
+        chunks = _get_static_chunks(remaining, next_size)
+    else:
+        print(
+            "[Node %d] Sharing %d grid points in chunks of %d, starting with %d at once.\n"
+            "Starting extraction..." % (rank, start_end[1] - start_end[0], chunk_size, tuner.size), flush=True
+        )
+        # The window holding the shared chunk counter is freed collectively, so it must outlive the extraction on
+        # every rank rather than be freed by whichever rank runs out of chunks first.
+        counter = np.zeros(1 if rank == 0 else 0, dtype=np.int64)
+        window = MPI.Win.Create(counter, disp_unit=counter.itemsize, comm=comm)
+        chunks = _get_dynamic_chunks(window, start_end, remaining, chunk_size, next_size)
 
     information["minimums"]["vp"] = float(information["minimums"]["vp"])
     information["minimums"]["vs"] = float(information["minimums"]["vs"])
 
+    timing = {"busy": 0.0, "idle": 0.0, "write": 0.0, "points": 0}
+    manifest = MeshManifest(files)
+    if information["format"] == "hdf5":
+        writer = MPIHDF5MeshWriter(files["hdf5"], information, aggregators=aggregators if aggregators else None,
+                                   stripe_size=stripe_size, journal=journal, checkpoint_rounds=CHECKPOINT_ROUNDS,
+                                   manifest=manifest)
+    else:
+        writer = MPIMeshWriter(files, collective=aggregators is not None,
+                               aggregators=aggregators if aggregators else None, stripe_size=stripe_size,
+                               journal=journal, checkpoint_rounds=CHECKPOINT_ROUNDS, manifest=manifest)
+
+    qa = MeshQA(information["minimums"], qa_indices, information["format"])
+
+    chunks = _timed_chunks(chunks, timing, tuner)
+
     if information["format"] == "rwg":
-        _mesh_extract_mpi_rwg(sd_array, information, internal_mesh, start_end)
-    elif information["format"] == "awp":
-        _mesh_extract_mpi_awp(sd_array, information, internal_mesh, start_end)
+        _mesh_extract_mpi_rwg(sd_array, information, internal_mesh, chunks, timing, writer, qa)
     else:
-        raise ValueError("Invalid mesh format.")
+        _mesh_extract_mpi_awp(sd_array, information, internal_mesh, chunks, timing, writer, qa)
+
+    if window is not None:
+        window.Free()
 
     print(
-        "[Node %d] Extraction is done!" % rank
+        "[Node %d] Extraction is done!\n[Node %d] %s" % (rank, rank, tuner.report())
     )
 
+    _report_mpi_timing(information, timing)
 
-def _mesh_extract_mpi_awp(sd_array: List[SeismicData], information: dict, im: InternalMesh, start_end: tuple) -> bool:
+    all_qa = comm.gather(qa, root=0)
+    all_manifests = comm.gather(manifest, root=0)
+    if rank == 0:
+        for rank_qa in all_qa[1:]:
+            all_qa[0].merge(rank_qa)
+        _write_qa_report(information, all_qa[0])
+        for rank_manifest in all_manifests[1:]:
+            all_manifests[0].merge(rank_manifest)
+        _save_manifest(information, all_manifests[0])
+
+    return True
+
+
+def _get_mpi_output_files(information: dict) -> dict:
     """
-    Extract an AWP mesh using MPI. Internal method.
+    Returns the paths of the files that make up the mesh, keyed by the names the MPI extraction writes them under.
 
     Args:
+        information (dict): The dictionary containing the metadata defining the extraction.
 
     Returns:
-        True, if successful. Raises an error if not successful.
+        A dictionary of file paths.
+    """
+    file_out = os.path.join(information["out_dir"], information["mesh_name"])
+
+    if information["format"] == "awp":
+        return {"awp": file_out + ".awp"}
+    elif information["format"] == "rwg":
+        return {"vp": file_out + ".rwgvp", "vs": file_out + ".rwgvs", "dn": file_out + ".rwgdn"}
+    elif information["format"] == "hdf5":
+        return {"hdf5": file_out + ".h5"}
+    else:
+        raise ValueError("Invalid mesh format.")
+
+
+def _get_verified_ranges(files: dict, point_size: int, entries: List[tuple]) -> List[tuple]:
+    """
+    Checks the chunks recorded in a mesh journal against the data in the mesh files. A chunk only counts as done
+    if its data still has the checksum that was recorded when it was written.
+
+    Args:
+        files (dict): The mesh file paths, as returned by _get_mpi_output_files.
+        point_size (int): The number of bytes per point in each file.
+        entries (list): The (start, end, checksum) tuples read from the journal.
+
+    Returns:
+        The list of (start, end) ranges that are done.
+    """
+    verified = []
+
+    if False in [os.path.exists(path) for path in files.values()]:
+        return verified
+
+    if "hdf5" in files:
+        # The checksum is of the (n, 3) values as written, so read them back the same way.
+        with h5py.File(files["hdf5"], "r") as handle:
+            datasets = [handle[name] for name in HDF5_DATASETS]
+            for start, end, checksum in entries:
+                if zlib.crc32(memoryview(read_hdf5_points(datasets, start, end)).cast("B")) == checksum:
+                    verified.append((start, end))
+        return verified
+
+    handles = {key: open(path, "rb") for key, path in files.items()}
+    try:
+        for start, end, checksum in entries:
+            data_checksum = 0
+            for key in sorted(handles):
+                handles[key].seek(start * point_size)
+                data_checksum = zlib.crc32(handles[key].read((end - start) * point_size), data_checksum)
+            if data_checksum == checksum:
+                verified.append((start, end))
+    finally:
+        for handle in handles.values():
+            handle.close()
+
+    return verified
+
+
+def _get_static_chunks(remaining: List[tuple], next_size: callable):
+    """
+    Splits the rest of this rank's own range into chunks.
+
+    Args:
+        remaining (list): The (start, end) ranges that this rank has left to extract.
+        next_size (callable): Returns the maximum number of points in the next chunk.
+
+    Returns:
+        A generator of (start, end) tuples.
+    """
+    for range_start, range_end in remaining:
+        yield from _split_range(range_start, range_end, next_size)
+
+
+def _split_range(range_start: int, range_end: int, next_size: callable):
+    """
+    Splits a range of points into pieces, asking for the size of each piece just before it is returned, so that
+    the size can change with what the previous pieces showed.
+
+    Args:
+        range_start (int): The first point of the range.
+        range_end (int): The end of the range, exclusive.
+        next_size (callable): Returns the maximum number of points in the next piece.
+
+    Returns:
+        A generator of (start, end) tuples.
+    """
+    start = range_start
+    while start < range_end:
+        end = min(start + next_size(), range_end)
+        yield (start, end)
+        start = end
+
+
+def _get_dynamic_chunks(window, start_end: tuple, remaining: List[tuple], chunk_size: int, next_size: callable):
+    """
+    Hands out chunks of the range to whichever rank asks next. The next chunk number is a counter on rank 0 that
+    every rank atomically increments, so no rank needs to stop working to coordinate the others. Only the parts of
+    each chunk that are still left to extract are returned, split into pieces.
+
+    Args:
+        window (MPI.Win): The window exposing the chunk counter on rank 0.
+        start_end (tuple): The full range of points, the same on every rank.
+        remaining (list): The (start, end) ranges within start_end that are left to extract.
+        chunk_size (int): The number of points in each chunk.
+        next_size (callable): Returns the maximum number of points in the next piece.
+
+    Returns:
+        A generator of (start, end) tuples.
+    """
+    from mpi4py import MPI
+
+    increment = np.ones(1, dtype=np.int64)
+    chunk = np.zeros(1, dtype=np.int64)
+
+    while True:
+        window.Lock(0)
+        window.Fetch_and_op([increment, MPI.INT64_T], [chunk, MPI.INT64_T], 0, 0, MPI.SUM)
+        window.Unlock(0)
+
+        chunk_start = start_end[0] + int(chunk[0]) * chunk_size
+        if chunk_start >= start_end[1]:
+            break
+
+        chunk_end = min(chunk_start + chunk_size, start_end[1])
+
+        for range_start, range_end in remaining:
+            range_start = max(range_start, chunk_start)
+            range_end = min(range_end, chunk_end)
+            yield from _split_range(range_start, range_end, next_size)
+
+
+def _report_mpi_timing(information: dict, timing: dict) -> None:
+    """
+    Gathers every rank's busy, idle, and write time on rank 0, prints a summary, and writes the per-rank times to
+    [mesh_name]_timing.txt in the output directory.
+
+    Args:
+        information (dict): The dictionary containing the metadata defining the extraction.
+        timing (dict): This rank's "busy", "idle", and "write" seconds and the number of "points" it extracted.
+
+    Returns:
+        Nothing
     """
     from mpi4py import MPI
 
     comm = MPI.COMM_WORLD
-    rank = comm.Get_rank()
+    all_timing = comm.gather(timing, root=0)
+
+    if comm.Get_rank() != 0:
+        return
+
+    busy = [x["busy"] for x in all_timing]
+    idle = [x["idle"] for x in all_timing]
+    write = [x["write"] for x in all_timing]
+
+    print("\n[Node 0] Busy time per rank: min %.2fs, mean %.2fs, max %.2fs. Idle time per rank: min %.2fs, "
+          "mean %.2fs, max %.2fs. Write time per rank: min %.2fs, mean %.2fs, max %.2fs. Imbalance (max busy / "
+          "mean busy): %.3f." % (
+              min(busy), sum(busy) / len(busy), max(busy), min(idle), sum(idle) / len(idle), max(idle),
+              min(write), sum(write) / len(write), max(write),
+              max(busy) / (sum(busy) / len(busy)) if sum(busy) > 0 else 1.0
+          ), flush=True)
 
-    file_out = os.path.join(information["out_dir"], information["mesh_name"]) + ".awp"
+    with open(os.path.join(information["out_dir"], information["mesh_name"] + "_timing.txt"), "w") as fd:
+        fd.write("rank busy idle write points\n")
+        for rank, rank_timing in enumerate(all_timing):
+            fd.write("%d %.3f %.3f %.3f %d\n" % (rank, rank_timing["busy"], rank_timing["idle"],
+                                                 rank_timing["write"], rank_timing["points"]))
 
-    im_iter = AWPInternalMeshIterator(im, start_end[0], start_end[1], len(sd_array), sd_array)
 
-    progress = start_end[0]
-    sqrt2 = math.sqrt(2)
+def _timed_chunks(chunks, timing: dict, tuner: ChunkTuner):
+    """
+    Passes the chunks through, counting the time spent waiting for each chunk as idle time and the time spent
+    extracting it as busy time. The time the extraction spends in the writer, which the extraction adds up in
+    timing["write"], is left out of the busy time, since a collective write waits for the slowest rank.
+
+    Args:
+        chunks: The generator of (start, end) tuples.
+        timing (dict): The dictionary in which to add up the "busy" and "idle" seconds and the "points".
+        tuner (ChunkTuner): The tuner to tell how long each chunk took to query and post-process.
+
+    Returns:
+        A generator of (start, end) tuples.
+    """
+    waiting = time.time()
+    for chunk in chunks:
+        started = time.time()
+        timing["idle"] += started - waiting
+        written = timing["write"]
+        yield chunk
+        waiting = time.time()
+        busy = waiting - started - (timing["write"] - written)
+        timing["busy"] += busy
+        timing["points"] += chunk[1] - chunk[0]
+        tuner.record(chunk[1] - chunk[0], busy)
+    timing["idle"] += time.time() - waiting
+
+
+def _mesh_extract_mpi_awp(sd_array: List[SeismicData], information: dict, im: InternalMesh, chunks,
+                          timing: dict, writer: MPIMeshWriter, qa: MeshQA) -> bool:
+    """
+    Extract an AWP or HDF5 mesh using MPI. Internal method.
+
+    Args:
+        sd_array (list): The SeismicData array to use for the queries.
+        information (dict): The mesh information dictionary (from the XML config file).
+        im (InternalMesh): The internal representation of the AWP or HDF5 mesh.
+        chunks: A generator of the (start, end) ranges this rank should extract, timed by _timed_chunks.
+        timing (dict): The dictionary in which to add up this rank's busy, idle, and write time.
+        writer (MPIMeshWriter): The writer for the mesh files, which is closed when the extraction is done.
+        qa (MeshQA): The post-processing stage, which adds up this rank's QA statistics.
 
-    fh = MPI.File.Open(MPI.COMM_WORLD, file_out, amode=MPI.MODE_WRONLY | MPI.MODE_CREATE)
+    Returns:
+        True, if successful. Raises an error if not successful.
+    """
+    from mpi4py import MPI
+
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
 
-    while progress < im_iter.end_point:
+    for start, end in chunks:
+        resize_seismicdata_array(sd_array, end - start)
+        im_iter = AWPInternalMeshIterator(im, start, end, end - start, sd_array)
         count = next(im_iter)
 
         UCVM.query(sd_array[0:count], information["cvm_list"], ["velocity"])
 
-        fl_array = []
-        for s in sd_array[0:count]:
-            if s.velocity_properties is not None and s.velocity_properties.vs is not None and \
-               s.velocity_properties.vs < information["minimums"]["vs"]:
-                s.set_velocity_data(
-                    VelocityProperties(
-                        information["minimums"]["vp"], information["minimums"]["vs"],
-                        s.velocity_properties.density, s.velocity_properties.qp,
-                        s.velocity_properties.qs, s.velocity_properties.vp_source,
-                        s.velocity_properties.vs_source, s.velocity_properties.density_source,
-                        s.velocity_properties.qp_source, s.velocity_properties.qs_source
-                    )
-                )
-
-            fl_array.append(s.velocity_properties.vp)
-            fl_array.append(s.velocity_properties.vs)
-            fl_array.append(s.velocity_properties.density)
-
-            if s.velocity_properties is None or s.velocity_properties.vp is None or \
-               s.velocity_properties.vs is None or s.velocity_properties.density is None:
-                print("[Node %d] Attention! %.3f, %.3f, %.3f has no material properties." % (
-                    rank, s.original_point.x_value, s.original_point.y_value, s.original_point.z_value
-                ), flush=True)
-            if s.velocity_properties is not None and s.velocity_properties.vp is not None and \
-               s.velocity_properties.vs is not None and s.velocity_properties.vp / s.velocity_properties.vs < sqrt2:
-                print("[Node %d] Warning: %.3f, %.3f, %.3f has a Vp/Vs ratio of less than sqrt(2)." % (
-                    rank, s.original_point.x_value, s.original_point.y_value, s.original_point.z_value
-                ), flush=True)
-        s = struct.pack('f' * len(fl_array), *fl_array)
-        fh.Write_at(progress * 12, s)
-        fh.Sync()
-
-        progress += count
-
-        print("[Node %d] %-4.2f" % (rank, ((progress - start_end[0]) / (start_end[1] - start_end[0])) * 100.0) +
-              "% complete. Wrote " + humanize.intcomma(count) + " more grid points.", flush=True)
+        values = qa.process(sd_array[0:count], start).astype(np.float32)
+        writing = time.time()
+        if im.format == "hdf5":
+            writer.write({"hdf5": (start, values)}, (start, end))
+        else:
+            writer.write({"awp": (start * 12, values)}, (start, end))
+        timing["write"] += time.time() - writing
 
+        print("[Node %d] Wrote grid points %s to %s (%s so far)." % (
+            rank, humanize.intcomma(start), humanize.intcomma(end - 1), humanize.intcomma(timing["points"] + count)
+        ), flush=True)
+
+    waiting = time.time()
+    writer.close()
     comm.Barrier()
-    fh.Close()
+    timing["idle"] += time.time() - waiting
 
     if rank == 0:
         print("\n[Node " + str(rank) + "] Extraction job fully complete.")
 
-        # print("\n[Node " + str(rank) + "] Expected file size is " + im.get_grid_file_size()["display"] + ". " +
-        #       "Actual size is " + humanize.naturalsize(os.path.getsize(os.path.join(file_out)), gnu=False) + ".",
-        #       flush=True)
-
-        # if im.get_grid_file_size()["real"] == os.path.getsize(file_out):
-        #     print("Generated file size matches the expected file size.")
-        # else:
-        #     print("ERROR! File sizes DO NOT MATCH!")
-
     return True
 
 
-def _mesh_extract_mpi_rwg(sd_array: List[SeismicData], information: dict, im: InternalMesh, start_end: tuple) -> bool:
+def _mesh_extract_mpi_rwg(sd_array: List[SeismicData], information: dict, im: InternalMesh, chunks,
+                          timing: dict, writer: MPIMeshWriter, qa: MeshQA) -> bool:
     """
     Extract a RWG mesh using MPI. Internal method.
 
     Args:
+        sd_array (list): The SeismicData array to use for the queries.
+        information (dict): The mesh information dictionary (from the XML config file).
+        im (InternalMesh): The internal representation of the RWG mesh.
+        chunks: A generator of the (start, end) ranges this rank should extract, timed by _timed_chunks.
+        timing (dict): The dictionary in which to add up this rank's busy, idle, and write time.
+        writer (MPIMeshWriter): The writer for the mesh files, which is closed when the extraction is done.
+        qa (MeshQA): The post-processing stage, which adds up this rank's QA statistics.
 
     Returns:
         True, if successful. Raises an error if not successful.
@@ -181,106 +467,58 @@ def _mesh_extract_mpi_rwg(sd_array: List[SeismicData], information: dict, im: In
     comm = MPI.COMM_WORLD
     rank = comm.Get_rank()
 
-    file_out_vp = os.path.join(information["out_dir"], information["mesh_name"]) + ".rwgvp"
-    file_out_vs = os.path.join(information["out_dir"], information["mesh_name"]) + ".rwgvs"
-    file_out_dn = os.path.join(information["out_dir"], information["mesh_name"]) + ".rwgdn"
-
-    im_iter = RWGInternalMeshIterator(im, start_end[0], start_end[1], len(sd_array), sd_array)
-
-    progress = start_end[0]
-    sqrt2 = math.sqrt(2)
-
-    fh_vp = MPI.File.Open(MPI.COMM_WORLD, file_out_vp, amode=MPI.MODE_WRONLY | MPI.MODE_CREATE)
-    fh_vs = MPI.File.Open(MPI.COMM_WORLD, file_out_vs, amode=MPI.MODE_WRONLY | MPI.MODE_CREATE)
-    fh_dn = MPI.File.Open(MPI.COMM_WORLD, file_out_dn, amode=MPI.MODE_WRONLY | MPI.MODE_CREATE)
-
-    while progress < im_iter.end_point:
+    for start, end in chunks:
+        resize_seismicdata_array(sd_array, end - start)
+        im_iter = RWGInternalMeshIterator(im, start, end, end - start, sd_array)
         count = next(im_iter)
 
         UCVM.query(sd_array[0:count], information["cvm_list"], ["velocity"], None)
 
-        vp_array = []
-        vs_array = []
-        dn_array = []
-        for s in sd_array[0:count]:
-            if s.velocity_properties is not None and s.velocity_properties.vs is not None and \
-               s.velocity_properties.vs < information["minimums"]["vs"]:
-                s.set_velocity_data(
-                    VelocityProperties(
-                        information["minimums"]["vp"], information["minimums"]["vs"],
-                        s.velocity_properties.density, s.velocity_properties.qp,
-                        s.velocity_properties.qs, s.velocity_properties.vp_source,
-                        s.velocity_properties.vs_source, s.velocity_properties.density_source,
-                        s.velocity_properties.qp_source, s.velocity_properties.qs_source
-                    )
-                )
-
-            vp_array.append(s.velocity_properties.vp / 1000)
-            vs_array.append(s.velocity_properties.vs / 1000)
-            dn_array.append(s.velocity_properties.density / 1000)
-
-            if s.velocity_properties is None or s.velocity_properties.vp is None or \
-               s.velocity_properties.vs is None or s.velocity_properties.density is None:
-                print("[Node %d] Attention! %.3f, %.3f, %.3f has no material properties." % (
-                    rank, s.original_point.x_value, s.original_point.y_value, s.original_point.z_value
-                ), flush=True)
-            if s.velocity_properties is not None and s.velocity_properties.vp is not None and \
-               s.velocity_properties.vs is not None and s.velocity_properties.vp / s.velocity_properties.vs < sqrt2:
-                print("[Node %d] Warning: %.3f, %.3f, %.3f has a Vp/Vs ratio of less than sqrt(2)." % (
-                    rank, s.original_point.x_value, s.original_point.y_value, s.original_point.z_value
-                ), flush=True)
-        s = struct.pack('f' * len(vp_array), *vp_array)
-        fh_vp.Write_at(progress * 4, s)
-        fh_vp.Sync()
-        s = struct.pack('f' * len(vs_array), *vs_array)
-        fh_vs.Write_at(progress * 4, s)
-        fh_vs.Sync()
-        s = struct.pack('f' * len(dn_array), *dn_array)
-        fh_dn.Write_at(progress * 4, s)
-        fh_dn.Sync()
-
-        progress += count
-
-        print("[Node %d] %-4.2f" % (rank, ((progress - start_end[0]) / (start_end[1] - start_end[0])) * 100.0) +
-              "% complete. Wrote " + humanize.intcomma(count) + " more grid points.", flush=True)
-
+        values = qa.process(sd_array[0:count], start) / 1000
+        writing = time.time()
+        writer.write({
+            "vp": (start * 4, values[:, 0].astype(np.float32)),
+            "vs": (start * 4, values[:, 1].astype(np.float32)),
+            "dn": (start * 4, values[:, 2].astype(np.float32))
+        }, (start, end))
+        timing["write"] += time.time() - writing
+
+        print("[Node %d] Wrote grid points %s to %s (%s so far)." % (
+            rank, humanize.intcomma(start), humanize.intcomma(end - 1), humanize.intcomma(timing["points"] + count)
+        ), flush=True)
+
+    waiting = time.time()
+    writer.close()
     comm.Barrier()
-
-    fh_vp.Close()
-    fh_vs.Close()
-    fh_dn.Close()
+    timing["idle"] += time.time() - waiting
 
     if rank == 0:
         print("\n[Node " + str(rank) + "] Extraction job fully complete.")
 
-        # print("\n[Node " + str(rank) + "] Expected file size is " + im.get_grid_file_size()["display"] + ". " +
-        #       "Actual size is " + humanize.naturalsize(os.path.getsize(
-        #       os.path.join(information["out_dir"], file_out_vp)), gnu=False) + ".", flush=True)
-
-        # if im.get_grid_file_size()["real"] == \
-        #    os.path.getsize(os.path.join(information["out_dir"], file_out_vp)) and \
-        #    im.get_grid_file_size()["real"] == \
-        #    os.path.getsize(os.path.join(information["out_dir"], file_out_vs)) and \
-        #    im.get_grid_file_size()["real"] == \
-        #    os.path.getsize(os.path.join(information["out_dir"], file_out_dn)):
-        #     print("Generated file size matches the expected file size.")
-        # else:
-        #     print("ERROR! File sizes DO NOT MATCH!")
-
     return True
 
 
-def mesh_extract_single(information: dict, slices: str=None, interval: str=None, **kwargs) -> bool:
+def mesh_extract_single(information: dict, slices: str=None, interval: str=None, qa_indices: bool=False,
+                        memory_budget: int=None, columns: bool=False, **kwargs) -> bool:
     """
     Given a dictionary containing the relevant parameters for the extraction, extract the material
-    properties for a single process.
+    properties for a single process. The number of points queried at once is chosen by a ChunkTuner.
 
     Args:
         information (dict): The dictionary containing the metadata defining the extraction.
+        qa_indices (bool): True to dump the indices of the points counted in the QA report.
+        memory_budget (int): The memory, in bytes, that one chunk may use. By default a third of the
+            available memory.
+        columns (bool): True to query the mesh in blocks of whole columns, so that the work that depends only
+            on the horizontal position is done once per column. See _mesh_extract_single_columns.
 
     Returns:
         True, when successful. It will raise an error if the extraction is not successful.
     """
+    if information.get("blocks") is not None:
+        return all(mesh_extract_single(block_info, None, None, qa_indices, memory_budget, columns, **kwargs)
+                   for block_info in prepare_mesh_blocks(information, slices, interval))
+
     internal_mesh = InternalMesh(information)
 
     if slices is not None:
@@ -288,41 +526,324 @@ def mesh_extract_single(information: dict, slices: str=None, interval: str=None,
     elif interval is not None:
         internal_mesh.do_interval(interval)
 
-    sd_array = UCVM.create_max_seismicdata_array(min(internal_mesh.total_size, 250000), 1)
+    tuner = ChunkTuner(memory_budget, maximum=internal_mesh.total_size)
+    sd_array = []
 
     print("\nThere are a total of " + humanize.intcomma(internal_mesh.total_size) + " grid points "
-          "to extract.\nWe can extract " + humanize.intcomma(len(sd_array)) + " points at once.\n"
-          "\nStarting extraction...\n")
+          "to extract.\nThe first " + humanize.intcomma(tuner.size) + " points measure how many we can "
+          "extract at once.\n\nStarting extraction...\n")
 
     information["minimums"]["vp"] = float(information["minimums"]["vp"])
     information["minimums"]["vs"] = float(information["minimums"]["vs"])
 
+    qa = MeshQA(information["minimums"], qa_indices, information["format"])
+    manifest = MeshManifest(_get_mpi_output_files(information))
+
+    if columns:
+        _mesh_extract_single_columns(sd_array, information, internal_mesh, qa, tuner, slices, interval, manifest)
+    elif internal_mesh.format == "awp":
+        _mesh_extract_single_awp(sd_array, information, internal_mesh, qa, tuner, slices, interval, manifest)
+    elif internal_mesh.format == "rwg":
+        _mesh_extract_single_rwg(sd_array, information, internal_mesh, qa, tuner, manifest)
+    elif internal_mesh.format == "hdf5":
+        _mesh_extract_single_hdf5(sd_array, information, internal_mesh, qa, tuner, slices, interval, manifest)
+
+    _write_qa_report(information, qa)
+    _save_manifest(information, manifest)
+
+    print("\n" + tuner.report())
+
+    print("\nExtraction done.")
+
+    return True
+
+
+def mesh_extract_multiprocess(information: dict, processes: int, slices: str=None, interval: str=None,
+                              qa_indices: bool=False, memory_budget: int=None) -> bool:
+    """
+    Given a dictionary containing the relevant parameters for the extraction, extract the material
+    properties using a pool of local processes. This needs no MPI installation. The models are
+    loaded before the pool is started, so the workers share the loaded model data. The workers
+    take chunks of the mesh as they become free and write them straight into the preallocated
+    output files.
+
+    Args:
+        information (dict): The dictionary containing the metadata defining the extraction.
+        processes (int): The number of worker processes.
+        slices (str): The slices to extract (AWP meshes only), as for mesh_extract_single.
+        interval (str): The interval to extract (AWP meshes only), as for mesh_extract_single.
+        qa_indices (bool): True to dump the indices of the points counted in the QA report.
+        memory_budget (int): The memory, in bytes, that one worker's chunk may use. By default a third of the
+            available memory, split between the workers.
+
+    Returns:
+        True, when successful. It will raise an error if the extraction is not successful.
+    """
+    if information.get("blocks") is not None:
+        return all(mesh_extract_multiprocess(block_info, processes, None, None, qa_indices, memory_budget)
+                   for block_info in prepare_mesh_blocks(information, slices, interval))
+
+    internal_mesh = InternalMesh(information)
+
+    if slices is not None:
+        internal_mesh.do_slices(slices)
+    elif interval is not None:
+        internal_mesh.do_interval(interval)
+
+    information["minimums"]["vp"] = float(information["minimums"]["vp"])
+    information["minimums"]["vs"] = float(information["minimums"]["vs"])
+
+    file_out = os.path.join(information["out_dir"], information["mesh_name"])
+
     if internal_mesh.format == "awp":
-        _mesh_extract_single_awp(sd_array, information, internal_mesh, slices, interval)
+        files = {"awp": file_out + ".awp"}
+        start_point, end_point = _get_extract_range(internal_mesh, slices, interval)
+        iterator = AWPInternalMeshIterator
     elif internal_mesh.format == "rwg":
-        _mesh_extract_single_rwg(sd_array, information, internal_mesh)
+        files = {"vp": file_out + ".rwgvp", "vs": file_out + ".rwgvs", "dn": file_out + ".rwgdn"}
+        start_point, end_point = 0, internal_mesh.total_size
+        iterator = RWGInternalMeshIterator
+    elif internal_mesh.format == "hdf5":
+        # The compressed chunks of an HDF5 mesh cannot be written by several processes at once, so the workers
+        # send their values back and this process writes them.
+        files = {}
+        start_point, end_point = _get_extract_range(internal_mesh, slices, interval)
+        iterator = AWPInternalMeshIterator
+    else:
+        raise ValueError("Invalid mesh format.")
+
+    start_point = int(start_point)
+    end_point = int(end_point)
+
+    # Preallocate the files so that the workers can write their chunks anywhere in them.
+    MeshWriter(files, internal_mesh.get_grid_file_size()["real"], truncate=internal_mesh.format == "rwg").close()
+
+    _load_models(information, internal_mesh, iterator, start_point)
+
+    # The workers' chunks are fixed before the pool starts, so the tuner only gets the warm-up chunk to measure
+    # how much memory each point takes. The warm-up is the first chunk of the mesh, extracted and written here.
+    # Each worker gets several chunks, so that the ones that finish early can take work from the others.
+    tuner = ChunkTuner(memory_budget, processes,
+                       maximum=int(math.ceil((end_point - start_point) / (processes * CHUNKS_PER_PROCESS))))
+    _init_mesh_worker(information, internal_mesh, files, tuner.next_size(), qa_indices)
+    started = time.time()
+    warm_up = _extract_mesh_chunk((start_point, min(start_point + tuner.size, end_point)))
+    tuner.record(warm_up[0], time.time() - started)
+    _close_mesh_worker()
+
+    max_pts = max(1, min(tuner.maximum, tuner.get_memory_limit(), MAX_CHUNK_SIZE))
+    chunks = [(start, min(start + max_pts, end_point))
+              for start in range(start_point + warm_up[0], end_point, max_pts)]
+
+    print("\nThere are a total of " + humanize.intcomma(end_point - start_point) + " grid points "
+          "to extract.\nEach of the " + str(processes) + " processes extracts " + humanize.intcomma(max_pts) +
+          " points at once.\n" + tuner.report() + "\n\nStarting extraction...\n")
+
+    progress = 0
+    qa = MeshQA(information["minimums"], qa_indices, information["format"])
+    manifest = MeshManifest(_get_mpi_output_files(information))
+
+    with multiprocessing.get_context("fork").Pool(
+        processes, initializer=_init_mesh_worker, initargs=(information, internal_mesh, files, max_pts, qa_indices)
+    ) as pool:
+        writer = HDF5MeshWriter(file_out + ".h5", information, manifest) if internal_mesh.format == "hdf5" else None
+        for count, chunk_qa, chunk_manifest, values in itertools.chain(
+            [warm_up], pool.imap_unordered(_extract_mesh_chunk, chunks)
+        ):
+            if writer is not None:
+                writer.write(*values)
+            qa.merge(chunk_qa)
+            manifest.merge(chunk_manifest)
+            progress += count
+            print("%-4.2f" % ((progress / (end_point - start_point)) * 100.0) +
+                  "% complete. Wrote " + humanize.intcomma(count) + " more grid points.", flush=True)
+        if writer is not None:
+            writer.close()
+
+    _write_qa_report(information, qa)
+    _save_manifest(information, manifest)
 
     print("\nExtraction done.")
 
     return True
 
 
-def _mesh_extract_single_awp(sd_array: List[SeismicData], information: dict, im: InternalMesh, slices: str=None,
-                             interval: str=None) -> bool:
+def prepare_mesh_blocks(information: dict, slices: str=None, interval: str=None) -> List[dict]:
     """
-    Takes an InternalMesh object, the mesh information file, and the iterator, and generates, using
-    one core only, the mesh in AWP-ODC format.
+    Splits a discontinuous mesh into its blocks and writes the configuration file of each block, along with the
+    descriptor that lists them, before the blocks are extracted one after the other.
+
+    Args:
+        information (dict): The dictionary containing the metadata defining the extraction.
+        slices (str): Must be None. Slices of one block are extracted from the block's own configuration file.
+        interval (str): Must be None, as for slices.
+
+    Returns:
+        The list of the dictionaries defining each block, from the top down.
+    """
+    if slices is not None or interval is not None:
+        raise ValueError("Slices and intervals cannot be extracted from a mesh with several blocks. Extract them "
+                         "from the configuration file of the block, [mesh_name]_block[n].xml, instead.")
+
+    mesh_blocks = get_mesh_blocks(information)
+    path = write_mesh_blocks(information, mesh_blocks)
+
+    print("\nThe mesh has " + str(len(mesh_blocks)) + " blocks, which are described in " + path + ".")
+
+    return mesh_blocks
+
+
+#: dict: The state of a mesh extraction worker process, set up by _init_mesh_worker.
+_mesh_worker = {}
+
+
+def _init_mesh_worker(information: dict, im: InternalMesh, files: dict, max_pts: int, qa_indices: bool) -> None:
+    """
+    Sets up a mesh extraction worker process. Internal method.
 
     Args:
         information (dict): The mesh information dictionary (from the XML config file).
-        im (InternalMesh): The internal representation of the AWP mesh.
-        im_iter (AWPInternalMeshIterator): The internal mesh iterator that was generated from im.
+        im (InternalMesh): The internal representation of the mesh.
+        files (dict): The preallocated output file paths keyed by name.
+        max_pts (int): The maximum number of points in a chunk.
+        qa_indices (bool): True to keep the indices of the points counted in the QA report.
 
     Returns:
         Nothing
     """
-    file_out = information["mesh_name"] + ".awp"
+    _mesh_worker["qa_indices"] = qa_indices
+    _mesh_worker["information"] = information
+    _mesh_worker["im"] = im
+    _mesh_worker["fds"] = {key: os.open(path, os.O_WRONLY) for key, path in files.items()}
+    _mesh_worker["sd_array"] = [SeismicData() for _ in range(0, max_pts)]
+
+
+def _close_mesh_worker() -> None:
+    """
+    Closes the output files opened by _init_mesh_worker and clears the worker state. Internal method.
+
+    Returns:
+        Nothing
+    """
+    for fd in _mesh_worker.get("fds", {}).values():
+        os.close(fd)
+    _mesh_worker.clear()
+
+
+def _extract_mesh_chunk(chunk: tuple) -> (int, MeshQA, MeshManifest, tuple):
+    """
+    Extracts one chunk of the mesh in a worker process and writes it to the output files. Internal method.
+
+    Args:
+        chunk (tuple): The (start, end) range of points to extract.
+
+    Returns:
+        The number of points extracted, the QA statistics of the chunk, the manifest of what was written, and for
+        HDF5 meshes the (start, values) to be written, and added to the manifest, by the parent process (None
+        otherwise).
+    """
+    information = _mesh_worker["information"]
+    im = _mesh_worker["im"]
+    sd_array = _mesh_worker["sd_array"]
+
+    iterator = RWGInternalMeshIterator if im.format == "rwg" else AWPInternalMeshIterator
+    count = next(iterator(im, chunk[0], chunk[1], len(sd_array), sd_array))
 
+    UCVM.query(sd_array[0:count], information["cvm_list"], ["velocity"])
+
+    qa = MeshQA(information["minimums"], _mesh_worker["qa_indices"], information["format"])
+    values = qa.process(sd_array[0:count], chunk[0])
+
+    manifest = MeshManifest({})
+
+    if im.format == "hdf5":
+        return count, qa, manifest, (chunk[0], values.astype(np.float32))
+    elif im.format == "awp":
+        chunks = {"awp": (chunk[0] * 12, values.astype(np.float32))}
+    else:
+        values /= 1000
+        chunks = {
+            "vp": (chunk[0] * 4, values[:, 0].astype(np.float32)),
+            "vs": (chunk[0] * 4, values[:, 1].astype(np.float32)),
+            "dn": (chunk[0] * 4, values[:, 2].astype(np.float32))
+        }
+
+    for key, (offset, buffer) in chunks.items():
+        manifest.add(key, offset, buffer)
+        view = memoryview(buffer).cast("B")
+        while len(view) > 0:
+            written = os.pwrite(_mesh_worker["fds"][key], view, offset)
+            view = view[written:]
+            offset += written
+
+    return count, qa, manifest, None
+
+
+def _load_models(information: dict, im: InternalMesh, iterator, start_point: int) -> None:
+    """
+    Queries one point so that the models are loaded before the extraction starts. This keeps the time and
+    memory of loading them out of the chunk tuner's warm-up, and lets forked workers share the loaded models.
+
+    Args:
+        information (dict): The mesh information dictionary (from the XML config file).
+        im (InternalMesh): The internal representation of the mesh.
+        iterator: The iterator class for the mesh format.
+        start_point (int): The point to query.
+
+    Returns:
+        Nothing
+    """
+    sd_array = [SeismicData()]
+    next(iterator(im, start_point, start_point + 1, 1, sd_array))
+    UCVM.query(sd_array, information["cvm_list"], ["velocity"])
+
+
+def _write_qa_report(information: dict, qa: MeshQA) -> None:
+    """
+    Prints the QA summary of the extraction and writes the full report to [mesh_name]_qa.txt in the output
+    directory.
+
+    Args:
+        information (dict): The mesh information dictionary (from the XML config file).
+        qa (MeshQA): The QA statistics of the whole extraction.
+
+    Returns:
+        Nothing
+    """
+    path = os.path.join(information["out_dir"], information["mesh_name"] + "_qa.txt")
+    qa.write_report(path)
+    print("\n" + qa.summary() + " The QA report has been written to " + path + ".", flush=True)
+
+
+def _save_manifest(information: dict, manifest: MeshManifest) -> None:
+    """
+    Saves the checksums and statistics of the extraction to [mesh_name]_manifest.json in the output directory,
+    merged with those of any earlier extraction of other parts of the mesh, and prints its summary.
+
+    Args:
+        information (dict): The mesh information dictionary (from the XML config file).
+        manifest (MeshManifest): The checksums and statistics of the chunks written.
+
+    Returns:
+        Nothing
+    """
+    path = get_manifest_path(information)
+    manifest.save(path, information)
+    print(manifest.summary() + " The manifest has been written to " + path + ".", flush=True)
+
+
+def _get_extract_range(im: InternalMesh, slices: str=None, interval: str=None) -> tuple:
+    """
+    Returns the range of points of an AWP mesh covered by the given slices or interval.
+
+    Args:
+        im (InternalMesh): The internal representation of the AWP mesh.
+        slices (str): The slices to extract, like "5" or "1-5".
+        interval (str): The percentage range of the mesh to extract, like "0-10".
+
+    Returns:
+        The (start, end) tuple of points.
+    """
     start_point = 0
     end_point = im.total_size
 
@@ -342,69 +863,122 @@ def _mesh_extract_single_awp(sd_array: List[SeismicData], information: dict, im:
         else:
             raise ValueError("Interval must be a range (e.g. 0-10 which means generate the first 10% of the mesh).")
 
+    return start_point, end_point
+
+
+def _mesh_extract_single_awp(sd_array: List[SeismicData], information: dict, im: InternalMesh, qa: MeshQA,
+                             tuner: ChunkTuner, slices: str=None, interval: str=None,
+                             manifest: MeshManifest=None) -> bool:
+    """
+    Takes an InternalMesh object, the mesh information file, and the iterator, and generates, using
+    one core only, the mesh in AWP-ODC format.
+
+    Args:
+        information (dict): The mesh information dictionary (from the XML config file).
+        im (InternalMesh): The internal representation of the AWP mesh.
+        qa (MeshQA): The post-processing stage, which adds up the QA statistics.
+        tuner (ChunkTuner): The tuner choosing the number of points in each chunk.
+        manifest (MeshManifest): The manifest to record the written chunks in, if any.
+
+    Returns:
+        Nothing
+    """
+    file_out = information["mesh_name"] + ".awp"
+
+    start_point, end_point = _get_extract_range(im, slices, interval)
+
     im_iter = AWPInternalMeshIterator(im, start_point, end_point, len(sd_array), sd_array)
-    progress = start_point
+    start_point = int(start_point)
+
+    _load_models(information, im, AWPInternalMeshIterator, start_point)
 
     progress = 0
-    sqrt2 = math.sqrt(2)
 
-    with open(os.path.join(information["out_dir"], file_out), "ab+") as fd:
+    with MeshWriter({"awp": os.path.join(information["out_dir"], file_out)},
+                    im.get_grid_file_size()["real"], manifest=manifest) as writer:
         while progress < im.total_size:
+            im_iter.num_at_a_time = tuner.next_size()
+            resize_seismicdata_array(sd_array, im_iter.num_at_a_time)
+            started = time.time()
             count = next(im_iter)
 
             UCVM.query(sd_array[0:count], information["cvm_list"], ["velocity"])
 
-            fl_array = []
-            for s in sd_array[0:count]:
-                if s.velocity_properties is not None and s.velocity_properties.vs is not None and \
-                   s.velocity_properties.vs < information["minimums"]["vs"]:
-                    s.set_velocity_data(
-                        VelocityProperties(
-                            information["minimums"]["vp"], information["minimums"]["vs"],
-                            s.velocity_properties.density, s.velocity_properties.qp,
-                            s.velocity_properties.qs, s.velocity_properties.vp_source,
-                            s.velocity_properties.vs_source, s.velocity_properties.density_source,
-                            s.velocity_properties.qp_source, s.velocity_properties.qs_source
-                        )
-                    )
-
-                fl_array.append(s.velocity_properties.vp)
-                fl_array.append(s.velocity_properties.vs)
-                fl_array.append(s.velocity_properties.density)
-
-                if s.velocity_properties is None or s.velocity_properties.vp is None or \
-                   s.velocity_properties.vs is None or s.velocity_properties.density is None:
-                    print("Attention! %.3f, %.3f, %.3f has no material properties." % (
-                        s.original_point.x_value, s.original_point.y_value, s.original_point.z_value
-                    ))
-                if s.velocity_properties is not None and s.velocity_properties.vp is not None and \
-                   s.velocity_properties.vs is not None and s.velocity_properties.vp / s.velocity_properties.vs < sqrt2:
-                    print("Warning: %.3f, %.3f, %.3f has a Vp/Vs ratio of less than sqrt(2)." % (
-                        s.original_point.x_value, s.original_point.y_value, s.original_point.z_value
-                    ))
-            s = struct.pack('f' * len(fl_array), *fl_array)
-            fd.seek(progress * 12)
-            fd.write(s)
+            values = qa.process(sd_array[0:count], start_point + progress)
+            writer.write("awp", (start_point + progress) * 12, values.astype(np.float32))
+            tuner.record(count, time.time() - started)
 
             progress += count
 
             print("%-4.2f" % ((progress / (im_iter.end_point - start_point)) * 100.0) +
-                  "% complete. Wrote " + humanize.intcomma(count) + " more grid points.")
+                  "% complete. Queued " + humanize.intcomma(count) + " more grid points.")
 
-        print("\nExpected file size is " + im.get_grid_file_size()["display"] + ". " +
-              "Actual size is " + humanize.naturalsize(os.path.getsize(
-              os.path.join(information["out_dir"], file_out)), gnu=False) + ".")
+    print("\nExpected file size is " + im.get_grid_file_size()["display"] + ". " +
+          "Actual size is " + humanize.naturalsize(os.path.getsize(
+          os.path.join(information["out_dir"], file_out)), gnu=False) + ".")
 
-        if im.get_grid_file_size()["real"] == \
-           os.path.getsize(os.path.join(information["out_dir"], file_out)):
-            print("Generated file size matches the expected file size.")
-        else:
-            print("ERROR! File sizes DO NOT MATCH!")
+    if im.get_grid_file_size()["real"] == \
+       os.path.getsize(os.path.join(information["out_dir"], file_out)):
+        print("Generated file size matches the expected file size.")
+    else:
+        print("ERROR! File sizes DO NOT MATCH!")
 
     return True
 
 
-def _mesh_extract_single_rwg(sd_array: List[SeismicData], information: dict, im: InternalMesh) -> bool:
+def _mesh_extract_single_hdf5(sd_array: List[SeismicData], information: dict, im: InternalMesh, qa: MeshQA,
+                              tuner: ChunkTuner, slices: str=None, interval: str=None,
+                              manifest: MeshManifest=None) -> bool:
+    """
+    Takes an InternalMesh object, the mesh information file, and the iterator, and generates, using
+    one core only, the mesh in compressed HDF5 format.
+
+    Args:
+        information (dict): The mesh information dictionary (from the XML config file).
+        im (InternalMesh): The internal representation of the HDF5 mesh.
+        qa (MeshQA): The post-processing stage, which adds up the QA statistics.
+        tuner (ChunkTuner): The tuner choosing the number of points in each chunk.
+        manifest (MeshManifest): The manifest to record the written chunks in, if any.
+
+    Returns:
+        Nothing
+    """
+    file_out = os.path.join(information["out_dir"], information["mesh_name"] + ".h5")
+
+    start_point, end_point = _get_extract_range(im, slices, interval)
+
+    im_iter = AWPInternalMeshIterator(im, start_point, end_point, len(sd_array), sd_array)
+    start_point = int(start_point)
+
+    _load_models(information, im, AWPInternalMeshIterator, start_point)
+
+    progress = 0
+
+    with HDF5MeshWriter(file_out, information, manifest) as writer:
+        while progress < im.total_size:
+            im_iter.num_at_a_time = tuner.next_size()
+            resize_seismicdata_array(sd_array, im_iter.num_at_a_time)
+            started = time.time()
+            count = next(im_iter)
+
+            UCVM.query(sd_array[0:count], information["cvm_list"], ["velocity"])
+
+            writer.write(start_point + progress, qa.process(sd_array[0:count], start_point + progress))
+            tuner.record(count, time.time() - started)
+
+            progress += count
+
+            print("%-4.2f" % ((progress / (im_iter.end_point - start_point)) * 100.0) +
+                  "% complete. Queued " + humanize.intcomma(count) + " more grid points.")
+
+    print("\nUncompressed size is " + im.get_grid_file_size()["display"] + ". " +
+          "Compressed size is " + humanize.naturalsize(os.path.getsize(file_out), gnu=False) + ".")
+
+    return True
+
+
+def _mesh_extract_single_rwg(sd_array: List[SeismicData], information: dict, im: InternalMesh, qa: MeshQA,
+                             tuner: ChunkTuner, manifest: MeshManifest=None) -> bool:
     """
     Takes an InternalMesh object, the mesh information file, and the iterator, and generates, using
     one core only, the mesh in RWG format.
@@ -412,6 +986,9 @@ def _mesh_extract_single_rwg(sd_array: List[SeismicData], information: dict, im:
     Args:
         information (dict): The mesh information dictionary (from the XML config file).
         im (InternalMesh): The internal representation of the RWG mesh.
+        qa (MeshQA): The post-processing stage, which adds up the QA statistics.
+        tuner (ChunkTuner): The tuner choosing the number of points in each chunk.
+        manifest (MeshManifest): The manifest to record the written chunks in, if any.
 
     Returns:
         Nothing
@@ -422,69 +999,136 @@ def _mesh_extract_single_rwg(sd_array: List[SeismicData], information: dict, im:
 
     im_iter = RWGInternalMeshIterator(im, 0, im.total_size, len(sd_array), sd_array)
 
+    _load_models(information, im, RWGInternalMeshIterator, 0)
+
     progress = 0
 
-    with open(os.path.join(information["out_dir"], file_out_vp), "wb") as fd_vp, \
-         open(os.path.join(information["out_dir"], file_out_vs), "wb") as fd_vs, \
-         open(os.path.join(information["out_dir"], file_out_dn), "wb") as fd_dn:
+    with MeshWriter({"vp": os.path.join(information["out_dir"], file_out_vp),
+                     "vs": os.path.join(information["out_dir"], file_out_vs),
+                     "dn": os.path.join(information["out_dir"], file_out_dn)},
+                    im.get_grid_file_size()["real"], truncate=True, manifest=manifest) as writer:
         while progress < im_iter.end_point:
+            im_iter.num_at_a_time = tuner.next_size()
+            resize_seismicdata_array(sd_array, im_iter.num_at_a_time)
+            started = time.time()
             count = next(im_iter)
-            progress += count
 
             UCVM.query(sd_array[0:count], information["cvm_list"], ["velocity"], None)
 
-            vp_array = []
-            vs_array = []
-            dn_array = []
-            for s in sd_array[0:count]:
-                if s.velocity_properties is not None and s.velocity_properties.vs is not None and \
-                   s.velocity_properties.vs < information["minimums"]["vs"]:
-                    s.set_velocity_data(
-                        VelocityProperties(
-                            information["minimums"]["vp"], information["minimums"]["vs"],
-                            s.velocity_properties.density, s.velocity_properties.qp,
-                            s.velocity_properties.qs, s.velocity_properties.vp_source,
-                            s.velocity_properties.vs_source, s.velocity_properties.density_source,
-                            s.velocity_properties.qp_source, s.velocity_properties.qs_source
-                        )
-                    )
-
-                vp_array.append(s.velocity_properties.vp / 1000)
-                vs_array.append(s.velocity_properties.vs / 1000)
-                dn_array.append(s.velocity_properties.density / 1000)
-
-                if s.velocity_properties.vp is None:
-                    print("Attention! %.3f, %.3f, %.3f has no material properties." % (
-                        s.original_point.x_value, s.original_point.y_value, s.original_point.z_value
-                    ))
-                if s.velocity_properties is not None and s.velocity_properties.vp is not None and \
-                   s.velocity_properties.vs is not None and s.velocity_properties.vp / s.velocity_properties.vs < 1.45:
-                    print("Warning: %.3f, %.3f, %.3f has a Vp/Vs ratio of less than 1.45." % (
-                        s.original_point.x_value, s.original_point.y_value, s.original_point.z_value
-                    ))
-            s = struct.pack('f' * len(vp_array), *vp_array)
-            fd_vp.write(s)
-            s = struct.pack('f' * len(vs_array), *vs_array)
-            fd_vs.write(s)
-            s = struct.pack('f' * len(dn_array), *dn_array)
-            fd_dn.write(s)
+            values = qa.process(sd_array[0:count], progress) / 1000
+            writer.write("vp", progress * 4, values[:, 0].astype(np.float32))
+            writer.write("vs", progress * 4, values[:, 1].astype(np.float32))
+            writer.write("dn", progress * 4, values[:, 2].astype(np.float32))
+            tuner.record(count, time.time() - started)
+
+            progress += count
 
             print("%-4.2f" % ((progress / im_iter.end_point) * 100.0) +
-                  "% complete. Wrote " + humanize.intcomma(count) + " more grid points.")
-
-        print("\nExpected file size is " + im.get_grid_file_size()["display"] + ". " +
-              "Actual size is " + humanize.naturalsize(os.path.getsize(
-              os.path.join(information["out_dir"], file_out_vp)), gnu=False) + ".")
-
-        if im.get_grid_file_size()["real"] == \
-           os.path.getsize(os.path.join(information["out_dir"], file_out_vp)) and \
-           im.get_grid_file_size()["real"] == \
-           os.path.getsize(os.path.join(information["out_dir"], file_out_vs)) and \
-           im.get_grid_file_size()["real"] == \
-           os.path.getsize(os.path.join(information["out_dir"], file_out_dn)):
-            print("Generated file size matches the expected file size.")
-        else:
-            print("ERROR! File sizes DO NOT MATCH!")
+                  "% complete. Queued " + humanize.intcomma(count) + " more grid points.")
+
+    print("\nExpected file size is " + im.get_grid_file_size()["display"] + ". " +
+          "Actual size is " + humanize.naturalsize(os.path.getsize(
+          os.path.join(information["out_dir"], file_out_vp)), gnu=False) + ".")
+
+    if im.get_grid_file_size()["real"] == \
+       os.path.getsize(os.path.join(information["out_dir"], file_out_vp)) and \
+       im.get_grid_file_size()["real"] == \
+       os.path.getsize(os.path.join(information["out_dir"], file_out_vs)) and \
+       im.get_grid_file_size()["real"] == \
+       os.path.getsize(os.path.join(information["out_dir"], file_out_dn)):
+        print("Generated file size matches the expected file size.")
+    else:
+        print("ERROR! File sizes DO NOT MATCH!")
+
+    return True
+
+
+def _mesh_extract_single_columns(sd_array: List[SeismicData], information: dict, im: InternalMesh, qa: MeshQA,
+                                 tuner: ChunkTuner, slices: str=None, interval: str=None,
+                                 manifest: MeshManifest=None) -> bool:
+    """
+    Generates a mesh of any format using one core, querying it in blocks of whole (x, y) columns rather than
+    slice by slice. The projection of each column is done once, and the models only project, and look up the
+    elevation and Vs30 of, each column once. Each block is transposed in memory into the order of the output
+    file and written as one contiguous run per slice (AWP and HDF5) or per row (RWG).
+
+    Args:
+        information (dict): The mesh information dictionary (from the XML config file).
+        im (InternalMesh): The internal representation of the mesh.
+        qa (MeshQA): The post-processing stage, which adds up the QA statistics.
+        tuner (ChunkTuner): The tuner choosing the number of points in each chunk.
+        slices (str): The slices to extract (AWP and HDF5 meshes only).
+        interval (str): Not supported, as intervals do not cover whole columns.
+        manifest (MeshManifest): The manifest to record the written chunks in, if any.
+
+    Returns:
+        Nothing
+    """
+    if interval is not None or (slices is not None and im.format == "rwg"):
+        raise ValueError("Column-ordered extraction works on whole columns, so it cannot extract intervals, or "
+                         "slices of RWG meshes.")
+
+    if im.format == "rwg":
+        z_start, z_end = 0, im.num_z
+    else:
+        start_point, end_point = _get_extract_range(im, slices)
+        z_start, z_end = int(start_point) // im.slice_size, int(end_point) // im.slice_size
+    column_length = z_end - z_start
+    total = im.num_x * im.num_y * column_length
+
+    file_out = os.path.join(information["out_dir"], information["mesh_name"])
+    if im.format == "hdf5":
+        writer = HDF5MeshWriter(file_out + ".h5", information, manifest)
+    elif im.format == "rwg":
+        writer = MeshWriter({"vp": file_out + ".rwgvp", "vs": file_out + ".rwgvs", "dn": file_out + ".rwgdn"},
+                            im.get_grid_file_size()["real"], truncate=True, manifest=manifest)
+    else:
+        writer = MeshWriter({"awp": file_out + ".awp"}, im.get_grid_file_size()["real"], manifest=manifest)
+
+    im_iter = ColumnInternalMeshIterator(im, z_start, z_end, len(sd_array), sd_array)
+
+    _load_models(information, im, ColumnInternalMeshIterator, z_start)
+
+    progress = 0
+
+    with writer:
+        while progress < total:
+            im_iter.num_at_a_time = max(tuner.next_size(), column_length)
+            resize_seismicdata_array(sd_array, im_iter.num_at_a_time)
+            started = time.time()
+            count = next(im_iter)
+            y_start, y_end, x_start, x_end = im_iter.block
+
+            UCVM.query(sd_array[0:count], information["cvm_list"], ["velocity"])
+
+            values = qa.process(sd_array[0:count], 0, im_iter.get_indices() if qa.keep_indices else None)
+            values = values.reshape((y_end - y_start, x_end - x_start, column_length, 3))
+
+            if im.format == "rwg":
+                # (y, x, z) to (y, z, x). A block of whole rows is one run of each file.
+                values = values.transpose(0, 2, 1, 3) / 1000
+                runs = [(y_start * im.num_z * im.num_x, values)] if x_end - x_start == im.num_x else \
+                    [(y_start * im.num_z * im.num_x + z_val * im.num_x + x_start, values[:, z_val])
+                     for z_val in range(im.num_z)]
+                for start, run in runs:
+                    for index, key in enumerate(("vp", "vs", "dn")):
+                        writer.write(key, start * 4, np.ascontiguousarray(run[..., index], dtype=np.float32))
+            else:
+                # (y, x, z) to (z, y, x), then one run per slice.
+                values = values.transpose(2, 0, 1, 3)
+                for z_val in range(column_length):
+                    start = (z_start + z_val) * im.slice_size + y_start * im.num_x + x_start
+                    if im.format == "hdf5":
+                        writer.write(start, values[z_val].reshape(-1, 3))
+                    else:
+                        writer.write("awp", start * 12, np.ascontiguousarray(values[z_val], dtype=np.float32))
+
+            tuner.record(count, time.time() - started)
+
+            progress += count
+
+            print("%-4.2f" % ((progress / total) * 100.0) + "% complete. Queued " + humanize.intcomma(count) +
+                  " more grid points.")
 
     return True
 
@@ -646,7 +1290,7 @@ def ask_questions() -> dict:
 
     answers["format"] = ask_and_validate(
         "\nIn which format would you like this mesh? Type 'awp' for AWP-ODC, 'rwg' for a Graves'\n"
-        "format mesh:", is_acceptable_value, allowed=["awp", "rwg"]
+        "format mesh, or 'hdf5' for a compressed HDF5 mesh:", is_acceptable_value, allowed=["awp", "rwg", "hdf5"]
     )
     answers["out_dir"] = ask_and_validate("To which directory should the mesh and metadata be "
                                           "saved?")
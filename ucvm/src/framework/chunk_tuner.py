@@ -0,0 +1,240 @@
+"""
+Chunk size auto-tuner.
+
+Queries and extractions work through their points in chunks. A chunk that is too large runs a
+shared node out of memory and one that is too small wastes time on per-query overhead, and
+neither can be known ahead of time since both depend on the models being queried. The tuner in
+this file measures the memory each point really takes and the throughput of the query during a
+short warm-up, then keeps adjusting the chunk size as the run goes on, within a memory budget.
+
+Copyright 2017 Southern California Earthquake Center
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# Python Imports
+import math
+import tracemalloc
+from typing import List
+
+# Package Imports
+import humanize
+import psutil
+
+# UCVM Imports
+from ucvm.src.shared.properties import SeismicData, Point, VelocityProperties, ElevationProperties, \
+    Vs30Properties, ZProperties
+
+MAX_PERCENT_FREE = 0.33         #: float: Share of the available memory used when no budget is given.
+WARM_UP_POINTS = 10000          #: int: The number of points in the warm-up chunk.
+MIN_CHUNK_SIZE = 1000           #: int: The smallest chunk the tuner will choose.
+MAX_CHUNK_SIZE = 4000000        #: int: The largest chunk the tuner will choose.
+THROUGHPUT_GAIN = 1.05          #: float: How much faster a larger chunk must be for the tuner to keep growing.
+
+
+class ChunkTuner:
+    """
+    Chooses chunk sizes for a run. Call next_size before each chunk and record after it with the number of points
+    and the time the chunk took. The first chunk is the warm-up, during which the memory per point is measured.
+    Tracing the memory slows the query down several times, so the warm-up's throughput is not used: the next
+    chunk sets the baseline. After that the chunk size doubles for as long as the throughput keeps improving and
+    the chunk fits in the budget, and halves if the machine runs short of memory. Every decision is kept for the
+    report.
+    """
+
+    def __init__(self, memory_budget: int=None, processes: int=1, maximum: int=MAX_CHUNK_SIZE):
+        """
+        Sets up the tuner.
+
+        Args:
+            memory_budget (int): The memory, in bytes, that one chunk may use. By default a share of the
+                available memory, split between the processes.
+            processes (int): The number of processes sharing the machine's memory, when there is no budget.
+            maximum (int): The largest chunk size to choose, e.g. the number of points left to extract.
+        """
+        if memory_budget is None:
+            memory_budget = int(psutil.virtual_memory().available * MAX_PERCENT_FREE / processes)
+
+        self.memory_budget = memory_budget
+        self.maximum = max(1, maximum)
+        self.size = min(WARM_UP_POINTS, self.maximum)
+        self.bytes_per_point = None
+        self.best_throughput = 0.0
+        self.growing = True
+        self.decisions = []
+        self._warm_up_rss = None
+
+    def next_size(self) -> int:
+        """
+        Returns the size of the next chunk. Before the warm-up chunk, this starts measuring memory.
+
+        Returns:
+            The number of points to put in the next chunk.
+        """
+        if self.bytes_per_point is None and self._warm_up_rss is None:
+            tracemalloc.start()
+            self._warm_up_rss = psutil.Process().memory_info().rss
+
+        return self.size
+
+    def record(self, count: int, seconds: float) -> None:
+        """
+        Records how long a chunk took and picks the size of the next one.
+
+        Args:
+            count (int): The number of points in the chunk.
+            seconds (float): The time the chunk took.
+
+        Returns:
+            Nothing
+        """
+        if count == 0:
+            return
+
+        throughput = count / max(seconds, 1e-9)
+
+        if self.bytes_per_point is None:
+            _, peak = tracemalloc.get_traced_memory()
+            # The traces themselves take memory too, which must not be counted against the points.
+            rss_growth = psutil.Process().memory_info().rss - self._warm_up_rss - tracemalloc.get_tracemalloc_memory()
+            tracemalloc.stop()
+            self.bytes_per_point = max(peak, rss_growth, 1) / count
+            self._decide(self.size * 2, "warm-up measured %s per point" %
+                         humanize.naturalsize(self.bytes_per_point, gnu=True))
+            return
+
+        available = psutil.virtual_memory().available
+        if available < 2 * self.size * self.bytes_per_point:
+            self.growing = False
+            self._decide(self.size // 2, "only %s of memory is available" % humanize.naturalsize(available, gnu=True))
+        elif self.growing and self.best_throughput == 0:
+            self.best_throughput = throughput
+            self._decide(self.size * 2, "first chunk after the warm-up ran at %s points per second" %
+                         humanize.intcomma(int(throughput)))
+        elif self.growing:
+            if throughput > self.best_throughput * THROUGHPUT_GAIN:
+                self.best_throughput = throughput
+                self._decide(self.size * 2, "throughput rose to %s points per second" %
+                             humanize.intcomma(int(throughput)))
+            else:
+                self.growing = False
+                self.decisions.append((self.size, "throughput stopped improving at %s points per second" %
+                                       humanize.intcomma(int(throughput))))
+
+    def get_memory_limit(self) -> int:
+        """
+        Returns the largest chunk that fits in the memory budget, based on the measured memory per point.
+
+        Returns:
+            The number of points, or the maximum chunk size if nothing has been measured yet.
+        """
+        if self.bytes_per_point is None:
+            return self.maximum
+        return max(MIN_CHUNK_SIZE, int(self.memory_budget / self.bytes_per_point))
+
+    def report(self) -> str:
+        """
+        Returns the list of decisions the tuner made, for printing.
+
+        Returns:
+            The report as a string.
+        """
+        return "Chunk size decisions (memory budget %s):\n" % humanize.naturalsize(self.memory_budget, gnu=True) + \
+               "\n".join("    %s points: %s." % (humanize.intcomma(size), reason) for size, reason in self.decisions)
+
+    def _decide(self, size: int, reason: str) -> None:
+        """
+        Sets the next chunk size, keeping it within the limits and the memory budget, and records the decision.
+
+        Args:
+            size (int): The desired size.
+            reason (str): Why the size was chosen.
+
+        Returns:
+            Nothing
+        """
+        limit = min(self.maximum, MAX_CHUNK_SIZE, self.get_memory_limit())
+        new_size = max(min(MIN_CHUNK_SIZE, self.maximum), min(size, limit))
+
+        if new_size == limit and size > limit:
+            self.growing = False
+            reason += ", limited by the memory budget" if limit == self.get_memory_limit() else ", at the maximum"
+
+        if new_size != self.size or len(self.decisions) == 0:
+            self.decisions.append((new_size, reason))
+        self.size = new_size
+
+
+def resize_seismicdata_array(sd_array: List[SeismicData], size: int) -> List[SeismicData]:
+    """
+    Makes sure that a SeismicData array has at least size entries, growing it in place. The array is only
+    shrunk when it holds more than twice the entries needed, so that chunks of slightly different sizes reuse it.
+
+    Args:
+        sd_array (list): The SeismicData array.
+        size (int): The number of entries needed.
+
+    Returns:
+        The same array.
+    """
+    if len(sd_array) < size:
+        sd_array.extend(SeismicData() for _ in range(size - len(sd_array)))
+    elif len(sd_array) > 2 * size:
+        del sd_array[size:]
+    return sd_array
+
+
+def get_seismicdata_size() -> int:
+    """
+    Measures the memory taken by one SeismicData object once a query has filled it in, once per process. An empty
+    object takes less than half of that.
+
+    Returns:
+        The size in bytes.
+    """
+    if get_seismicdata_size.size is None:
+        was_tracing = tracemalloc.is_tracing()
+        if not was_tracing:
+            tracemalloc.start()
+        before, _ = tracemalloc.get_traced_memory()
+        sample = [_get_queried_seismicdata(i) for i in range(1000)]
+        after, _ = tracemalloc.get_traced_memory()
+        if not was_tracing:
+            tracemalloc.stop()
+        get_seismicdata_size.size = max(1, math.ceil((after - before) / len(sample)))
+    return get_seismicdata_size.size
+
+
+get_seismicdata_size.size = None
+
+
+def _get_queried_seismicdata(index: int) -> SeismicData:
+    """
+    Returns a SeismicData object filled in as a query fills it in, with a converted point and velocity, elevation,
+    Vs30, and Z properties. Internal method.
+
+    Args:
+        index (int): Makes the values of this object distinct from those of the others.
+
+    Returns:
+        The SeismicData object.
+    """
+    value = index + 0.5
+    datum = SeismicData(Point(value, value, value))
+    datum.converted_point = Point(value + 1, value + 1, value)
+    datum.set_velocity_data(VelocityProperties(value + 1, value + 2, value + 3, value + 4, value + 5,
+                                               "model", "model", "model", "model", "model"))
+    datum.set_elevation_data(ElevationProperties(value + 6, "model"))
+    datum.set_vs30_data(Vs30Properties(value + 7, "model"))
+    datum.set_z_data(ZProperties(value + 8, value + 9))
+    datum.set_model_string("model")
+    return datum
@@ -19,159 +19,467 @@ limitations under the License.
 """
 # Python Imports
 import os
+import re
 import sys
 import math
-import copy
+import multiprocessing
+import queue
+import threading
+from collections import deque
 from datetime import datetime
 from typing import List
 
 # Package Imports
+import numpy as np
 import xmltodict
 
 # UCVM Imports
 from ucvm.src.framework.ucvm import UCVM
-from ucvm.src.shared.properties import SeismicData
+from ucvm.src.shared.properties import SeismicData, Point
 from ucvm.src.shared.functions import ask_and_validate, is_number
+from ucvm.src.framework.journal import ExtractionJournal
 from ucvm_c_common import UCVMCCommon
 
+CHECKPOINT_COLUMNS = 32     #: int: Columns written between MPI e-tree checkpoints (flush and journal update).
+ETREE_BUFFER_SIZE = 256     #: int: The default page buffer size, in MB, of the e-tree being written.
+MAX_POINTS = 250000         #: int: The most octants a worker sends to be inserted at once.
+OCTANT_BUFFER_SIZE = 2000000    #: int: The octants held and sorted into Morton order before they are inserted.
+COLUMNS_PER_REQUEST = 4     #: int: The most columns handed to an MPI worker at once.
+WRITE_QUEUE_SIZE = 8        #: int: The batches of octants that may wait for the MPI e-tree writer thread.
+CONTROL_TAG = 1             #: int: The MPI tag of the messages that workers send to the first node.
+WORK_TAG = 2                #: int: The MPI tag of the columns that the first node hands out.
+DATA_TAG = 3                #: int: The MPI tag of the octant arrays that follow a worker's message.
 
-def etree_extract_mpi(information: dict, rows: str=None, interval: str=None) -> bool:
+
+def etree_extract_mpi(information: dict, rows: str=None, interval: str=None, resume: bool=False,
+                      buffer_size: int=ETREE_BUFFER_SIZE, columns_per_request: int=COLUMNS_PER_REQUEST,
+                      writers: int=1, scratch: str=None) -> bool:
+    """
+    Extracts the e-tree with MPI. The first node hands out columns, a few at a time, and inserts the octants
+    that the other nodes send back. The octants are sent as NumPy arrays rather than pickled, and are inserted
+    by a writer thread, so that the first node keeps handing out work while the e-tree is written. The other
+    nodes send their octants without waiting, and carry on with the next column.
+
+    With more than one writer, the nodes are split into that many groups, each of which extracts its own share
+    of the columns into its own sub-e-tree, with its own journal, exactly as above. Unless the sub-e-trees are
+    written to a scratch directory, the first node then merges them into the e-tree with etree_merge. Otherwise
+    they are left for ucvm_etree_merge.
+
+    Args:
+        information (dict): The XML description of the desired e-tree as a dictionary.
+        rows (str): The rows to extract, as for etree_extract_single.
+        interval (str): The interval to extract, as for etree_extract_single.
+        resume (bool): True to skip the columns that the journal records as complete.
+        buffer_size (int): The page buffer size, in MB, of the e-tree being written.
+        columns_per_request (int): The most columns handed to a node at once. Fewer are handed out towards the
+            end, so that the nodes finish together.
+        writers (int): The number of groups of nodes, each with its own writer and sub-e-tree. Each group needs
+            at least two nodes.
+        scratch (str): The directory, which may be local to each node, to write the sub-e-trees to. By default
+            they are written to the output directory and merged once they are complete.
+
+    Returns:
+        True, when successful. Raises an error if not.
+    """
     from mpi4py import MPI
 
-    comm = MPI.COMM_WORLD
-    rank = comm.Get_rank()
+    world = MPI.COMM_WORLD
+    rank = world.Get_rank()
+
+    if writers > 1 and world.Get_size() < 2 * writers:
+        raise ValueError("Each of the %d writers needs at least one other node to extract the e-tree." % writers)
+
+    # The nodes are split into groups of neighbouring ranks, which are likely to share a machine.
+    group = rank * writers // world.Get_size() if writers > 1 else None
+    comm = world.Split(group, rank) if writers > 1 else world
     size = comm.Get_size()
 
     stats = _calculate_etree_stats(
         information, int(information["properties"]["columns"]), int(information["properties"]["rows"])
     )
 
-    start_rc = [1, 1]
-    end_rc = [int(information["properties"]["rows"]), int(information["properties"]["columns"])]
+    start_rc, end_rc = _get_start_end_rc(information, rows, interval)
 
-    if rows is not None:
-        if "-" in rows:
-            parts = rows.split("-")
-            start_rc = [int(parts[0]), 1]
-            end_rc = [int(parts[1]), int(information["properties"]["columns"])]
+    if comm.Get_rank() == 0:
+        if group is None:
+            path = (os.path.join(information["out_dir"], information["etree_name"] + ".e")).encode("ASCII")
+            journal_path = os.path.join(information["out_dir"], information["etree_name"] + ".journal")
         else:
-            start_rc = [int(rows), 1]
-            end_rc = [int(rows), int(information["properties"]["columns"])]
-    elif interval is not None:
-        if "-" in interval:
-            parts = interval.split("-")
-            parts1 = parts[0].split(",")
-            start_rc = [int(parts1[0]), int(parts1[1])]
-            parts2 = parts[1].split(",")
-            end_rc = [int(parts2[0]), int(parts2[1])]
+            if scratch is not None:
+                os.makedirs(scratch, exist_ok=True)
+            subetree = _get_subetree_path(information, group, scratch)
+            path = subetree.encode("ASCII")
+            journal_path = os.path.splitext(subetree)[0] + ".journal"
+            print("[Node %d] Writing sub-e-tree %d to %s." % (rank, group, subetree), flush=True)
+
+        # Columns are only recorded in the journal once the e-tree has been closed, and so flushed, after they
+        # were inserted.
+        journal = ExtractionJournal(journal_path, information)
+        if resume:
+            completed = set((row, col) for row, col, _ in journal.load())
+            print("[Node %d] Resuming. %d columns were already extracted." % (rank, len(completed)), flush=True)
         else:
-            interval = interval.split(",")
-            start_rc = [int(interval[0]), int(interval[1])]
-            end_rc = [int(interval[0]), int(interval[1])]
+            journal.start()
+            completed = set()
+
+        # A sub-e-tree may not exist yet when only some rows are extracted, as the columns are shared out anew.
+        create = start_rc[0] == 1 and start_rc[1] == 1
+        if resume or (group is not None and not create):
+            create = not os.path.exists(path)
+
+        writer = EtreeWriter(path, create, buffer_size, journal)
+
+        columns = _get_columns(information, start_rc, end_rc)
+        if group is not None:
+            columns = columns[group * len(columns) // writers:(group + 1) * len(columns) // writers]
+        rcs_to_extract = deque(rc for rc in columns if rc not in completed)
+        workers = size - 1
+        status = MPI.Status()
+
+        while workers > 0:
+            message = comm.recv(source=MPI.ANY_SOURCE, tag=CONTROL_TAG, status=status)
+            source = status.Get_source()
+
+            if message["code"] in ("start", "new"):
+                # Hand out the next columns before receiving the octants, so the node can start on them at once.
+                count = max(1, min(columns_per_request, len(rcs_to_extract) // (size - 1)))
+                columns = [rcs_to_extract.popleft() for _ in range(min(count, len(rcs_to_extract)))]
+                comm.send(columns if len(columns) > 0 else "done", dest=source, tag=WORK_TAG)
+                if len(columns) == 0:
+                    workers -= 1
+
+            if message["count"] > 0:
+                props = np.empty((message["count"], 3), dtype=np.float32)
+                etree_pnts = np.empty((message["count"], 4), dtype=np.int64)
+                comm.Recv(props, source=source, tag=DATA_TAG)
+                comm.Recv(etree_pnts, source=source, tag=DATA_TAG)
+                writer.write(props, etree_pnts, message["count"], message["columns"])
+            elif message["code"] == "new":
+                writer.write(None, None, 0, message["columns"])
+
+        total_extracted = writer.close(_get_metadata_string(information, stats))
 
-    if rank == 0:
-        schema = "float Vp; float Vs; float density;".encode("ASCII")
-        path = (os.path.join(information["out_dir"], information["etree_name"] + ".e")).encode("ASCII")
+        print("[Node %d] Total number of octants extracted: %d." % (rank, total_extracted), flush=True)
+    else:
+        print("[Node %d] Maximum points per section is %d." % (rank, stats["max_points"]), flush=True)
+        sd_array = UCVM.create_max_seismicdata_array(stats["max_points"], 1)
+        sender = OctantSender(comm)
+        count = 0
 
-        if sys.byteorder == "little" and sys.platform != "darwin":
-            if start_rc[0] == 1 and start_rc[1] == 1:
-                ep = UCVMCCommon.c_etree_open(path, 578)
-            else:
-                ep = UCVMCCommon.c_etree_open(path, 2)
-        else:
-            if start_rc[0] == 1 and start_rc[1] == 1:
-                ep = UCVMCCommon.c_etree_open(path, 1538)
-            else:
-                ep = UCVMCCommon.c_etree_open(path, 2)
+        comm.send({"code": "start", "count": 0, "columns": []}, dest=0, tag=CONTROL_TAG)
 
-        UCVMCCommon.c_etree_registerschema(ep, schema)
+        while True:
+            columns = comm.recv(source=0, tag=WORK_TAG)
 
-        rcs_to_extract = []
+            if columns == "done":
+                break
 
-        current_rc = start_rc
-        while not (current_rc[0] == end_rc[0] and current_rc[1] == end_rc[1] + 1):
-            if current_rc[1] > int(information["properties"]["columns"]):
-                current_rc[0] += 1
-                current_rc[1] = 1
-            rcs_to_extract.append((current_rc[0], current_rc[1]))
-            current_rc[1] += 1
+            finished = []
+            for row_col in columns:
+                print("[Node %d] Received instruction to extract column (%d, %d)." % (rank, row_col[0], row_col[1]),
+                      flush=True)
+                extracted = _extract_mpi(rank, sd_array, information, stats, row_col[1] - 1, row_col[0] - 1,
+                                         sender.add)
+                finished.append((row_col[0], row_col[1], extracted))
+                count += extracted
+                print("[Node %d] Finished extracting column (%d, %d)" % (rank, row_col[0], row_col[1]))
 
-        total_extracted = 0
-        is_done = [False for _ in range(size - 1)]
+            sender.send(finished)
 
-        while True:
-            data = comm.recv(source=MPI.ANY_SOURCE)
-
-            if data["code"] == "start":
-                if len(rcs_to_extract) > 0:
-                    comm.send(rcs_to_extract.pop(0), dest=data["source"])
-                else:
-                    comm.send("done", dest=data["source"])
-                    is_done[data["source"] - 1] = True
-            elif data["code"] == "write":
-                print("[Node %d] Writing data from node %d to file." % (rank, data["source"]), flush=True)
-                _etree_writer(ep, data["data"][0], data["data"][1], data["data"][2])
-                total_extracted += data["data"][2]
-                print("[Node %d] Data written successfully!" % rank, flush=True)
-            elif data["code"] == "new":
-                if len(rcs_to_extract) > 0:
-                    comm.send(rcs_to_extract.pop(0), dest=data["source"])
-                else:
-                    comm.send("done", dest=data["source"])
-                    is_done[data["source"] - 1] = True
-                print("[Node %d] Writing data from node %d to file." % (rank, data["source"]), flush=True)
-                _etree_writer(ep, data["data"][0], data["data"][1], data["data"][2])
-                total_extracted += data["data"][2]
-                print("[Node %d] Data written successfully!" % rank, flush=True)
-
-            if False not in is_done:
-                break
+        sender.close()
 
-        metadata_string = ("Title:%s Author:%s Date:%s %u %s %f %f %f %f %f %f %u %u %u" % (
-            str(information["author"]["title"]).replace(" ", "_"),
-            str(information["author"]["person"]).replace(" ", "_"),
-            str(information["author"]["date"]).replace(" ", "_"), 3, "Vp(float);Vs(float);density(float)",
-            float(information["corners"]["bl"]["y"]), float(information["corners"]["bl"]["x"]),
-            float(information["dimensions"]["x"]), float(information["dimensions"]["y"]),
-            0, float(information["dimensions"]["z"]), int(stats["max_ticks"]["width"]),
-            int(stats["max_ticks"]["height"]), int(stats["max_ticks"]["depth"])
-        )).encode("ASCII")
+        print("[Node %d] Finished extracting %d octants." % (rank, count), flush=True)
 
-        print("[Node %d] Total number of octants extracted: %d." % (rank, total_extracted), flush=True)
+    if group is not None:
+        world.Barrier()
 
-        UCVMCCommon.c_etree_setappmeta(ep, metadata_string)
+        if rank == 0 and scratch is None:
+            output = os.path.join(information["out_dir"], information["etree_name"] + ".e")
+            print("[Node %d] Merging %d sub-e-trees into %s." % (rank, writers, output), flush=True)
+            merged = etree_merge([_get_subetree_path(information, number) for number in range(writers)], output,
+                                 buffer_size)
+            print("[Node %d] Merged %d octants." % (rank, merged), flush=True)
+        elif rank == 0:
+            print("[Node %d] The sub-e-trees are in %s on each node. Gather them and merge them with "
+                  "ucvm_etree_merge." % (rank, scratch), flush=True)
 
-        UCVMCCommon.c_etree_close(ep)
-    else:
-        done = False
-        print("[Node %d] Maximum points per section is %d." % (rank, stats["max_points"]), flush=True)
-        sd_array = UCVM.create_max_seismicdata_array(stats["max_points"], 1)
-        count = 0
+    return True
 
-        comm.send({"source": rank, "data": "", "code": "start"}, dest=0)
 
-        while not done:
-            row_col = comm.recv(source=0)
+def etree_extract_single(information: dict, rows: str=None, interval: str=None,
+                         buffer_size: int=ETREE_BUFFER_SIZE) -> bool:
+    path = (os.path.join(information["out_dir"], information["etree_name"] + ".e")).encode("ASCII")
 
-            if row_col == "done":
-                break
+    start_rc, end_rc = _get_start_end_rc(information, rows, interval)
 
-            print("[Node %d] Received instruction to extract column (%d, %d)." % (rank, row_col[0], row_col[1]),
-                  flush=True)
-            data = _extract_mpi(rank, sd_array, information, stats, row_col[1] - 1, row_col[0] - 1)
-            count += data[2]
-            print("[Node %d] Finished extracting column (%d, %d)" % (rank, row_col[0], row_col[1]))
-            comm.send({"source": rank, "data": data, "code": "new"}, dest=0)
+    ep = _open_etree(path, start_rc[0] == 1 and start_rc[1] == 1, buffer_size)
+    octants = OctantBuffer(ep)
 
-        print("[Node %d] Finished extracting %d octants." % (rank, count), flush=True)
+    octant_count = 0
+
+    stats = _calculate_etree_stats(
+        information, int(information["properties"]["columns"]), int(information["properties"]["rows"])
+    )
+
+    sd_array = UCVM.create_max_seismicdata_array(stats["max_points"], 1)
+
+    print("Maximum points per section is %d" % stats["max_points"])
+
+    current_rc = start_rc
+
+    while not (current_rc[0] == end_rc[0] and current_rc[1] == end_rc[1] + 1):
+        if current_rc[1] > int(information["properties"]["columns"]):
+            current_rc[0] += 1
+            current_rc[1] = 1
+
+        count = _extract_single(octants, sd_array, information, stats, current_rc[1] - 1, current_rc[0] - 1)
+
+        if count is not None:
+            octant_count += count
+        else:
+            raise Exception("HELP!")
+
+        current_rc[1] += 1
+
+    octants.flush()
+
+    print(str(octant_count) + " octants were extracted.")
+
+    metadata_string = _get_metadata_string(information, stats)
+
+    UCVMCCommon.c_etree_setappmeta(ep, metadata_string)
+
+    UCVMCCommon.c_etree_close(ep)
 
     return True
 
 
-def etree_extract_single(information: dict, rows: str=None, interval: str=None) -> bool:
-    schema = "float Vp; float Vs; float density;".encode("ASCII")
+def etree_extract_multiprocess(information: dict, processes: int, rows: str=None, interval: str=None,
+                               buffer_size: int=ETREE_BUFFER_SIZE) -> bool:
+    """
+    Extracts the e-tree using a pool of local processes, without MPI. As with the MPI version, the
+    workers extract columns and this process inserts them into the e-tree. The models are loaded
+    before the pool is started, so the workers share the loaded model data.
+
+    Args:
+        information (dict): The XML description of the desired e-tree as a dictionary.
+        processes (int): The number of worker processes.
+        rows (str): The rows to extract, as for etree_extract_single.
+        interval (str): The interval to extract, as for etree_extract_single.
+        buffer_size (int): The page buffer size, in MB, of the e-tree being written.
+
+    Returns:
+        True, when successful. Raises an error if not.
+    """
     path = (os.path.join(information["out_dir"], information["etree_name"] + ".e")).encode("ASCII")
 
+    start_rc, end_rc = _get_start_end_rc(information, rows, interval)
+
+    stats = _calculate_etree_stats(
+        information, int(information["properties"]["columns"]), int(information["properties"]["rows"])
+    )
+
+    print("Maximum points per section is %d" % stats["max_points"])
+
+    # Query one point so that the models are loaded before the workers are forked from this process.
+    UCVM.query([SeismicData(Point(float(information["corners"]["bl"]["x"]), float(information["corners"]["bl"]["y"]),
+                                  0))], information["cvm_list"], ["velocity"])
+
+    ep = _open_etree(path, start_rc[0] == 1 and start_rc[1] == 1, buffer_size)
+    octants = OctantBuffer(ep)
+
+    octant_count = 0
+    context = multiprocessing.get_context("fork")
+    worker_count = context.Value("i", 0)
+
+    with context.Pool(processes, initializer=_init_etree_worker,
+                      initargs=(information, stats, worker_count)) as pool:
+        for row_col, batches in pool.imap_unordered(_extract_etree_column,
+                                                    _get_columns(information, start_rc, end_rc)):
+            print("Buffering column (%d, %d)." % (row_col[0], row_col[1]), flush=True)
+            for batch in batches:
+                octants.add(batch[0], batch[1], batch[2])
+                octant_count += batch[2]
+
+    octants.flush()
+
+    print(str(octant_count) + " octants were extracted.")
+
+    UCVMCCommon.c_etree_setappmeta(ep, _get_metadata_string(information, stats))
+
+    UCVMCCommon.c_etree_close(ep)
+
+    return True
+
+
+def etree_compact(path: str, output: str=None, buffer_size: int=ETREE_BUFFER_SIZE) -> int:
+    """
+    Rewrites an existing e-tree with its octants in the order of their locational codes. The octants are read
+    in that order and appended to a new e-tree, so its pages are full and in order. This makes the file smaller
+    and faster to query, particularly after an extraction that was resumed or done a few rows at a time.
+
+    Args:
+        path (str): The path to the e-tree.
+        output (str): The path to write the compacted e-tree to. By default the e-tree is replaced, once the
+            compacted copy is complete.
+        buffer_size (int): The page buffer size, in MB, of each of the two e-trees.
+
+    Returns:
+        The number of octants copied.
+    """
+    destination = output if output is not None else path + ".compact"
+
+    source = UCVMCCommon.c_etree_open(path.encode("ASCII"), 0, buffer_size)
+    if source == 0:
+        raise ValueError("Could not open the e-tree " + path + ".")
+
+    target = _open_etree(destination.encode("ASCII"), True, buffer_size)
+    copied, failed = UCVMCCommon.c_etree_copy(source, target)
+    UCVMCCommon.c_etree_close(target)
+    UCVMCCommon.c_etree_close(source)
+
+    if failed > 0:
+        os.remove(destination)
+        raise ValueError("%d of the %d octants of %s could not be copied." % (failed, copied, path))
+
+    if output is None:
+        os.replace(destination, path)
+
+    return copied
+
+
+def etree_merge(paths: List[str], output: str, buffer_size: int=ETREE_BUFFER_SIZE) -> int:
+    """
+    Merges sub-e-trees, whose octants do not overlap, into one e-tree. The sub-e-trees are read together, in
+    the order of the locational codes, so the merged e-tree is written in order, as etree_compact writes it.
+    The metadata of the first sub-e-tree is kept.
+
+    Args:
+        paths (List[str]): The paths to the sub-e-trees.
+        output (str): The path to write the merged e-tree to. It is only replaced once the merge is complete.
+        buffer_size (int): The page buffer size, in MB, of each of the e-trees.
+
+    Returns:
+        The number of octants merged.
+    """
+    destination = output + ".merge"
+
+    sources = []
+    for path in paths:
+        source = UCVMCCommon.c_etree_open(path.encode("ASCII"), 0, buffer_size)
+        if source == 0:
+            for opened in sources:
+                UCVMCCommon.c_etree_close(opened)
+            raise ValueError("Could not open the e-tree " + path + ".")
+        sources.append(source)
+
+    target = _open_etree(destination.encode("ASCII"), True, buffer_size)
+    merged, failed = UCVMCCommon.c_etree_merge(sources, target)
+    UCVMCCommon.c_etree_close(target)
+    for source in sources:
+        UCVMCCommon.c_etree_close(source)
+
+    if failed > 0:
+        os.remove(destination)
+        raise ValueError("%d of the %d octants could not be merged. The sub-e-trees overlap." % (failed, merged))
+
+    os.replace(destination, output)
+
+    return merged
+
+
+def get_subetree_paths(information: dict, directory: str=None) -> List[str]:
+    """
+    Finds the sub-e-trees of an e-tree, as written by etree_extract_mpi with more than one writer.
+
+    Args:
+        information (dict): The XML description of the e-tree as a dictionary.
+        directory (str): The directory to look in. By default, the output directory of the e-tree.
+
+    Returns:
+        The paths of the sub-e-trees, in the order of their numbers.
+    """
+    directory = directory if directory is not None else information["out_dir"]
+    pattern = re.compile(re.escape(information["etree_name"]) + r"\.(\d+)\.e$")
+
+    numbers = sorted(int(match.group(1)) for match in (pattern.match(name) for name in os.listdir(directory))
+                     if match is not None)
+
+    return [_get_subetree_path(information, number, directory) for number in numbers]
+
+
+def _get_subetree_path(information: dict, number: int, directory: str=None) -> str:
+    """
+    Returns the path of one sub-e-tree. Internal method.
+
+    Args:
+        information (dict): The XML description of the e-tree as a dictionary.
+        number (int): The number of the sub-e-tree, which is that of the group of nodes that writes it.
+        directory (str): The directory of the sub-e-tree. By default, the output directory of the e-tree.
+
+    Returns:
+        The path.
+    """
+    directory = directory if directory is not None else information["out_dir"]
+    return os.path.join(directory, "%s.%d.e" % (information["etree_name"], number))
+
+
+#: dict: The state of an e-tree extraction worker process, set up by _init_etree_worker.
+_etree_worker = {}
+
+
+def _init_etree_worker(information: dict, stats: dict, worker_count) -> None:
+    """
+    Sets up an e-tree extraction worker process.
+
+    Args:
+        information (dict): The XML description of the desired e-tree as a dictionary.
+        stats (dict): The statistics as calculated from _calculate_etree_stats.
+        worker_count (multiprocessing.Value): The shared count of started workers, used to number them.
+
+    Returns:
+        Nothing
+    """
+    with worker_count.get_lock():
+        worker_count.value += 1
+        _etree_worker["number"] = worker_count.value
+
+    _etree_worker["information"] = information
+    _etree_worker["stats"] = stats
+    _etree_worker["sd_array"] = UCVM.create_max_seismicdata_array(stats["max_points"], 1)
+
+
+def _extract_etree_column(row_col: tuple) -> (tuple, list):
+    """
+    Extracts one column of the e-tree in a worker process.
+
+    Args:
+        row_col (tuple): The 1-based (row, column) to extract.
+
+    Returns:
+        The row_col tuple and the list of (material properties, e-tree addresses, count) batches to insert.
+    """
+    batches = []
+
+    _extract_mpi(_etree_worker["number"], _etree_worker["sd_array"], _etree_worker["information"],
+                 _etree_worker["stats"], row_col[1] - 1, row_col[0] - 1,
+                 lambda props, addrs, n: batches.append((props, addrs, n)))
+
+    return row_col, batches
+
+
+def _get_start_end_rc(information: dict, rows: str=None, interval: str=None) -> (list, list):
+    """
+    Returns the first and last 1-based (row, column) to extract, given the rows or interval options.
+
+    Args:
+        information (dict): The XML description of the desired e-tree as a dictionary.
+        rows (str): The rows to extract, like "1" or "1-5".
+        interval (str): The interval to extract, like "1,5-10,12".
+
+    Returns:
+        The start [row, column] and end [row, column] lists.
+    """
     start_rc = [1, 1]
     end_rc = [int(information["properties"]["rows"]), int(information["properties"]["columns"])]
 
@@ -195,48 +503,46 @@ def etree_extract_single(information: dict, rows: str=None, interval: str=None)
             start_rc = [int(interval[0]), int(interval[1])]
             end_rc = [int(interval[0]), int(interval[1])]
 
-    if sys.byteorder == "little" and sys.platform != "darwin":
-        if start_rc[0] == 1 and start_rc[1] == 1:
-            ep = UCVMCCommon.c_etree_open(path, 578)
-        else:
-            ep = UCVMCCommon.c_etree_open(path, 2)
-    else:
-        if start_rc[0] == 1 and start_rc[1] == 1:
-            ep = UCVMCCommon.c_etree_open(path, 1538)
-        else:
-            ep = UCVMCCommon.c_etree_open(path, 2)
-
-    UCVMCCommon.c_etree_registerschema(ep, schema)
-
-    octant_count = 0
+    return start_rc, end_rc
 
-    stats = _calculate_etree_stats(
-        information, int(information["properties"]["columns"]), int(information["properties"]["rows"])
-    )
 
-    sd_array = UCVM.create_max_seismicdata_array(stats["max_points"], 1)
+def _get_columns(information: dict, start_rc: list, end_rc: list) -> List[tuple]:
+    """
+    Lists the 1-based (row, column) tuples from start_rc to end_rc inclusive, in row-major order.
 
-    print("Maximum points per section is %d" % stats["max_points"])
+    Args:
+        information (dict): The XML description of the desired e-tree as a dictionary.
+        start_rc (list): The first [row, column].
+        end_rc (list): The last [row, column].
 
-    current_rc = start_rc
+    Returns:
+        The list of (row, column) tuples.
+    """
+    columns = []
 
+    current_rc = list(start_rc)
     while not (current_rc[0] == end_rc[0] and current_rc[1] == end_rc[1] + 1):
         if current_rc[1] > int(information["properties"]["columns"]):
             current_rc[0] += 1
             current_rc[1] = 1
+        columns.append((current_rc[0], current_rc[1]))
+        current_rc[1] += 1
 
-        count = _extract_single(ep, sd_array, information, stats, current_rc[1] - 1, current_rc[0] - 1)
+    return columns
 
-        if count is not None:
-            octant_count += count
-        else:
-            raise Exception("HELP!")
 
-        current_rc[1] += 1
+def _get_metadata_string(information: dict, stats: dict) -> bytes:
+    """
+    Returns the application metadata string stored in the e-tree.
 
-    print(str(octant_count) + " octants were extracted.")
+    Args:
+        information (dict): The XML description of the desired e-tree as a dictionary.
+        stats (dict): The statistics as calculated from _calculate_etree_stats.
 
-    metadata_string = ("Title:%s Author:%s Date:%s %u %s %f %f %f %f %f %f %u %u %u" % (
+    Returns:
+        The metadata string, ASCII encoded.
+    """
+    return ("Title:%s Author:%s Date:%s %u %s %f %f %f %f %f %f %u %u %u" % (
         str(information["author"]["title"]).replace(" ", "_"), str(information["author"]["person"]).replace(" ", "_"),
         str(information["author"]["date"]).replace(" ", "_"), 3, "Vp(float);Vs(float);density(float)",
         float(information["corners"]["bl"]["y"]), float(information["corners"]["bl"]["x"]),
@@ -245,186 +551,455 @@ def etree_extract_single(information: dict, rows: str=None, interval: str=None)
         int(stats["max_ticks"]["height"]), int(stats["max_ticks"]["depth"])
     )).encode("ASCII")
 
-    UCVMCCommon.c_etree_setappmeta(ep, metadata_string)
 
-    UCVMCCommon.c_etree_close(ep)
+def _open_etree(path: bytes, create: bool, buffer_size: int=ETREE_BUFFER_SIZE) -> int:
+    """
+    Opens the e-tree for writing and registers the material property schema.
 
-    return True
+    Args:
+        path (bytes): The path to the e-tree file.
+        create (bool): True to create a new, empty e-tree. False to add to the existing one.
+        buffer_size (int): The page buffer size, in MB. A larger buffer keeps more of the e-tree's pages in
+            memory while octants are inserted.
 
+    Returns:
+        The e-tree handle.
+    """
+    if not create:
+        ep = UCVMCCommon.c_etree_open(path, 2, buffer_size)
+    elif sys.byteorder == "little" and sys.platform != "darwin":
+        ep = UCVMCCommon.c_etree_open(path, 578, buffer_size)
+    else:
+        ep = UCVMCCommon.c_etree_open(path, 1538, buffer_size)
 
-def _etree_writer(ep: int, props: list, etree_pnts: list, n: int):
-    for i in range(n):
-        UCVMCCommon.c_etree_insert(
-            ep, etree_pnts[i * 4], etree_pnts[i * 4 + 1], etree_pnts[i * 4 + 2], etree_pnts[i * 4 + 3],
-            props[i * 3], props[i * 3 + 1], props[i * 3 + 2]
-        )
+    UCVMCCommon.c_etree_registerschema(ep, "float Vp; float Vs; float density;".encode("ASCII"))
 
+    return ep
 
-def _extract_mpi(rank: int, sd_array: List[SeismicData], cfg: dict, stats: dict, column: int, row: int) \
-        -> (dict, list, int, int):
-    from mpi4py import MPI
 
-    comm = MPI.COMM_WORLD
+def _etree_writer(ep: int, props: np.ndarray, etree_pnts: np.ndarray, n: int) -> int:
+    """
+    Inserts a batch of octants into the e-tree in one call, without the GIL.
 
-    level = int(stats["max_level"])
-    edgesize = stats["max_length"] / (1 << level)
-    edgetics = 1 << (31 - level)
-    extracted = 0
-    ztics = 0
+    Args:
+        ep (int): The e-tree handle.
+        props (np.ndarray): The (n, 3) Vp, Vs, and density of each octant.
+        etree_pnts (np.ndarray): The (n, 4) x, y, and z ticks and level of each octant.
+        n (int): The number of octants to insert.
 
-    MAX_POINTS = 250000
-    master_array_mp = [-1.2 for _ in range(MAX_POINTS * 3 + 3)]
-    master_array_ea = [-1.2 for _ in range(MAX_POINTS * 4 + 4)]
+    Returns:
+        The number of octants that could not be inserted.
+    """
+    failed = UCVMCCommon.c_etree_insert_batch(
+        ep, np.ascontiguousarray(etree_pnts[0:n], dtype=np.int64), np.ascontiguousarray(props[0:n], dtype=np.float32)
+    )
 
-    ret_matprop = copy.copy(master_array_mp)
-    ret_etree_addrs = copy.copy(master_array_ea)
-    cursor = 0
+    if failed > 0:
+        print("Warning: %d of %d octants could not be inserted into the e-tree." % (failed, n), flush=True)
+
+    return failed
 
-    print("[Node %d] Extracting row %d, column %d..." % (rank, row + 1, column + 1), flush=True)
 
-    num_points, etree_addrs = _get_grid(sd_array, cfg, stats, level, column, row, ztics)
+def get_morton_order(etree_pnts: np.ndarray) -> np.ndarray:
+    """
+    Returns the order that sorts octants by their Morton, or locational, codes: the bits of the z, y, and x
+    ticks interleaved, most significant first, with a parent before its children.
 
-    if num_points > stats["max_points"]:
-        print("ERROR: Num points exceeds max points")
+    Args:
+        etree_pnts (np.ndarray): The (n, 4) x, y, and z ticks and level of each octant.
 
-    while ztics < stats["max_ticks"]["depth"]:
-        if ztics % (1 << (31 - level)) != 0:
-            print("ERROR: Ztics")
-
-        print("[Node %d]\tQuerying velocity model for %d points" % (rank, num_points), flush=True)
-
-        UCVM.query(sd_array[0:num_points], cfg["cvm_list"], ["velocity"])
-
-        scanlevel = _get_level(cfg, stats, sd_array, num_points)
-
-        if scanlevel < int(stats["min_level"]):
-            scanlevel = int(stats["min_level"])
-        elif scanlevel > int(stats["max_level"]):
-            scanlevel = int(stats["max_level"])
-
-        if level < scanlevel:
-            print("[Node %d]\tIncreasing scan level to %d" % (rank, scanlevel), flush=True)
-            level = scanlevel
-            edgesize = stats["max_length"] / (1 << level)
-            edgetics = 1 << (31 - level)
-            num_points, etree_addrs = _get_grid(sd_array, cfg, stats, level, column, row, ztics)
-            print("[Node %d]\tQuerying velocity model for %d points" % (rank, num_points), flush=True)
-            UCVM.query(sd_array[0:num_points], cfg["cvm_list"], ["velocity"])
-        elif level > scanlevel:
-            for l in range(scanlevel, level):
-                if ztics % (1 << (31 - l)) == 0 and \
-                   ztics + (1 << (31 - l)) <= stats["max_ticks"]["depth"]:
-                    print("[Node %d]\tDecreasing scan level to %d" % (rank, l), flush=True)
-                    level = l
-                    edgesize = stats["max_length"] / (1 << level)
-                    edgetics = 1 << (31 - level)
-                    num_points, etree_addrs = _get_grid(sd_array, cfg, stats, level, column, row, ztics)
-                    print("[Node %d]\tQuerying velocity model for %d points" % (rank, num_points), flush=True)
-                    UCVM.query(sd_array[0:num_points], cfg["cvm_list"], ["velocity"])
-                    break
-
-        for i in range(num_points):
-            ret_matprop[cursor * 3] = sd_array[i].velocity_properties.vp
-            ret_matprop[cursor * 3 + 1] = sd_array[i].velocity_properties.vs
-            ret_matprop[cursor * 3 + 2] = sd_array[i].velocity_properties.density
-            ret_etree_addrs[cursor * 4] = etree_addrs[i]["x"]
-            ret_etree_addrs[cursor * 4 + 1] = etree_addrs[i]["y"]
-            ret_etree_addrs[cursor * 4 + 2] = etree_addrs[i]["z"]
-            ret_etree_addrs[cursor * 4 + 3] = etree_addrs[i]["level"]
-            if cursor == MAX_POINTS:
-                comm.send({"source": rank, "data": (ret_matprop, ret_etree_addrs, MAX_POINTS), "code": "write"}, dest=0)
-                ret_matprop = copy.copy(master_array_mp)
-                ret_etree_addrs = copy.copy(master_array_ea)
-                cursor = 0
-            else:
-                cursor += 1
-
-        extracted += num_points
-
-        ztics += edgetics
-
-        for item in sd_array:
-            item.original_point.z_value = (ztics * stats["tick_size"]) + edgesize / 2.0
-        for _, item in etree_addrs.items():
-            item["z"] = ztics
+    Returns:
+        The indices that sort the octants.
+    """
+    ticks = etree_pnts[:, 0:3].astype(np.uint64)
 
-    if ztics != stats["max_ticks"]["depth"]:
-        raise Exception("Ticks mismatch")
+    # The ticks have up to 31 bits, so the 93-bit code is compared as its top and bottom halves.
+    keys = []
+    for shift, mask in ((16, 0x7FFF), (0, 0xFFFF)):
+        part = (ticks >> np.uint64(shift)) & np.uint64(mask)
+        keys.append((_spread_bits(part[:, 2]) << np.uint64(2)) | (_spread_bits(part[:, 1]) << np.uint64(1)) |
+                    _spread_bits(part[:, 0]))
 
-    return ret_matprop, ret_etree_addrs, cursor, extracted
+    return np.lexsort((etree_pnts[:, 3], keys[1], keys[0]))
 
 
-def _extract_single(ep: int, sd_array: List[SeismicData], cfg: dict, stats: dict, column: int, row: int) -> int:
-    level = int(stats["max_level"])
-    edgesize = stats["max_length"] / (1 << level)
-    edgetics = 1 << (31 - level)
-    extracted = 0
-    ztics = 0
+def _spread_bits(values: np.ndarray) -> np.ndarray:
+    """
+    Spreads the bottom 16 bits of each value out to every third bit, so that three spread values can be
+    interleaved. Internal method.
+
+    Args:
+        values (np.ndarray): The uint64 values.
+
+    Returns:
+        The spread values.
+    """
+    values = values & np.uint64(0xFFFF)
+    for shift, mask in ((16, 0x0000FF0000FF), (8, 0x00F00F00F00F), (4, 0x0C30C30C30C3), (2, 0x249249249249)):
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+class OctantBuffer:
+    """
+    Holds octants until there are enough of them, then inserts them into the e-tree in Morton order. The
+    e-tree is fastest to build, and smallest, when octants are appended in the order of their locational codes,
+    whereas the extraction produces them a column at a time.
+    """
+
+    def __init__(self, ep: int, size: int=OCTANT_BUFFER_SIZE):
+        """
+        Starts an empty buffer.
+
+        Args:
+            ep (int): The e-tree handle. It may be changed, but only after a flush.
+            size (int): The number of octants to hold before they are sorted and inserted.
+        """
+        self.ep = ep
+        self.size = size
+        self.props = []
+        self.etree_pnts = []
+        self.count = 0
+
+    def add(self, props: np.ndarray, etree_pnts: np.ndarray, n: int) -> None:
+        """
+        Adds a batch of octants, inserting the buffer if it is full.
+
+        Args:
+            props (np.ndarray): The (n, 3) Vp, Vs, and density of each octant.
+            etree_pnts (np.ndarray): The (n, 4) x, y, and z ticks and level of each octant.
+            n (int): The number of octants.
+
+        Returns:
+            Nothing
+        """
+        if n == 0:
+            return
+
+        self.props.append(props[0:n])
+        self.etree_pnts.append(etree_pnts[0:n])
+        self.count += n
+
+        if self.count >= self.size:
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        Sorts the held octants into Morton order and inserts them. This must be done before the e-tree is closed.
+
+        Returns:
+            The number of octants that could not be inserted.
+        """
+        if self.count == 0:
+            return 0
+
+        props = np.concatenate(self.props)
+        etree_pnts = np.concatenate(self.etree_pnts)
+        self.props = []
+        self.etree_pnts = []
+        self.count = 0
+
+        order = get_morton_order(etree_pnts)
+        return _etree_writer(self.ep, props[order], etree_pnts[order], len(order))
+
+
+class OctantSender:
+    """
+    Sends an MPI worker's octants to the first node. Octants are copied into one of two preallocated buffers,
+    and a full buffer is sent with non-blocking sends, as a small message followed by the raw arrays, while the
+    worker fills the other buffer. A buffer is only reused once its sends have completed.
+    """
+
+    def __init__(self, comm, size: int=MAX_POINTS):
+        """
+        Allocates the two buffers.
+
+        Args:
+            comm (MPI.Comm): The communicator of the extraction.
+            size (int): The number of octants in each buffer.
+        """
+        from mpi4py import MPI
+
+        self.comm = comm
+        self.waitall = MPI.Request.Waitall
+        self.size = size
+        self.buffers = [(np.empty((size, 3), dtype=np.float32), np.empty((size, 4), dtype=np.int64))
+                        for _ in range(2)]
+        self.requests = [[], []]
+        self.current = 0
+        self.cursor = 0
+
+    def add(self, props: np.ndarray, etree_pnts: np.ndarray, n: int) -> None:
+        """
+        Copies octants into the current buffer, sending it whenever it is full.
+
+        Args:
+            props (np.ndarray): The (n, 3) Vp, Vs, and density of each octant.
+            etree_pnts (np.ndarray): The (n, 4) x, y, and z ticks and level of each octant.
+            n (int): The number of octants.
+
+        Returns:
+            Nothing
+        """
+        done = 0
+        while done < n:
+            count = min(n - done, self.size - self.cursor)
+            self.buffers[self.current][0][self.cursor:self.cursor + count] = props[done:done + count]
+            self.buffers[self.current][1][self.cursor:self.cursor + count] = etree_pnts[done:done + count]
+            self.cursor += count
+            done += count
+            if self.cursor == self.size:
+                self.send()
+
+    def send(self, columns: list=None) -> None:
+        """
+        Sends the current buffer, even if it is empty, and switches to the other one.
+
+        Args:
+            columns (list): The (row, column, octants) of each column that this worker has finished since the last
+                time it sent columns. None if the buffer is only being sent because it is full.
+
+        Returns:
+            Nothing
+        """
+        props, etree_pnts = self.buffers[self.current]
+        message = {"code": "write" if columns is None else "new", "count": self.cursor, "columns": columns}
+
+        requests = [self.comm.isend(message, dest=0, tag=CONTROL_TAG)]
+        if self.cursor > 0:
+            requests.append(self.comm.Isend(props[0:self.cursor], dest=0, tag=DATA_TAG))
+            requests.append(self.comm.Isend(etree_pnts[0:self.cursor], dest=0, tag=DATA_TAG))
+        self.requests[self.current] = requests
+
+        self.current = 1 - self.current
+        self.cursor = 0
+        self.waitall(self.requests[self.current])
+        self.requests[self.current] = []
+
+    def close(self) -> None:
+        """
+        Waits for all the sends to complete.
+
+        Returns:
+            Nothing
+        """
+        for requests in self.requests:
+            self.waitall(requests)
+        self.requests = [[], []]
+
+
+class EtreeWriter:
+    """
+    Inserts octants into the e-tree on a background thread, so that the first MPI node can keep receiving
+    octants and handing out columns while they are written. The octants go through an OctantBuffer, and the
+    columns that arrive with them are recorded in the journal. Every CHECKPOINT_COLUMNS columns the e-tree is
+    closed, which flushes it, and the journal is committed. At most max_pending batches wait to be inserted at
+    once; write blocks until there is room.
+    """
+
+    def __init__(self, path: bytes, create: bool, buffer_size: int, journal: ExtractionJournal,
+                 max_pending: int=WRITE_QUEUE_SIZE):
+        """
+        Opens the e-tree and starts the writer thread.
+
+        Args:
+            path (bytes): The path to the e-tree file.
+            create (bool): True to create a new, empty e-tree. False to add to the existing one.
+            buffer_size (int): The page buffer size, in MB.
+            journal (ExtractionJournal): The journal in which to record the completed columns.
+            max_pending (int): The number of batches that may wait to be inserted at once.
+        """
+        self.path = path
+        self.buffer_size = buffer_size
+        self.journal = journal
+        self.octants = OctantBuffer(_open_etree(path, create, buffer_size))
+        self.count = 0
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._insert_octants, daemon=True)
+        self.thread.start()
+
+    def write(self, props: np.ndarray, etree_pnts: np.ndarray, n: int, columns: list=None) -> None:
+        """
+        Queues a batch of octants to be inserted. The arrays must not be modified after they have been handed to
+        the writer.
+
+        Args:
+            props (np.ndarray): The (n, 3) Vp, Vs, and density of each octant.
+            etree_pnts (np.ndarray): The (n, 4) x, y, and z ticks and level of each octant.
+            n (int): The number of octants.
+            columns (list): The (row, column, octants) of each column that is complete once this batch is in.
+
+        Returns:
+            Nothing
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put((props, etree_pnts, n, columns))
+
+    def close(self, metadata: bytes) -> int:
+        """
+        Waits for all the queued octants to be inserted, sets the metadata, closes the e-tree, and commits the
+        journal. Raises the first error from the writer thread, if any.
+
+        Args:
+            metadata (bytes): The application metadata string of the e-tree.
+
+        Returns:
+            The number of octants inserted.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+        self.octants.flush()
+        UCVMCCommon.c_etree_setappmeta(self.octants.ep, metadata)
+        UCVMCCommon.c_etree_close(self.octants.ep)
+        self.journal.commit()
+
+        return self.count
+
+    def _insert_octants(self) -> None:
+        """
+        The background thread that inserts the queued octants and checkpoints the e-tree.
+
+        Returns:
+            Nothing
+        """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            props, etree_pnts, n, columns = item
+            if self.error is not None:
+                continue
+
+            try:
+                self.octants.add(props, etree_pnts, n)
+                self.count += n
+
+                for row, column, extracted in columns or []:
+                    self.journal.record(row, column, extracted)
+
+                if len(self.journal.pending) >= CHECKPOINT_COLUMNS:
+                    self.octants.flush()
+                    UCVMCCommon.c_etree_close(self.octants.ep)
+                    self.journal.commit()
+                    self.octants.ep = _open_etree(self.path, False, self.buffer_size)
+            except Exception as error:
+                self.error = error
+
+
+def _get_octant_arrays(sd_array: List[SeismicData], num_points: int) -> np.ndarray:
+    """
+    Gathers the material properties of the queried octants into the array that _etree_writer inserts
+    and _get_level scans.
+
+    Args:
+        sd_array (List[SeismicData]): The queried octant centres.
+        num_points (int): The number of octants.
+
+    Returns:
+        The (n, 3) float32 material properties.
+    """
+    props = np.array([(sd_array[i].velocity_properties.vp, sd_array[i].velocity_properties.vs,
+                       sd_array[i].velocity_properties.density) for i in range(num_points)], dtype=np.float32)
+
+    return props.reshape(num_points, 3)
+
 
+def _extract_mpi(rank: int, sd_array: List[SeismicData], cfg: dict, stats: dict, column: int, row: int,
+                 send: callable) -> int:
+    print("[Node %d] Extracting row %d, column %d..." % (rank, row + 1, column + 1), flush=True)
+
+    return _extract_column(sd_array, cfg, stats, column, row, send, "[Node %d]" % rank)
+
+
+def _extract_single(octants: OctantBuffer, sd_array: List[SeismicData], cfg: dict, stats: dict, column: int,
+                    row: int) -> int:
     print("Extracting row %d, column %d..." % (row + 1, column + 1), flush=True)
 
-    num_points, etree_addrs = _get_grid(sd_array, cfg, stats, level, column, row, ztics)
+    return _extract_column(sd_array, cfg, stats, column, row, octants.add, "")
 
-    ret_matprop = [-1.2 for _ in range(num_points * 3 + 3)]
-    ret_etree_addrs = [-1.2 for _ in range(num_points * 4 + 4)]
 
-    if num_points > stats["max_points"]:
-        print("ERROR: Num points exceeds max points")
+def _extract_column(sd_array: List[SeismicData], cfg: dict, stats: dict, column: int, row: int, write: callable,
+                    prefix: str) -> int:
+    """
+    Extracts one column of the e-tree, a layer at a time. Each layer is first covered with the largest octants
+    that fit it, and each octant is queried at its centre and at the centres of its eight children. An octant
+    whose slowest sample needs a finer level is replaced by its children, which already have their centre
+    samples, so the column is only refined, and only queried finely, where the material is slow.
+
+    Args:
+        sd_array (List[SeismicData]): The SeismicData objects to query with.
+        cfg (dict): The configuration XML file as a dictionary.
+        stats (dict): The statistics as calculated from _calculate_etree_stats.
+        column (int): The column to extract.
+        row (int): The row to extract.
+        write (callable): Called with the (n, 3) material properties, (n, 4) addresses, and number of each
+            batch of finished octants.
+        prefix (str): The text that starts each progress message.
+
+    Returns:
+        The number of octants extracted.
+    """
+    max_level = int(stats["max_level"])
+    extracted = 0
+    ztics = 0
 
     while ztics < stats["max_ticks"]["depth"]:
-        if ztics % (1 << (31 - level)) != 0:
-            print("ERROR: Ztics")
-
-        print("\tQuerying velocity model for %d points" % num_points, flush=True)
-
-        UCVM.query(sd_array[0:num_points], cfg["cvm_list"], ["velocity"])
-
-        scanlevel = _get_level(cfg, stats, sd_array, num_points)
-
-        if scanlevel < int(stats["min_level"]):
-            scanlevel = int(stats["min_level"])
-        elif scanlevel > int(stats["max_level"]):
-            scanlevel = int(stats["max_level"])
-
-        if level < scanlevel:
-            print("\tIncreasing scan level to %d" % scanlevel)
-            level = scanlevel
-            edgesize = stats["max_length"] / (1 << level)
-            edgetics = 1 << (31 - level)
-            num_points, etree_addrs = _get_grid(sd_array, cfg, stats, level, column, row, ztics)
-            print("\tQuerying velocity model for %d points" % num_points, flush=True)
-            UCVM.query(sd_array[0:num_points], cfg["cvm_list"], ["velocity"])
-        elif level > scanlevel:
-            for l in range(scanlevel, level):
-                if ztics % (1 << (31 - l)) == 0 and \
-                   ztics + (1 << (31 - l)) <= stats["max_ticks"]["depth"]:
-                    print("\tDecreasing scan level to %d" % l)
-                    level = l
-                    edgesize = stats["max_length"] / (1 << level)
-                    edgetics = 1 << (31 - level)
-                    num_points, etree_addrs = _get_grid(sd_array, cfg, stats, level, column, row, ztics)
-                    print("\tQuerying velocity model for %d points" % num_points, flush=True)
-                    UCVM.query(sd_array[0:num_points], cfg["cvm_list"], ["velocity"])
-                    break
-
-        print("\tWriting points to e-tree file", flush=True)
-        for i in range(num_points):
-            ret_matprop[i * 3] = sd_array[i].velocity_properties.vp
-            ret_matprop[i * 3 + 1] = sd_array[i].velocity_properties.vs
-            ret_matprop[i * 3 + 2] = sd_array[i].velocity_properties.density
-            ret_etree_addrs[i * 4] = etree_addrs[i]["x"]
-            ret_etree_addrs[i * 4 + 1] = etree_addrs[i]["y"]
-            ret_etree_addrs[i * 4 + 2] = etree_addrs[i]["z"]
-            ret_etree_addrs[i * 4 + 3] = etree_addrs[i]["level"]
-        _etree_writer(ep, ret_matprop, ret_etree_addrs, num_points)
-        extracted += num_points
-
-        ztics += edgetics
-
-        for item in sd_array:
-            item.original_point.z_value = (ztics * stats["tick_size"]) + edgesize / 2.0
-        for _, item in etree_addrs.items():
-            item["z"] = ztics
+        level = _get_layer_level(stats, ztics)
+        print("%s\tExtracting layer at %d ticks from level %d" % (prefix, ztics, level), flush=True)
+
+        # Each pending item is a set of octants and, if they have already been sampled, their properties.
+        pending = [(_get_grid(stats, level, column, row, ztics), None)]
+
+        while len(pending) > 0:
+            etree_pnts, props = pending.pop()
+
+            # Up to nine points are queried for each octant, so large sets are split to fit in sd_array.
+            size = max(1, len(sd_array) // 9)
+            if len(etree_pnts) > size:
+                pending.append((etree_pnts[size:], None if props is None else props[size:]))
+                etree_pnts = etree_pnts[0:size]
+                props = None if props is None else props[0:size]
+
+            divisible = etree_pnts[:, 3] < max_level
+            children = _get_children(etree_pnts[divisible])
+            points = children if props is not None else np.concatenate((etree_pnts, children))
+            samples = np.empty((0, 3), dtype=np.float32)
+
+            if len(points) > 0:
+                print("%s\tQuerying velocity model for %d points" % (prefix, len(points)), flush=True)
+                _set_octant_centres(sd_array, cfg, stats, points)
+                UCVM.query(sd_array[0:len(points)], cfg["cvm_list"], ["velocity"])
+                samples = _get_octant_arrays(sd_array, len(points))
+
+            if props is None:
+                props = samples[0:len(etree_pnts)]
+                samples = samples[len(etree_pnts):]
+
+            vs_min = props[:, 1].copy()
+            vs_min[divisible] = np.fmin(vs_min[divisible], np.nanmin(samples[:, 1].reshape(-1, 8), axis=1))
+            refine = np.zeros(len(etree_pnts), dtype=bool)
+            refine[divisible] = _get_levels(cfg, stats, vs_min[divisible]) > etree_pnts[divisible, 3]
+
+            keep = ~refine
+            count = int(np.count_nonzero(keep))
+            if count > 0:
+                write(props[keep], etree_pnts[keep], count)
+                extracted += count
+
+            if np.any(refine):
+                # The children of the octants being refined, and their samples, in the same order.
+                chosen = np.repeat(refine[divisible], 8)
+                print("%s\tRefining %d octants" % (prefix, int(np.count_nonzero(refine))), flush=True)
+                pending.append((children[chosen], samples[chosen]))
+
+        ztics += 1 << (31 - level)
 
     if ztics != stats["max_ticks"]["depth"]:
         raise Exception("Ticks mismatch")
@@ -739,18 +1314,62 @@ def ask_questions() -> dict:
     return answers
 
 
-def _get_grid(sd_array: List[SeismicData], cfg: dict, stats: dict, level: int, column: int,
-              row: int, ztics: int) -> (int, dict):
+def etree_xy2geo(cfg: dict, x_values: np.ndarray, y_values: np.ndarray) -> (np.ndarray, np.ndarray):
     """
-    Internal utility which generates the query grid based on the z level (in tics), the column and
-    row, as well as the desired level. It returns the number of queried points (which cannot be
-    greater than the maximum points in the stats dictionary), as well as a dictionary of the
-    e-tree address locations.
+    Maps points within the e-tree, given in metres from its bottom-left corner, to longitude and latitude by
+    interpolating between its four corners. This is the vectorized form of UCVMCCommon.c_etree_bilinear_xy2geo
+    and, like it, works in single precision, so the two agree exactly.
 
     Args:
-        sd_array (`obj`:List of `obj`:SeismicData): The list of SeismicData objects to fill with
-            the X, Y, and Z values in geo-bilinear projection.
         cfg (dict): The configuration XML file as a dictionary.
+        x_values (np.ndarray): The distances along the width of the e-tree.
+        y_values (np.ndarray): The distances along the height of the e-tree, one for each x value.
+
+    Returns:
+        The longitudes and latitudes as float32 arrays.
+    """
+    x = np.asarray(x_values, dtype=np.float32)
+    y = np.asarray(y_values, dtype=np.float32)
+    x2 = np.float32(float(cfg["dimensions"]["x"]))
+    y2 = np.float32(float(cfg["dimensions"]["y"]))
+    p = x2 * y2
+
+    # The factors of the bottom-left, bottom-right, upper-left, and upper-right corners, in that order.
+    factors = ((x2 - x, y2 - y), (x, y2 - y), (x2 - x, y), (x, y))
+    coordinates = []
+    for axis in ("x", "y"):
+        corners = [np.float32(float(cfg["corners"][corner][axis])) for corner in ("bl", "br", "ul", "ur")]
+        coordinates.append(sum((corners[i] / p) * factors[i][0] * factors[i][1] for i in range(4)))
+
+    return coordinates[0], coordinates[1]
+
+
+def _get_layer_level(stats: dict, ztics: int) -> int:
+    """
+    Finds the level of the largest octants that can start a layer at the given depth: they must be no larger
+    than the maximum octant size, start at a multiple of their size, and end within the e-tree.
+
+    Args:
+        stats (dict): The statistics as calculated from _calculate_etree_stats.
+        ztics (int): The depth of the top of the layer, in ticks.
+
+    Returns:
+        The level as an integer.
+    """
+    for level in range(int(stats["min_level"]), int(stats["max_level"])):
+        edgetics = 1 << (31 - level)
+        if ztics % edgetics == 0 and ztics + edgetics <= stats["max_ticks"]["depth"]:
+            return level
+
+    return int(stats["max_level"])
+
+
+def _get_grid(stats: dict, level: int, column: int, row: int, ztics: int) -> np.ndarray:
+    """
+    Internal utility which generates the octants that cover one layer of a column at the desired
+    level, starting at the z level (in tics).
+
+    Args:
         stats (dict): The statistics as calculated from _get_etree_stats.
         level (int): Our curent extraction resolution level.
         column (int): The column to extract.
@@ -758,87 +1377,97 @@ def _get_grid(sd_array: List[SeismicData], cfg: dict, stats: dict, level: int, c
         ztics (int): The z level to extract in tics.
 
     Returns:
-        A tuple containing an int with the number of points extracted, and a dictionary of the
-        e-tree address locations for each lat, lon.
+        The (n, 4) int64 array of the x, y, and z ticks and level of each octant.
     """
-    edgesize = stats["max_length"] / (1 << level)
     edgetics = 1 << (31 - level)
-    num_points = 0
-    etree_pnts = {}
-
-    grid_z = (ztics * stats["tick_size"]) + edgesize / 2.0
 
     imin = int(column * stats["column_ticks"])
     jmin = int(row * stats["row_ticks"])
     imax = int(imin + stats["column_ticks"])
     jmax = int(jmin + stats["row_ticks"])
 
-    for j in range(jmin, jmax, edgetics):
-        for i in range(imin, imax, edgetics):
-            x_val = (i + (edgetics / 2.0)) * stats["tick_size"]
-            y_val = (j + (edgetics / 2.0)) * stats["tick_size"]
-            new_y, new_x = UCVMCCommon.c_etree_bilinear_xy2geo(
-                x_val, y_val,
-                (
-                    (float(cfg["corners"]["bl"]["x"]), float(cfg["corners"]["bl"]["y"])),
-                    (float(cfg["corners"]["ul"]["x"]), float(cfg["corners"]["ul"]["y"])),
-                    (float(cfg["corners"]["ur"]["x"]), float(cfg["corners"]["ur"]["y"])),
-                    (float(cfg["corners"]["br"]["x"]), float(cfg["corners"]["br"]["y"]))
-                ),
-                (
-                    float(cfg["dimensions"]["x"]),
-                    float(cfg["dimensions"]["y"]),
-                    float(cfg["dimensions"]["z"])
-                )
-            )
-            sd_array[num_points].original_point.x_value = new_x
-            sd_array[num_points].original_point.y_value = new_y
-            sd_array[num_points].original_point.z_value = grid_z
-
-            etree_pnts[num_points] = {
-                "x": i,
-                "y": j,
-                "z": ztics,
-                "level": level,
-                "type": 1
-            }
+    # The octants run along each row, x fastest.
+    j, i = np.meshgrid(np.arange(jmin, jmax, edgetics, dtype=np.int64),
+                       np.arange(imin, imax, edgetics, dtype=np.int64), indexing="ij")
 
-            num_points += 1
+    etree_pnts = np.empty((i.size, 4), dtype=np.int64)
+    etree_pnts[:, 0] = i.ravel()
+    etree_pnts[:, 1] = j.ravel()
+    etree_pnts[:, 2] = ztics
+    etree_pnts[:, 3] = level
 
-    return num_points, etree_pnts
+    return etree_pnts
 
 
-def _get_level(cfg: dict, stats: dict, sd_array: List[SeismicData], num_points: int) -> int:
+def _get_children(etree_pnts: np.ndarray) -> np.ndarray:
     """
-    Given the minimum found velocity in sd_array, calculate the level that is needed to properly
-    represent it.
+    Divides each octant into its eight children.
+
+    Args:
+        etree_pnts (np.ndarray): The (n, 4) x, y, and z ticks and level of each octant.
+
+    Returns:
+        The (8n, 4) addresses of the children, eight for each octant in turn.
+    """
+    children = np.repeat(etree_pnts, 8, axis=0)
+    children[:, 3] += 1
+
+    edgetics = np.left_shift(1, 31 - children[:, 3])
+    for axis in range(3):
+        children[:, axis] += ((np.arange(len(children)) >> axis) & 1) * edgetics
+
+    return children
+
+
+def _set_octant_centres(sd_array: List[SeismicData], cfg: dict, stats: dict, etree_pnts: np.ndarray) -> None:
+    """
+    Sets the X, Y, and Z values of sd_array, in geo-bilinear projection, to the centres of the octants.
 
     Args:
+        sd_array (`obj`:List of `obj`:SeismicData): The list of SeismicData objects to fill.
         cfg (dict): The configuration XML file as a dictionary.
-        stats (dict): The statistics as calculated using the _calculate_etree_stats function.
-        sd_array (`obj`:List of `obj`:SeismicData): The extracted SeismicData objects containing
-            the material properties to check for.
-        num_points (int): The number of points to look through in sd_array.
+        stats (dict): The statistics as calculated from _get_etree_stats.
+        etree_pnts (np.ndarray): The (n, 4) x, y, and z ticks and level of each octant.
 
     Returns:
-        The level as an integer.
+        Nothing
     """
-    if num_points == 0:
-        raise Exception("Num points is 0.")
+    edgetics = np.left_shift(1, 31 - etree_pnts[:, 3])
 
-    vs_min = sd_array[0].velocity_properties.vs
-    min_index = 0
+    lons, lats = etree_xy2geo(cfg, (etree_pnts[:, 0] + (edgetics / 2.0)) * stats["tick_size"],
+                              (etree_pnts[:, 1] + (edgetics / 2.0)) * stats["tick_size"])
+    depths = (etree_pnts[:, 2] * stats["tick_size"]) + (edgetics * stats["tick_size"]) / 2.0
 
-    for i in range(num_points):
-        if sd_array[i].velocity_properties.vs < vs_min:
-            vs_min = sd_array[i].velocity_properties.vs
-            min_index = i
+    for index, (lon, lat, depth) in enumerate(zip(lons.tolist(), lats.tolist(), depths.tolist())):
+        point = sd_array[index].original_point
+        point.x_value = lon
+        point.y_value = lat
+        point.z_value = depth
 
-    return int(math.log(
+
+def _get_levels(cfg: dict, stats: dict, vs: np.ndarray) -> np.ndarray:
+    """
+    Given the minimum velocity found in each octant, calculate the level that is needed to properly
+    represent it.
+
+    Args:
+        cfg (dict): The configuration XML file as a dictionary.
+        stats (dict): The statistics as calculated using the _calculate_etree_stats function.
+        vs (np.ndarray): The minimum Vs of each octant.
+
+    Returns:
+        The levels as an int64 array. Octants without a positive Vs get -1, as they need no refinement.
+    """
+    levels = np.full(len(vs), -1, dtype=np.int64)
+    valid = np.isfinite(vs) & (vs > 0)
+
+    levels[valid] = np.floor(np.log(
         float(stats["max_length"]) /
-        (vs_min / (float(cfg["properties"]["parts_per_wavelength"]) * float(cfg["properties"]["max_frequency"])))
+        (vs[valid] / (float(cfg["properties"]["parts_per_wavelength"]) * float(cfg["properties"]["max_frequency"])))
     ) / math.log(2.0) + 1)
 
+    return levels
+
 
 def _calculate_etree_stats(information: dict, cols: int, rows: int) -> dict:
     """
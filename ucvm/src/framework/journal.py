@@ -0,0 +1,160 @@
+"""
+Extraction progress journal.
+
+Long mesh and e-tree extractions record the work they have finished in a journal next to their
+output, so that a failed job can be restarted and only extract what is left. The journal is a
+plain text file: a header line identifying the configuration it belongs to, then one line per
+completed unit of work. Lines are only appended once the work they describe has been flushed to
+disk, so everything in the journal can be trusted after a crash.
+
+Copyright 2017 Southern California Earthquake Center
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# Python Imports
+import hashlib
+import json
+import os
+from typing import List
+
+JOURNAL_HEADER = "# UCVM extraction journal"   #: str: The start of the first line of every journal.
+
+
+class ExtractionJournal:
+    """
+    Records completed units of work, such as mesh chunks or e-tree columns, for one extraction. Each unit is a
+    tuple of integers. Units are buffered with record and only written out by commit, which the caller should do
+    after the output they describe has been synced.
+    """
+
+    def __init__(self, path: str, information: dict):
+        """
+        Sets up the journal. Nothing is read or written until load or start is called.
+
+        Args:
+            path (str): The path to the journal file.
+            information (dict): The configuration of the extraction. The journal only matches this exact
+                configuration.
+        """
+        self.path = path
+        self.fingerprint = get_configuration_fingerprint(information)
+        self.pending = []
+
+    def load(self) -> List[tuple]:
+        """
+        Reads the completed units from an existing journal, so that the extraction can resume. New units are then
+        appended to the same journal.
+
+        Returns:
+            The list of completed units. Empty if there is no journal yet.
+        """
+        if not os.path.exists(self.path):
+            self.start()
+            return []
+
+        units = []
+        with open(self.path, "r") as fd:
+            header = fd.readline().split()
+            if len(header) == 0 or header[-1] != self.fingerprint:
+                raise ValueError("The journal %s was written for a different configuration. Remove it to "
+                                 "extract from the beginning." % self.path)
+
+            for line in fd:
+                # A line can only be cut short if the job died while appending it.
+                if not line.endswith("\n"):
+                    break
+                units.append(tuple(int(x) for x in line.split()))
+
+        return units
+
+    def start(self) -> None:
+        """
+        Starts a new, empty journal, replacing any existing one.
+
+        Returns:
+            Nothing
+        """
+        with open(self.path, "w") as fd:
+            fd.write("%s %s\n" % (JOURNAL_HEADER, self.fingerprint))
+            fd.flush()
+            os.fsync(fd.fileno())
+
+    def record(self, *unit: int) -> None:
+        """
+        Buffers one completed unit until the next commit.
+
+        Args:
+            unit (int): The integers identifying the unit.
+
+        Returns:
+            Nothing
+        """
+        self.pending.append(tuple(int(x) for x in unit))
+
+    def commit(self) -> None:
+        """
+        Appends all the buffered units to the journal and flushes it to disk.
+
+        Returns:
+            Nothing
+        """
+        if len(self.pending) == 0:
+            return
+
+        with open(self.path, "a") as fd:
+            fd.writelines(" ".join(str(x) for x in unit) + "\n" for unit in self.pending)
+            fd.flush()
+            os.fsync(fd.fileno())
+
+        self.pending = []
+
+
+def get_configuration_fingerprint(information: dict) -> str:
+    """
+    Returns a short hash of the extraction configuration, used to make sure a journal is only resumed by the
+    same extraction that wrote it.
+
+    Args:
+        information (dict): The configuration of the extraction.
+
+    Returns:
+        The hash as a hexadecimal string.
+    """
+    return hashlib.sha1(json.dumps(information, sort_keys=True, default=str).encode("UTF-8")).hexdigest()[0:16]
+
+
+def subtract_ranges(start_end: tuple, completed: List[tuple]) -> List[tuple]:
+    """
+    Removes the completed ranges from a range of points.
+
+    Args:
+        start_end (tuple): The (start, end) range of points, end exclusive.
+        completed (list): The completed (start, end) ranges, in any order. They may overlap.
+
+    Returns:
+        The ordered list of (start, end) ranges within start_end that are not completed.
+    """
+    remaining = []
+    current = start_end[0]
+
+    for start, end in sorted(completed):
+        if end <= current or start >= start_end[1]:
+            continue
+        if start > current:
+            remaining.append((current, start))
+        current = max(current, end)
+
+    if current < start_end[1]:
+        remaining.append((current, start_end[1]))
+
+    return remaining
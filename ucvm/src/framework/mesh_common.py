@@ -1,6 +1,6 @@
 """
-Provides all the common data structures and functions for all meshing capabilities (both AWP and
-and RWG) within UCVM.
+Provides all the common data structures and functions for all meshing capabilities (AWP, RWG,
+and HDF5) within UCVM.
 
 Copyright 2017 Southern California Earthquake Center
 
@@ -17,11 +17,19 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 # Python Imports
+import copy
 import math
+import os
+import queue
+import threading
+import zlib
+from collections import OrderedDict
 from typing import List
 
 # Package Imports
+import h5py
 import humanize
+import numpy as np
 import psutil
 import pyproj
 import xmltodict
@@ -29,9 +37,15 @@ import xmltodict
 # UCVM Imports
 from ucvm.src.shared.properties import Point, SeismicData
 from ucvm.src.shared import UCVM_DEPTH, UCVM_ELEVATION, UCVM_DEFAULT_PROJECTION
+from ucvm.src.framework.chunk_tuner import MAX_PERCENT_FREE, get_seismicdata_size
 
-SEISMICDATA_SIZE = 2048     #: int: For now, let's assume that SeismicData is at least 2KB.
-MAX_PERCENT_FREE = 0.33     #: float: Only use 1/3rd of available memory for SeismicData objects.
+HDF5_DATASETS = ("vp", "vs", "density")     #: tuple: The datasets of an HDF5 mesh, in the order of AWP points.
+HDF5_CHUNK_SHAPE = (8, 64, 64)              #: tuple: The (z, y, x) shape of each compressed HDF5 chunk.
+HDF5_COMPRESSION = "gzip"                   #: str: The HDF5 compression filter (fast and readable everywhere).
+HDF5_COMPRESSION_LEVEL = 1                  #: int: The compression level. Higher levels gain little on meshes.
+HDF5_CACHE_SIZE = 256 * 1024 * 1024         #: int: The chunk cache size, in bytes, of each dataset being written.
+HDF5_CACHE_SLOTS = 100003                   #: int: The number of chunk cache hash slots (a prime number).
+CHECKPOINT_TAG = 11                         #: int: The MPI tag of the chunks that ranks report to rank 0.
 
 
 class InternalMesh(object):
@@ -66,13 +80,15 @@ class InternalMesh(object):
         self.num_y = int(mesh_info["dimensions"]["y"])
         self.num_z = int(mesh_info["dimensions"]["z"])
         self.spacing = float(mesh_info["spacing"])
+        self.z_offsets = get_z_offsets(mesh_info, self.num_z, self.spacing)
         self.grid_type = mesh_info["grid_type"]
         self.format = mesh_info["format"]
         self.cvm_list = mesh_info["cvm_list"]
         self.out_dir = mesh_info["out_dir"]
         self.projection = mesh_info["projection"]
 
-        if self.format == "awp":
+        # HDF5 meshes are extracted in the same order as AWP meshes.
+        if self.format in ("awp", "hdf5"):
             self.slice_size = self.num_x * self.num_y
             self.total_size = self.slice_size * self.num_z
         elif self.format == "rwg":
@@ -103,6 +119,7 @@ class InternalMesh(object):
         im_instance.num_y = int(grid_info["num_y"])
         im_instance.num_z = int(grid_info["num_z"])
         im_instance.spacing = float(grid_info["spacing"])
+        im_instance.z_offsets = get_z_offsets(grid_info, im_instance.num_z, im_instance.spacing)
         im_instance.projection = grid_info["projection"]
         im_instance.cvm_list = cvm_list
         im_instance.out_dir = out_dir
@@ -142,7 +159,8 @@ class InternalMesh(object):
         return True
 
     def get_grid_file_size(self) -> dict:
-        if self.format == "awp":
+        # For HDF5 meshes, this is the size before compression.
+        if self.format in ("awp", "hdf5"):
             return {
                 "display": humanize.naturalsize(self.end_point * 12, gnu=False),
                 "real": self.end_point * 12
@@ -155,10 +173,1100 @@ class InternalMesh(object):
 
     @staticmethod
     def get_max_points_extract(num_processes: int=1) -> int:
-        return math.floor((psutil.virtual_memory().free * MAX_PERCENT_FREE) / SEISMICDATA_SIZE /
+        return math.floor((psutil.virtual_memory().available * MAX_PERCENT_FREE) / get_seismicdata_size() /
                           num_processes)
 
 
+class MeshWriter:
+    """
+    Writes mesh chunks to their output files on a background thread, so that the next chunk can be queried while
+    the previous one is being written. Chunks are NumPy arrays that are written in place with positional writes,
+    so the files can be written in any order. At most max_pending chunks wait to be written at once; write blocks
+    until there is room, which bounds the memory held by the writer. If there is a manifest, the checksum and
+    statistics of each chunk are added to it on the same background thread.
+    """
+
+    def __init__(self, files: dict, size: int, max_pending: int=2, truncate: bool=False, manifest=None):
+        """
+        Opens each output file and extends it to its final size.
+
+        Args:
+            files (dict): The output file paths keyed by a name that write uses to refer to them.
+            size (int): The final size of each file in bytes.
+            max_pending (int): The number of chunks that may wait to be written at once.
+            truncate (bool): True to empty any existing file first. Otherwise existing contents are kept, so that
+                a mesh can be extracted a few slices at a time.
+            manifest (MeshManifest): The manifest to record the written chunks in, if any.
+        """
+        self.fds = {}
+        for key, path in files.items():
+            self.fds[key] = os.open(path, os.O_WRONLY | os.O_CREAT | (os.O_TRUNC if truncate else 0), 0o644)
+            if os.fstat(self.fds[key]).st_size < size:
+                os.ftruncate(self.fds[key], size)
+
+        self.manifest = manifest
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._write_chunks, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, key: str, offset: int, buffer: np.ndarray) -> None:
+        """
+        Queues a chunk to be written. The buffer must not be modified after it has been handed to the writer.
+
+        Args:
+            key (str): The name of the file to write to.
+            offset (int): The byte offset within the file.
+            buffer (np.ndarray): The C-contiguous array to write.
+
+        Returns:
+            Nothing
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put((key, offset, buffer))
+
+    def close(self) -> None:
+        """
+        Waits for all the queued chunks to be written and closes the files. Raises the first write error, if any.
+
+        Returns:
+            Nothing
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+            for fd in self.fds.values():
+                os.close(fd)
+
+        if self.error is not None:
+            raise self.error
+
+    def _write_chunks(self) -> None:
+        """
+        The background thread that writes the queued chunks.
+
+        Returns:
+            Nothing
+        """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            key, offset, buffer = item
+            if self.error is not None:
+                continue
+
+            try:
+                view = memoryview(buffer).cast("B")
+                position = offset
+                while len(view) > 0:
+                    written = os.pwrite(self.fds[key], view, position)
+                    view = view[written:]
+                    position += written
+            except OSError as error:
+                self.error = error
+                continue
+
+            if self.manifest is not None:
+                self.manifest.add(key, offset, buffer)
+
+
+class MPIMeshWriter:
+    """
+    Writes mesh chunks from every MPI rank to shared output files.
+
+    In collective mode the chunks are written in rounds. In each round every rank writes at most one chunk to each
+    file, and ranks that have run out of chunks keep joining the rounds with empty writes until all the ranks are
+    done. Since every rank goes through the same number of rounds, the writes can be collective (Write_at_all),
+    which lets MPI-IO gather the chunks on a few aggregator ranks and write them as large contiguous stripes. At
+    each checkpoint the files are synced and the chunks written since the last one are gathered on rank 0 and
+    recorded in the extraction journal with their checksums.
+
+    Otherwise each rank opens the files on its own and writes its chunks as soon as they are ready, without waiting
+    for the other ranks. Each rank checkpoints after its own number of writes: it syncs its writes and sends its
+    chunks to rank 0, which records them in the journal at its own checkpoints.
+
+    If there is a manifest, each rank also adds its chunks to its own manifest; the manifests are merged at the
+    end of the extraction.
+    """
+
+    def __init__(self, files: dict, collective: bool=False, aggregators: int=None, stripe_size: int=None,
+                 journal=None, checkpoint_rounds: int=None, manifest=None):
+        """
+        Opens each output file on every rank.
+
+        Args:
+            files (dict): The output file paths keyed by a name that write uses to refer to them.
+            collective (bool): True to write with Write_at_all in rounds, false to write each rank's chunks
+                independently, as soon as they are ready.
+            aggregators (int): The number of ranks that gather and write the data in collective mode. By default
+                MPI-IO decides.
+            stripe_size (int): The file system stripe size in bytes. Collective buffers are made this size.
+            journal (ExtractionJournal): The journal in which rank 0 records the completed chunks. None on the
+                other ranks.
+            checkpoint_rounds (int): The number of rounds between checkpoints. Must be the same on every rank.
+                By default there is only a checkpoint when the files are closed. In independent mode, the number
+                of writes between each rank's checkpoints.
+            manifest (MeshManifest): This rank's manifest, to record its chunks in, if any.
+        """
+        from mpi4py import MPI
+
+        self.comm = MPI.COMM_WORLD
+        self.collective = collective
+        self.active_ranks = 1
+        self.rounds = 0
+        self.completed = []
+        self.requests = []
+        self.unfinished_ranks = self.comm.Get_size() - 1
+        self.journal = journal
+        self.checkpoint_rounds = checkpoint_rounds
+        self.manifest = manifest
+
+        info = MPI.Info.Create()
+        if collective:
+            info.Set("romio_cb_write", "enable")
+            if aggregators is not None:
+                info.Set("cb_nodes", str(aggregators))
+        if stripe_size is not None:
+            info.Set("striping_unit", str(stripe_size))
+            info.Set("cb_buffer_size", str(stripe_size))
+
+        self.handles = self._open_files(files, info)
+
+        info.Free()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, chunks: dict, chunk: tuple=None) -> None:
+        """
+        Writes this rank's part of one round. In collective mode every rank must call write the same number of
+        times, so ranks with nothing left to write should call finish instead of returning.
+
+        Args:
+            chunks (dict): The (offset, buffer) tuple to write to each file, keyed by file name. Empty if this rank
+                has nothing to write this round.
+            chunk (tuple): The (start, end) range of points being written, to record in the journal.
+
+        Returns:
+            Nothing
+        """
+        self._write_files(chunks)
+
+        if self.manifest is not None:
+            self._add_to_manifest(chunks)
+
+        if chunk is not None:
+            checksum = 0
+            for key in sorted(chunks):
+                checksum = zlib.crc32(memoryview(chunks[key][1]).cast("B"), checksum)
+            self.completed.append((chunk[0], chunk[1], checksum))
+
+        if self.collective:
+            self.active_ranks = self.comm.allreduce(1 if len(chunks) > 0 else 0)
+        self.rounds += 1
+
+        if self.checkpoint_rounds is not None and self.rounds % self.checkpoint_rounds == 0:
+            self.checkpoint()
+
+    def finish(self) -> None:
+        """
+        Joins the remaining rounds with empty writes until every rank has run out of chunks. There are no rounds
+        in independent mode.
+
+        Returns:
+            Nothing
+        """
+        while self.collective and self.active_ranks > 0:
+            self.write({})
+
+    def sync(self) -> None:
+        """
+        Flushes the files to disk. In collective mode this is collective, so every rank must call it in the same
+        round. Otherwise it only flushes this rank's writes.
+
+        Returns:
+            Nothing
+        """
+        for handle in self.handles.values():
+            handle.Sync()
+
+    def _open_files(self, files: dict, info) -> dict:
+        """
+        Opens the output files on every rank. In independent mode each rank opens them on its own, so that it
+        can sync and close them without the other ranks.
+
+        Args:
+            files (dict): The output file paths keyed by name.
+            info (MPI.Info): The MPI-IO hints.
+
+        Returns:
+            The open files keyed by name.
+        """
+        from mpi4py import MPI
+
+        comm = self.comm if self.collective else MPI.COMM_SELF
+        return {key: MPI.File.Open(comm, path, amode=MPI.MODE_WRONLY | MPI.MODE_CREATE, info=info)
+                for key, path in files.items()}
+
+    def _write_files(self, chunks: dict) -> None:
+        """
+        Writes this rank's part of one round to the files.
+
+        Args:
+            chunks (dict): The (offset, buffer) tuple to write to each file, keyed by file name.
+
+        Returns:
+            Nothing
+        """
+        empty = np.zeros(0, dtype=np.float32)
+
+        for key, handle in self.handles.items():
+            offset, buffer = chunks.get(key, (0, empty))
+            if self.collective:
+                handle.Write_at_all(offset, buffer)
+            elif len(buffer) > 0:
+                handle.Write_at(offset, buffer)
+
+    def _add_to_manifest(self, chunks: dict) -> None:
+        """
+        Adds this rank's part of one round to its manifest.
+
+        Args:
+            chunks (dict): The (offset, buffer) tuple written to each file, keyed by file name.
+
+        Returns:
+            Nothing
+        """
+        for key, (offset, buffer) in chunks.items():
+            self.manifest.add(key, offset, buffer)
+
+    def checkpoint(self, final: bool=False) -> None:
+        """
+        Syncs the files and records the chunks written since the last checkpoint in the journal. In collective
+        mode this is collective, so every rank must call it in the same round. Otherwise each rank sends its
+        synced chunks to rank 0, which records those that have arrived at its own checkpoints.
+
+        Args:
+            final (bool): True for the checkpoint before the files are closed. In independent mode rank 0 then
+                waits for the final checkpoints of the other ranks.
+
+        Returns:
+            Nothing
+        """
+        from mpi4py import MPI
+
+        self.sync()
+
+        if self.collective:
+            completed = self.comm.gather(self.completed, root=0)
+        elif self.comm.Get_rank() == 0:
+            completed = [self.completed]
+            while self.unfinished_ranks > 0 and (final or self.comm.Iprobe(source=MPI.ANY_SOURCE,
+                                                                           tag=CHECKPOINT_TAG)):
+                rank_completed, rank_final = self.comm.recv(source=MPI.ANY_SOURCE, tag=CHECKPOINT_TAG)
+                completed.append(rank_completed)
+                if rank_final:
+                    self.unfinished_ranks -= 1
+        else:
+            self.requests.append(self.comm.isend((self.completed, final), dest=0, tag=CHECKPOINT_TAG))
+            completed = None
+        self.completed = []
+
+        if self.journal is not None and completed is not None:
+            for rank_completed in completed:
+                for unit in rank_completed:
+                    self.journal.record(*unit)
+            self.journal.commit()
+
+    def close(self) -> None:
+        """
+        Finishes the remaining rounds, then syncs and closes the files with a final checkpoint.
+
+        Returns:
+            Nothing
+        """
+        from mpi4py import MPI
+
+        if self.handles is not None:
+            self.finish()
+            self.checkpoint(final=True)
+            self._close_files()
+            self.handles = None
+            MPI.Request.waitall(self.requests)
+            self.requests = []
+
+    def _close_files(self) -> None:
+        """
+        Closes the files on every rank.
+
+        Returns:
+            Nothing
+        """
+        for handle in self.handles.values():
+            handle.Close()
+
+
+class HDF5MeshWriter:
+    """
+    Writes mesh chunks to an HDF5 mesh. The mesh has a Vp, Vs, and density dataset, each a (z, y, x) array of
+    32-bit floats stored in compressed chunks, with the mesh geometry stored as attributes of the file. Chunks are
+    given as ranges of points in AWP order, which is the row-major order of the datasets, so any range of points
+    can be written. An existing mesh is written into, so that a mesh can be extracted a few slices at a time.
+    """
+
+    def __init__(self, path: str, information: dict, manifest=None):
+        """
+        Opens the HDF5 mesh, creating it if needed.
+
+        Args:
+            path (str): The path to the .h5 file.
+            information (dict): The mesh information dictionary (from the XML config file).
+            manifest (MeshManifest): The manifest to record the written chunks in, if any. Chunks are recorded at
+                the offset their points would have in an AWP mesh.
+        """
+        self.file = h5py.File(path, "a", rdcc_nbytes=HDF5_CACHE_SIZE, rdcc_nslots=HDF5_CACHE_SLOTS)
+        self.datasets = create_hdf5_datasets(self.file, information)
+        self.manifest = manifest
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, start: int, values: np.ndarray) -> None:
+        """
+        Writes a range of points.
+
+        Args:
+            start (int): The index of the first point.
+            values (np.ndarray): The (n, 3) array of the Vp, Vs, and density of each point.
+
+        Returns:
+            Nothing
+        """
+        shape = self.datasets[0].shape
+        for offset, (z_range, y_range, x_range) in get_hdf5_hyperslabs(start, start + len(values), shape):
+            block = values[offset:offset + (z_range[1] - z_range[0]) * (y_range[1] - y_range[0]) *
+                           (x_range[1] - x_range[0])]
+            block_shape = (z_range[1] - z_range[0], y_range[1] - y_range[0], x_range[1] - x_range[0])
+            for index, dataset in enumerate(self.datasets):
+                dataset[z_range[0]:z_range[1], y_range[0]:y_range[1], x_range[0]:x_range[1]] = \
+                    block[:, index].reshape(block_shape)
+
+        if self.manifest is not None:
+            self.manifest.add("hdf5", start * 12, values)
+
+    def close(self) -> None:
+        """
+        Flushes and closes the file.
+
+        Returns:
+            Nothing
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class MPIHDF5MeshWriter(MPIMeshWriter):
+    """
+    Writes an HDF5 mesh from every MPI rank in rounds, like MPIMeshWriter. Parallel HDF5 can only write compressed
+    datasets collectively, so every round is a collective write in which each rank selects the hyperslabs of its
+    chunk, or nothing. This needs h5py built against a parallel HDF5 library.
+    """
+
+    def __init__(self, path: str, information: dict, aggregators: int=None, stripe_size: int=None, journal=None,
+                 checkpoint_rounds: int=None, manifest=None):
+        """
+        Opens, and if needed creates, the HDF5 mesh on every rank.
+
+        Args:
+            path (str): The path to the .h5 file.
+            information (dict): The mesh information dictionary (from the XML config file).
+            aggregators (int): The number of ranks that gather and write the data. By default MPI-IO decides.
+            stripe_size (int): The file system stripe size in bytes. Collective buffers are made this size.
+            journal (ExtractionJournal): The journal in which rank 0 records the completed chunks. None on the
+                other ranks.
+            checkpoint_rounds (int): The number of rounds between checkpoints. Must be the same on every rank.
+            manifest (MeshManifest): This rank's manifest, to record its chunks in, if any.
+        """
+        if not h5py.get_config().mpi:
+            raise ValueError("HDF5 meshes can only be extracted with MPI if h5py is built with parallel HDF5.")
+
+        self.information = information
+        self.datasets = None
+        self.transfer = None
+        super().__init__({"hdf5": path}, collective=True, aggregators=aggregators, stripe_size=stripe_size,
+                         journal=journal, checkpoint_rounds=checkpoint_rounds, manifest=manifest)
+
+    def sync(self) -> None:
+        """
+        Flushes the file to disk. This is collective, so every rank must call it in the same round.
+
+        Returns:
+            Nothing
+        """
+        self.handles["hdf5"].flush()
+
+    def _close_files(self) -> None:
+        """
+        Closes the file on every rank.
+
+        Returns:
+            Nothing
+        """
+        self.handles["hdf5"].close()
+
+    def _add_to_manifest(self, chunks: dict) -> None:
+        """
+        Adds this rank's part of one round to its manifest, at the offset the points would have in an AWP mesh.
+
+        Args:
+            chunks (dict): The first point and the (n, 3) array of values written, keyed by "hdf5".
+
+        Returns:
+            Nothing
+        """
+        for key, (start, values) in chunks.items():
+            self.manifest.add(key, start * 12, values)
+
+    def _open_files(self, files: dict, info) -> dict:
+        """
+        Opens the HDF5 mesh with the MPI-IO driver and creates its datasets if needed.
+
+        Args:
+            files (dict): The path to the mesh keyed by "hdf5".
+            info (MPI.Info): The MPI-IO hints.
+
+        Returns:
+            The open file keyed by "hdf5".
+        """
+        handle = h5py.File(files["hdf5"], "a", driver="mpio", comm=self.comm, info=info)
+        self.datasets = create_hdf5_datasets(handle, self.information)
+
+        self.transfer = h5py.h5p.create(h5py.h5p.DATASET_XFER)
+        self.transfer.set_dxpl_mpio(h5py.h5fd.MPIO_COLLECTIVE)
+
+        return {"hdf5": handle}
+
+    def _write_files(self, chunks: dict) -> None:
+        """
+        Writes this rank's part of one round, a (start, values) tuple keyed by "hdf5", collectively.
+
+        Args:
+            chunks (dict): The first point and the (n, 3) array of values to write, keyed by "hdf5".
+
+        Returns:
+            Nothing
+        """
+        start, values = chunks.get("hdf5", (0, np.zeros((0, 3), dtype=np.float32)))
+        shape = self.datasets[0].shape
+
+        for index, dataset in enumerate(self.datasets):
+            file_space = dataset.id.get_space()
+            file_space.select_none()
+            for _, (z_range, y_range, x_range) in get_hdf5_hyperslabs(start, start + len(values), shape):
+                file_space.select_hyperslab((z_range[0], y_range[0], x_range[0]),
+                                            (z_range[1] - z_range[0], y_range[1] - y_range[0],
+                                             x_range[1] - x_range[0]), op=h5py.h5s.SELECT_OR)
+
+            # HDF5 copies the selected points in row-major order, which is the order of the values.
+            column = np.ascontiguousarray(values[:, index]) if len(values) > 0 else np.zeros(1, dtype=np.float32)
+            memory_space = h5py.h5s.create_simple((len(column),))
+            if len(values) == 0:
+                memory_space.select_none()
+
+            dataset.id.write(memory_space, file_space, column, dxpl=self.transfer)
+
+
+class HDF5MeshReader:
+    """
+    Reads the nodes of an HDF5 mesh by their index in AWP order, as an (n, 3) array of the Vp, Vs, and density, so
+    that it can stand in for a memory-mapped AWP mesh. Each compressed chunk is decompressed once and the most
+    recently used chunks are kept in memory, so queries that fall in the same part of the mesh read little.
+    """
+
+    def __init__(self, path: str, cache_size: int):
+        """
+        Opens the mesh.
+
+        Args:
+            path (str): The path to the .h5 file.
+            cache_size (int): The memory, in bytes, to use for decompressed chunks.
+        """
+        self.file = h5py.File(path, "r")
+        self.datasets = [self.file[name] for name in HDF5_DATASETS]
+        self.dims = self.datasets[0].shape
+        self.chunk_shape = self.datasets[0].chunks or self.dims
+        self.chunk_counts = tuple(int(math.ceil(dim / chunk)) for dim, chunk in zip(self.dims, self.chunk_shape))
+        self.shape = (self.dims[0] * self.dims[1] * self.dims[2], len(HDF5_DATASETS))
+        self.ndim = 2
+        self.cache = OrderedDict()
+        self.max_chunks = max(1, cache_size // (int(np.prod(self.chunk_shape)) * 4 * len(HDF5_DATASETS)))
+
+    def __getitem__(self, key) -> np.ndarray:
+        """
+        Reads the nodes at an array or slice of AWP indices.
+
+        Args:
+            key: The indices, as an integer array or a slice.
+
+        Returns:
+            The (n, 3) array of 32-bit floats.
+        """
+        if isinstance(key, slice):
+            indices = np.arange(*key.indices(self.shape[0]), dtype=np.int64)
+        else:
+            indices = np.asarray(key, dtype=np.int64).reshape(-1)
+
+        z_val, remainder = np.divmod(indices, self.dims[1] * self.dims[2])
+        y_val, x_val = np.divmod(remainder, self.dims[2])
+        chunk_ids = ((z_val // self.chunk_shape[0]) * self.chunk_counts[1] + y_val // self.chunk_shape[1]) * \
+            self.chunk_counts[2] + x_val // self.chunk_shape[2]
+
+        values = np.empty((len(indices), len(HDF5_DATASETS)), dtype=np.float32)
+        order = np.argsort(chunk_ids, kind="stable")
+        unique_ids, starts = np.unique(chunk_ids[order], return_index=True)
+
+        for chunk_id, group in zip(unique_ids.tolist(), np.split(order, starts[1:])):
+            origin, block = self._get_chunk(chunk_id)
+            values[group] = block[:, z_val[group] - origin[0], y_val[group] - origin[1],
+                                  x_val[group] - origin[2]].T
+
+        return values
+
+    def close(self) -> None:
+        """
+        Closes the file and empties the cache.
+
+        Returns:
+            Nothing
+        """
+        self.cache.clear()
+        self.file.close()
+
+    def _get_chunk(self, chunk_id: int) -> (tuple, np.ndarray):
+        """
+        Returns one decompressed chunk of all the datasets, reading it if it is not in the cache.
+
+        Args:
+            chunk_id (int): The chunk number, in row-major order of the chunks.
+
+        Returns:
+            The (z, y, x) index of the chunk's first node, and the (3, z, y, x) array of its values.
+        """
+        if chunk_id in self.cache:
+            self.cache.move_to_end(chunk_id)
+            return self.cache[chunk_id]
+
+        chunk_yx, chunk_x = divmod(chunk_id, self.chunk_counts[2])
+        chunk_z, chunk_y = divmod(chunk_yx, self.chunk_counts[1])
+        origin = (chunk_z * self.chunk_shape[0], chunk_y * self.chunk_shape[1], chunk_x * self.chunk_shape[2])
+        selection = tuple(slice(start, min(start + size, dim))
+                          for start, size, dim in zip(origin, self.chunk_shape, self.dims))
+
+        self.cache[chunk_id] = (origin, np.stack([dataset[selection] for dataset in self.datasets]))
+        while len(self.cache) > self.max_chunks:
+            self.cache.popitem(last=False)
+
+        return self.cache[chunk_id]
+
+
+def create_hdf5_datasets(handle: h5py.File, information: dict) -> list:
+    """
+    Creates the datasets and geometry attributes of an HDF5 mesh, or checks that an existing mesh has the same
+    dimensions. With parallel HDF5 every rank must call this.
+
+    Args:
+        handle (h5py.File): The open mesh file.
+        information (dict): The mesh information dictionary (from the XML config file).
+
+    Returns:
+        The list of the Vp, Vs, and density datasets.
+    """
+    shape = (int(information["dimensions"]["z"]), int(information["dimensions"]["y"]),
+             int(information["dimensions"]["x"]))
+
+    if HDF5_DATASETS[0] in handle:
+        if handle[HDF5_DATASETS[0]].shape != shape:
+            raise ValueError("The existing HDF5 mesh " + handle.filename + " has dimensions " +
+                             str(handle[HDF5_DATASETS[0]].shape) + " rather than " + str(shape) + ".")
+        return [handle[name] for name in HDF5_DATASETS]
+
+    datasets = [
+        handle.create_dataset(name, shape=shape, dtype="<f4", fillvalue=np.nan,
+                              chunks=tuple(min(chunk, dim) for chunk, dim in zip(HDF5_CHUNK_SHAPE, shape)),
+                              compression=HDF5_COMPRESSION, compression_opts=HDF5_COMPRESSION_LEVEL, shuffle=True)
+        for name in HDF5_DATASETS
+    ]
+
+    datasets[0].attrs["units"] = "m/s"
+    datasets[1].attrs["units"] = "m/s"
+    datasets[2].attrs["units"] = "kg/m^3"
+
+    handle.attrs["axes"] = "z, y, x"
+    handle.attrs["origin"] = [float(information["initial_point"][key]) for key in ("x", "y", "z")]
+    handle.attrs["origin_projection"] = str(information["initial_point"]["projection"])
+    handle.attrs["depth_elev"] = str(information["initial_point"]["depth_elev"])
+    handle.attrs["projection"] = str(information["projection"])
+    handle.attrs["rotation"] = float(information["rotation"])
+    handle.attrs["spacing"] = float(information["spacing"])
+    handle.attrs["z_offsets"] = get_z_offsets(information, shape[0], float(information["spacing"]))
+    handle.attrs["grid_type"] = str(information["grid_type"])
+    handle.attrs["cvm_list"] = str(information["cvm_list"])
+    handle.attrs["configuration"] = xmltodict.unparse({"root": information}, pretty=True)
+
+    return datasets
+
+
+def read_hdf5_points(datasets: list, start: int, end: int) -> np.ndarray:
+    """
+    Reads a range of points of an HDF5 mesh, in AWP order, the way they were given to the writer.
+
+    Args:
+        datasets (list): The Vp, Vs, and density datasets.
+        start (int): The index of the first point.
+        end (int): The index after the last point.
+
+    Returns:
+        The (n, 3) array of 32-bit floats.
+    """
+    values = np.empty((end - start, len(datasets)), dtype=np.float32)
+    for offset, (z_range, y_range, x_range) in get_hdf5_hyperslabs(start, end, datasets[0].shape):
+        for index, dataset in enumerate(datasets):
+            block = dataset[z_range[0]:z_range[1], y_range[0]:y_range[1], x_range[0]:x_range[1]]
+            values[offset:offset + block.size, index] = block.reshape(-1)
+    return values
+
+
+def get_hdf5_hyperslabs(start: int, end: int, shape: tuple):
+    """
+    Splits a range of points in AWP order into the few (z, y, x) boxes that make it up: a part row, whole rows to
+    the end of the slice, whole slices, whole rows, and a part row.
+
+    Args:
+        start (int): The index of the first point.
+        end (int): The end of the range, exclusive.
+        shape (tuple): The (z, y, x) shape of the mesh.
+
+    Returns:
+        A generator of (offset, ((z0, z1), (y0, y1), (x0, x1))) tuples, where offset is the position of the box's
+        first point within the range.
+    """
+    num_y, num_x = shape[1], shape[2]
+    slice_size = num_y * num_x
+    position = start
+
+    while position < end:
+        z_val, remainder = divmod(position, slice_size)
+        y_val, x_val = divmod(remainder, num_x)
+        left = end - position
+
+        if x_val != 0 or left < num_x:
+            count = min(num_x - x_val, left)
+            box = ((z_val, z_val + 1), (y_val, y_val + 1), (x_val, x_val + count))
+        elif y_val != 0 or left < slice_size:
+            rows = min(num_y - y_val, left // num_x)
+            count = rows * num_x
+            box = ((z_val, z_val + 1), (y_val, y_val + rows), (0, num_x))
+        else:
+            slices = left // slice_size
+            count = slices * slice_size
+            box = ((z_val, z_val + slices), (0, num_y), (0, num_x))
+
+        yield position - start, box
+        position += count
+
+
+class MeshQA:
+    """
+    The post-processing stage of mesh extraction. Each chunk of queried points is converted to arrays in one pass,
+    then the minimum Vs and Vp are applied, the Vp/Vs ratios are checked, and missing material properties are
+    filled with NaN, all with array operations. Rather than printing a line for every affected point, the counts,
+    the minimum and maximum of each property, and a histogram of Vs are added up over the whole extraction and
+    written out once as a report. QA objects from different processes can be merged.
+    """
+
+    #: np.ndarray: The Vs histogram bin edges in m/s. The last bin holds everything above 8000 m/s.
+    VS_HISTOGRAM_EDGES = np.append(np.arange(0, 8001, 250, dtype=np.float64), np.inf)
+    #: list: The categories of affected points that are counted (and whose indices can be kept).
+    CATEGORIES = ["missing", "vs_floor", "low_ratio"]
+    #: dict: The lowest acceptable Vp/Vs ratio of each mesh format, and how it is printed. RWG meshes have always
+    #: been checked against 1.45, and the other formats against sqrt(2).
+    MIN_VP_VS_RATIOS = {"awp": (math.sqrt(2), "sqrt(2)"), "hdf5": (math.sqrt(2), "sqrt(2)"), "rwg": (1.45, "1.45")}
+
+    def __init__(self, minimums: dict, keep_indices: bool=False, mesh_format: str="awp"):
+        """
+        Sets up an empty QA summary.
+
+        Args:
+            minimums (dict): The mesh's "vp" and "vs" minimums.
+            keep_indices (bool): True to keep the mesh indices of every affected point, so they can be dumped.
+            mesh_format (str): The format of the mesh (awp, rwg, or hdf5), which sets the minimum Vp/Vs ratio.
+        """
+        self.minimums = {"vp": float(minimums["vp"]), "vs": float(minimums["vs"])}
+        self.min_ratio, self.min_ratio_name = self.MIN_VP_VS_RATIOS[mesh_format]
+        self.keep_indices = keep_indices
+        self.points = 0
+        self.counts = {category: 0 for category in self.CATEGORIES}
+        self.indices = {category: [] for category in self.CATEGORIES}
+        self.minimum = np.full(3, np.inf)
+        self.maximum = np.full(3, -np.inf)
+        self.histogram = np.zeros(len(self.VS_HISTOGRAM_EDGES) - 1, dtype=np.int64)
+
+    def process(self, sd_array: List[SeismicData], start: int, indices: np.ndarray=None) -> np.ndarray:
+        """
+        Post-processes one chunk of queried points.
+
+        Args:
+            sd_array (list): The queried SeismicData objects of the chunk.
+            start (int): The mesh index of the first point in the chunk.
+            indices (np.ndarray): The mesh index of each point, for chunks that are not a run of consecutive points
+                (such as the columns of a column-ordered extraction). Only needed when indices are kept.
+
+        Returns:
+            An (n, 3) array of the Vp, Vs, and density of each point, with the minimums applied and NaN for
+            anything missing.
+        """
+        values = np.array([
+            (s.velocity_properties.vp, s.velocity_properties.vs, s.velocity_properties.density)
+            if s.velocity_properties is not None else (None, None, None) for s in sd_array
+        ], dtype=np.float64).reshape(-1, 3)
+
+        masks = {"missing": np.isnan(values).any(axis=1)}
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            masks["vs_floor"] = values[:, 1] < self.minimums["vs"]
+            values[masks["vs_floor"], 0] = self.minimums["vp"]
+            values[masks["vs_floor"], 1] = self.minimums["vs"]
+            masks["low_ratio"] = values[:, 0] / values[:, 1] < self.min_ratio
+
+        self.points += len(values)
+        for category in self.CATEGORIES:
+            self.counts[category] += int(np.count_nonzero(masks[category]))
+            if self.keep_indices and masks[category].any():
+                self.indices[category].append(start + np.flatnonzero(masks[category]) if indices is None
+                                              else indices[masks[category]])
+
+        if not masks["missing"].all():
+            present = values[~masks["missing"]]
+            self.minimum = np.minimum(self.minimum, present.min(axis=0))
+            self.maximum = np.maximum(self.maximum, present.max(axis=0))
+            self.histogram += np.histogram(present[:, 1], bins=self.VS_HISTOGRAM_EDGES)[0]
+
+        return values
+
+    def merge(self, other: "MeshQA") -> None:
+        """
+        Adds another QA summary, for example from another process, to this one.
+
+        Args:
+            other (MeshQA): The summary to add.
+
+        Returns:
+            Nothing
+        """
+        self.points += other.points
+        for category in self.CATEGORIES:
+            self.counts[category] += other.counts[category]
+            self.indices[category] += other.indices[category]
+        self.minimum = np.minimum(self.minimum, other.minimum)
+        self.maximum = np.maximum(self.maximum, other.maximum)
+        self.histogram += other.histogram
+
+    def summary(self) -> str:
+        """
+        Returns a short summary of the affected points, for printing.
+
+        Returns:
+            The summary string.
+        """
+        return "%s points had no material properties, %s had Vs raised to the minimum, and %s had a Vp/Vs " \
+               "ratio of less than %s." % (humanize.intcomma(self.counts["missing"]),
+                                           humanize.intcomma(self.counts["vs_floor"]),
+                                           humanize.intcomma(self.counts["low_ratio"]), self.min_ratio_name)
+
+    def write_report(self, path: str) -> None:
+        """
+        Writes the full QA report, and if the indices were kept, dumps them to a .npz file with the same name.
+
+        Args:
+            path (str): The path of the report, e.g. [mesh_name]_qa.txt.
+
+        Returns:
+            Nothing
+        """
+        with open(path, "w") as fd:
+            fd.write("Points extracted: %d\n" % self.points)
+            fd.write("No material properties (written as NaN): %d\n" % self.counts["missing"])
+            fd.write("Vs below the minimum of %.4f (raised to Vp %.4f, Vs %.4f): %d\n" % (
+                self.minimums["vs"], self.minimums["vp"], self.minimums["vs"], self.counts["vs_floor"]
+            ))
+            fd.write("Vp/Vs ratio below %s: %d\n\n" % (self.min_ratio_name, self.counts["low_ratio"]))
+
+            fd.write("%-12s%-16s%-16s\n" % ("Property", "Minimum", "Maximum"))
+            for i, name in enumerate(["Vp", "Vs", "Density"]):
+                if self.minimum[i] <= self.maximum[i]:
+                    fd.write("%-12s%-16.4f%-16.4f\n" % (name, self.minimum[i], self.maximum[i]))
+                else:
+                    fd.write("%-12s%-16s%-16s\n" % (name, "N/A", "N/A"))
+
+            fd.write("\nVs histogram (m/s)\n")
+            for i in range(len(self.histogram)):
+                fd.write("%8.0f - %-8.0f%d\n" % (self.VS_HISTOGRAM_EDGES[i], self.VS_HISTOGRAM_EDGES[i + 1],
+                                                  self.histogram[i]))
+
+        if self.keep_indices:
+            np.savez(os.path.splitext(path)[0] + "_indices.npz", **{
+                category: np.sort(np.concatenate(self.indices[category])) if len(self.indices[category]) > 0
+                else np.zeros(0, dtype=np.int64) for category in self.CATEGORIES
+            })
+
+
+def get_z_offsets(mesh_info: dict, num_z: int, spacing: float) -> np.ndarray:
+    """
+    Returns the distance of each z slice of a mesh from its first slice. By default the slices are the
+    horizontal spacing apart. A z_spacing element instead divides the mesh into layers from the top down, each
+    with a number of slices and the spacing below each of those slices, so that the shallow, slow layers can be
+    sampled more finely than the deep ones:
+
+        <z_spacing>
+            <layer><count>40</count><spacing>25</spacing></layer>
+            <layer><count>60</count><spacing>100</spacing></layer>
+        </z_spacing>
+
+    Args:
+        mesh_info (dict): The mesh info parsed from the XML file.
+        num_z (int): The number of z slices.
+        spacing (float): The horizontal spacing of the mesh.
+
+    Returns:
+        The array of num_z distances, starting at 0.
+    """
+    if mesh_info.get("z_spacing") is None:
+        return np.arange(num_z, dtype=np.float64) * spacing
+
+    layers = mesh_info["z_spacing"]["layer"]
+    if isinstance(layers, dict):
+        layers = [layers]
+
+    gaps = np.concatenate([np.full(int(layer["count"]), float(layer["spacing"])) for layer in layers])
+    if len(gaps) != num_z:
+        raise ValueError("The z_spacing layers have " + str(len(gaps)) + " slices but the mesh has " +
+                         str(num_z) + ".")
+    if np.any(gaps <= 0):
+        raise ValueError("The z_spacing of each layer must be positive.")
+
+    return np.concatenate(([0.0], np.cumsum(gaps[:-1])))
+
+
+def get_mesh_blocks(information: dict) -> List[dict]:
+    """
+    Splits a discontinuous mesh into its blocks. The mesh information itself describes the top block, and each
+    block in its blocks element lies below the one before it, over the same area, with its own spacing:
+
+        <blocks>
+            <block>
+                <spacing>300</spacing>                      <!-- horizontal (and default vertical) spacing -->
+                <dimensions><z>50</z></dimensions>          <!-- x and y default to the area of the top block -->
+                <overlap>1</overlap>                        <!-- slices shared with the block above -->
+            </block>
+        </blocks>
+
+    A block may also have its own z_spacing. Each block is an ordinary mesh named [mesh_name]_block[n]. A mesh
+    without blocks is returned as it is.
+
+    Args:
+        information (dict): The mesh information dictionary (from the XML config file).
+
+    Returns:
+        The list of the mesh information dictionaries of the blocks, from the top down.
+    """
+    if information.get("blocks") is None:
+        return [information]
+
+    if information["format"] not in ("awp", "hdf5"):
+        raise ValueError("Discontinuous meshes can only be extracted in the AWP or HDF5 formats.")
+
+    blocks = information["blocks"]["block"]
+    if isinstance(blocks, dict):
+        blocks = [blocks]
+
+    top = copy.deepcopy(information)
+    del top["blocks"]
+    top["mesh_name"] = information["mesh_name"] + "_block1"
+
+    elevation = str(top["initial_point"]["depth_elev"]).strip().lower() in ("elevation", str(UCVM_ELEVATION))
+    spacing = float(top["spacing"])
+    dims = {key: int(top["dimensions"][key]) for key in ("x", "y", "z")}
+    # The x and y extent of the top block, which every block covers.
+    extent = {key: (dims[key] - (0 if top["grid_type"] == "center" else 1)) * spacing for key in ("x", "y")}
+
+    mesh_blocks = [top]
+    bottom = float(get_z_offsets(top, dims["z"], spacing)[-1])
+
+    for number, block in enumerate(blocks, start=2):
+        block_info = copy.deepcopy(top)
+        block_info["mesh_name"] = information["mesh_name"] + "_block" + str(number)
+        block_info["spacing"] = block["spacing"]
+        block_info["z_spacing"] = block.get("z_spacing")
+        if block_info["z_spacing"] is None:
+            del block_info["z_spacing"]
+
+        block_spacing = float(block["spacing"])
+        block_dims = block.get("dimensions") or {}
+        for key in ("x", "y"):
+            block_info["dimensions"][key] = int(block_dims[key]) if block_dims.get(key) is not None else \
+                int(math.floor(extent[key] / block_spacing + 1e-9)) + (0 if top["grid_type"] == "center" else 1)
+        block_info["dimensions"]["z"] = int(block_dims["z"])
+
+        offsets = get_z_offsets(block_info, int(block_info["dimensions"]["z"]), block_spacing)
+        gap = float(offsets[1]) if len(offsets) > 1 else block_spacing
+        depth = bottom + gap * (1 - int(block.get("overlap") or 0))
+        block_info["initial_point"]["z"] = float(information["initial_point"]["z"]) + (-depth if elevation else depth)
+
+        bottom = depth + float(offsets[-1])
+        mesh_blocks.append(block_info)
+
+    return mesh_blocks
+
+
+def write_mesh_blocks(information: dict, mesh_blocks: List[dict]) -> str:
+    """
+    Writes the configuration file of each block of a discontinuous mesh, so that each can be read or extracted
+    on its own, and the descriptor, [mesh_name]_blocks.xml, that lists the blocks from the top down with their
+    spacing, dimensions, and the depths of their first and last slices below the top of the mesh.
+
+    Args:
+        information (dict): The mesh information dictionary (from the XML config file).
+        mesh_blocks (list): The blocks, as returned by get_mesh_blocks.
+
+    Returns:
+        The path to the descriptor.
+    """
+    origin_z = float(information["initial_point"]["z"])
+    descriptor = []
+    for block_info in mesh_blocks:
+        with open(os.path.join(block_info["out_dir"], block_info["mesh_name"] + ".xml"), "w") as fd:
+            fd.write(xmltodict.unparse({"root": block_info}, pretty=True))
+
+        top = abs(float(block_info["initial_point"]["z"]) - origin_z)
+        offsets = get_z_offsets(block_info, int(block_info["dimensions"]["z"]), float(block_info["spacing"]))
+        descriptor.append(OrderedDict([
+            ("mesh_name", block_info["mesh_name"]),
+            ("configuration", block_info["mesh_name"] + ".xml"),
+            ("spacing", block_info["spacing"]),
+            ("dimensions", block_info["dimensions"]),
+            ("top", top),
+            ("bottom", top + float(offsets[-1]))
+        ]))
+
+    path = os.path.join(information["out_dir"], information["mesh_name"] + "_blocks.xml")
+    with open(path, "w") as fd:
+        fd.write(xmltodict.unparse({"root": OrderedDict([
+            ("mesh_name", information["mesh_name"]),
+            ("format", information["format"]),
+            ("blocks", {"block": descriptor})
+        ])}, pretty=True))
+
+    return path
+
+
+def get_aligned_chunk_size(chunk_size: int, point_size: int, stripe_size: int) -> int:
+    """
+    Rounds a chunk size down so that a chunk of that many points is a whole number of stripes, so that chunks
+    starting on a stripe boundary also end on one. Chunks are never made smaller than one aligned unit.
+
+    Args:
+        chunk_size (int): The desired number of points in a chunk.
+        point_size (int): The number of bytes written per point.
+        stripe_size (int): The stripe size in bytes.
+
+    Returns:
+        The aligned number of points per chunk.
+    """
+    unit = stripe_size // math.gcd(stripe_size, point_size)
+    return max(unit, chunk_size // unit * unit)
+
+
+def _get_projection(projection: str) -> pyproj.Proj:
+    """
+    Returns the pyproj projection for the given Proj.4 string, creating it only once.
+
+    Args:
+        projection (str): The Proj.4 string.
+
+    Returns:
+        The pyproj.Proj object.
+    """
+    if projection not in Point.loaded_projections:
+        Point.loaded_projections[projection] = pyproj.Proj(projection)
+    return Point.loaded_projections[projection]
+
+
+def _set_mesh_coordinates(iterator, x_val: np.ndarray, y_val: np.ndarray, z_point: np.ndarray,
+                          repeat: int=1) -> int:
+    """
+    Rotates and projects a chunk of mesh grid indices to longitude and latitude and writes the coordinates into
+    the first len(z_point) entries of the iterator's SeismicData array.
+
+    Args:
+        iterator (AWPInternalMeshIterator, RWGInternalMeshIterator, or ColumnInternalMeshIterator): The mesh
+            iterator.
+        x_val (np.ndarray): The x grid index of each point in the chunk, or of each column.
+        y_val (np.ndarray): The y grid index of each point in the chunk, or of each column.
+        z_point (np.ndarray): The depth or elevation of each point in the chunk.
+        repeat (int): The number of points in each column, when x_val and y_val are given per column. Each
+            column is then only rotated and projected once.
+
+    Returns:
+        The number of points in the chunk.
+    """
+    mesh = iterator.internal_mesh
+
+    x_val = x_val.astype(np.float64)
+    y_val = y_val.astype(np.float64)
+
+    if mesh.grid_type == "center":
+        x_val += 0.5
+        y_val += 0.5
+
+    # Rotate the whole chunk at once, then project it with one transform.
+    x_point = mesh.origin.x_value + (mesh.cos_angle * x_val - mesh.sin_angle * y_val) * mesh.spacing
+    y_point = mesh.origin.y_value + (mesh.sin_angle * x_val + mesh.cos_angle * y_val) * mesh.spacing
+
+    x_new, y_new = pyproj.transform(_get_projection(mesh.projection), _get_projection(UCVM_DEFAULT_PROJECTION),
+                                    x_point, y_point)
+
+    x_new = np.repeat(np.asarray(x_new, dtype=np.float64), repeat)
+    y_new = np.repeat(np.asarray(y_new, dtype=np.float64), repeat)
+
+    for datum, x_value, y_value, z_value in zip(iterator.init_array, x_new.tolist(), y_new.tolist(),
+                                                z_point.tolist()):
+        datum.original_point.x_value = x_value
+        datum.original_point.y_value = y_value
+        datum.original_point.z_value = z_value
+        datum.original_point.depth_elev = mesh.origin.depth_elev
+        datum.original_point.projection = UCVM_DEFAULT_PROJECTION
+
+    return len(z_point)
+
+
 class AWPInternalMeshIterator:
 
     def __init__(self, im: InternalMesh, start_point: int, end_point: int, num_at_a_time: int,
@@ -174,69 +1282,24 @@ class AWPInternalMeshIterator:
         return self
 
     def __next__(self) -> int:
-        internal_counter = 0
-
         if self.current_point >= self.end_point:
             raise StopIteration()
 
-        convert_array_x = []
-        convert_array_y = []
-
-        while internal_counter < self.num_at_a_time and self.current_point < self.end_point:
-            # Get our X, Y, and Z coordinates.
-            z_val = math.floor(self.current_point / self.internal_mesh.slice_size)
-            y_val = math.floor((self.current_point - z_val * self.internal_mesh.slice_size) /
-                               self.internal_mesh.num_x)
-            x_val = self.current_point - z_val * self.internal_mesh.slice_size - \
-                    y_val * self.internal_mesh.num_x
-
-            if self.internal_mesh.grid_type == "center":
-                x_val += 0.5
-                y_val += 0.5
-
-            x_point = self.internal_mesh.origin.x_value + (
-                self.internal_mesh.cos_angle * x_val - self.internal_mesh.sin_angle * y_val
-            ) * self.internal_mesh.spacing
-            y_point = self.internal_mesh.origin.y_value + (
-                self.internal_mesh.sin_angle * x_val + self.internal_mesh.cos_angle * y_val
-            ) * self.internal_mesh.spacing
-
-            if self.internal_mesh.origin.depth_elev == UCVM_ELEVATION:
-                z_point = (z_val * self.internal_mesh.spacing) - self.internal_mesh.origin.z_value
-            else:
-                z_point = (z_val * self.internal_mesh.spacing) + self.internal_mesh.origin.z_value
-
-            self.init_array[internal_counter].original_point.depth_elev = \
-                self.internal_mesh.origin.depth_elev
-            self.init_array[internal_counter].original_point.z_value = z_point
-            convert_array_x.append(x_point)
-            convert_array_y.append(y_point)
-            self.init_array[internal_counter].original_point.projection = \
-                self.internal_mesh.projection
-
-            internal_counter += 1
-            self.current_point += 1
-
-        if self.internal_mesh.projection in Point.loaded_projections:
-            in_proj = Point.loaded_projections[self.internal_mesh.projection]
-        else:
-            in_proj = pyproj.Proj(self.internal_mesh.projection)
-            Point.loaded_projections[self.internal_mesh.projection] = in_proj
+        # Get our X, Y, and Z coordinates. Z varies slowest, then Y, then X.
+        points = np.arange(self.current_point, min(self.current_point + self.num_at_a_time, self.end_point),
+                           dtype=np.int64)
+        z_val = points // self.internal_mesh.slice_size
+        y_val = (points - z_val * self.internal_mesh.slice_size) // self.internal_mesh.num_x
+        x_val = points - z_val * self.internal_mesh.slice_size - y_val * self.internal_mesh.num_x
 
-        if UCVM_DEFAULT_PROJECTION in Point.loaded_projections:
-            out_proj = Point.loaded_projections[UCVM_DEFAULT_PROJECTION]
+        if self.internal_mesh.origin.depth_elev == UCVM_ELEVATION:
+            z_point = self.internal_mesh.z_offsets[z_val] - self.internal_mesh.origin.z_value
         else:
-            out_proj = pyproj.Proj(UCVM_DEFAULT_PROJECTION)
-            Point.loaded_projections[UCVM_DEFAULT_PROJECTION] = out_proj
-
-        x_new, y_new = pyproj.transform(in_proj, out_proj, convert_array_x, convert_array_y)
+            z_point = self.internal_mesh.z_offsets[z_val] + self.internal_mesh.origin.z_value
 
-        for i in range(len(x_new)):
-            self.init_array[i].original_point.x_value = x_new[i]
-            self.init_array[i].original_point.y_value = y_new[i]
-            self.init_array[i].original_point.projection = UCVM_DEFAULT_PROJECTION
+        self.current_point += len(points)
 
-        return internal_counter
+        return _set_mesh_coordinates(self, x_val, y_val, z_point)
 
 
 class RWGInternalMeshIterator:
@@ -254,62 +1317,93 @@ class RWGInternalMeshIterator:
         return self
 
     def __next__(self) -> int:
-        internal_counter = 0
-
         if self.current_point >= self.end_point:
             raise StopIteration()
 
-        convert_array_x = []
-        convert_array_y = []
-
-        while internal_counter < self.num_at_a_time and self.current_point < self.end_point:
-            # Get our X, Y, and Z coordinates.
-            y_val = math.floor(self.current_point / self.internal_mesh.slice_size)
-            z_val = math.floor((self.current_point - y_val * self.internal_mesh.slice_size) /
-                               self.internal_mesh.num_x)
-            x_val = self.current_point - y_val * self.internal_mesh.slice_size - \
-                    z_val * self.internal_mesh.num_x
-
-            if self.internal_mesh.grid_type == "center":
-                x_val += 0.5
-                y_val += 0.5
-
-            x_point = self.internal_mesh.origin.x_value + (
-                self.internal_mesh.cos_angle * x_val - self.internal_mesh.sin_angle * y_val
-            ) * self.internal_mesh.spacing
-            y_point = self.internal_mesh.origin.y_value + (
-                self.internal_mesh.sin_angle * x_val + self.internal_mesh.cos_angle * y_val
-            ) * self.internal_mesh.spacing
-            z_point = z_val * self.internal_mesh.spacing
-
-            self.init_array[internal_counter].original_point.depth_elev = \
-                self.internal_mesh.origin.depth_elev
-            self.init_array[internal_counter].original_point.z_value = z_point
-            convert_array_x.append(x_point)
-            convert_array_y.append(y_point)
-            self.init_array[internal_counter].original_point.projection = \
-                self.internal_mesh.projection
-
-            internal_counter += 1
-            self.current_point += 1
-
-        if self.internal_mesh.projection in Point.loaded_projections:
-            in_proj = Point.loaded_projections[self.internal_mesh.projection]
+        # Get our X, Y, and Z coordinates. Y varies slowest, then Z, then X.
+        points = np.arange(self.current_point, min(self.current_point + self.num_at_a_time, self.end_point),
+                           dtype=np.int64)
+        y_val = points // self.internal_mesh.slice_size
+        z_val = (points - y_val * self.internal_mesh.slice_size) // self.internal_mesh.num_x
+        x_val = points - y_val * self.internal_mesh.slice_size - z_val * self.internal_mesh.num_x
+
+        z_point = self.internal_mesh.z_offsets[z_val]
+
+        self.current_point += len(points)
+
+        return _set_mesh_coordinates(self, x_val, y_val, z_point)
+
+
+class ColumnInternalMeshIterator:
+    """
+    Walks a mesh column by column rather than slice by slice. Each step takes a block of whole (x, y) columns,
+    either several whole rows of columns or part of one row, with as many points as will fit in num_at_a_time.
+    The points are ordered column by column, and each column is rotated and projected only once. Consecutive
+    points at the same position also let the models project them, and look up their elevation and Vs30, once
+    per column. The block is left in self.block as (y_start, y_end, x_start, x_end).
+    """
+
+    def __init__(self, im: InternalMesh, z_start: int, z_end: int, num_at_a_time: int,
+                 init_array: List[SeismicData]):
+        self.internal_mesh = im
+        self.z_start = z_start
+        self.z_end = z_end
+        self.current_column = 0
+        self.end_column = im.num_x * im.num_y
+        self.num_at_a_time = num_at_a_time
+        self.init_array = init_array
+        self.block = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> int:
+        if self.current_column >= self.end_column:
+            raise StopIteration()
+
+        mesh = self.internal_mesh
+        column_length = self.z_end - self.z_start
+        columns = max(1, self.num_at_a_time // column_length)
+        y_start, x_start = divmod(self.current_column, mesh.num_x)
+
+        # Take whole rows when at least one fits, otherwise as much of the current row as fits.
+        if x_start == 0 and columns >= mesh.num_x:
+            y_end = min(mesh.num_y, y_start + columns // mesh.num_x)
+            x_end = mesh.num_x
         else:
-            in_proj = pyproj.Proj(self.internal_mesh.projection)
-            Point.loaded_projections[self.internal_mesh.projection] = in_proj
+            y_end = y_start + 1
+            x_end = min(mesh.num_x, x_start + columns)
+
+        self.block = (y_start, y_end, x_start, x_end)
+        y_val, x_val = np.meshgrid(np.arange(y_start, y_end, dtype=np.int64),
+                                   np.arange(x_start, x_end, dtype=np.int64), indexing="ij")
 
-        if UCVM_DEFAULT_PROJECTION in Point.loaded_projections:
-            out_proj = Point.loaded_projections[UCVM_DEFAULT_PROJECTION]
+        # RWG meshes are always extracted by depth from the surface.
+        z_offsets = mesh.z_offsets[self.z_start:self.z_end]
+        if mesh.format == "rwg":
+            z_point = z_offsets
+        elif mesh.origin.depth_elev == UCVM_ELEVATION:
+            z_point = z_offsets - mesh.origin.z_value
         else:
-            out_proj = pyproj.Proj(UCVM_DEFAULT_PROJECTION)
-            Point.loaded_projections[UCVM_DEFAULT_PROJECTION] = out_proj
+            z_point = z_offsets + mesh.origin.z_value
 
-        x_new, y_new = pyproj.transform(in_proj, out_proj, convert_array_x, convert_array_y)
+        self.current_column = (y_end - 1) * mesh.num_x + x_end
 
-        for i in range(len(x_new)):
-            self.init_array[i].original_point.x_value = x_new[i]
-            self.init_array[i].original_point.y_value = y_new[i]
-            self.init_array[i].original_point.projection = UCVM_DEFAULT_PROJECTION
+        return _set_mesh_coordinates(self, x_val.reshape(-1), y_val.reshape(-1), np.tile(z_point, x_val.size),
+                                     repeat=column_length)
 
-        return internal_counter
+    def get_indices(self) -> np.ndarray:
+        """
+        Returns the mesh index, in the order of the output file, of each point of the current block.
+
+        Returns:
+            The array of indices, in the order the points were queried.
+        """
+        mesh = self.internal_mesh
+        y_start, y_end, x_start, x_end = self.block
+        y_val, x_val, z_val = np.meshgrid(np.arange(y_start, y_end, dtype=np.int64),
+                                          np.arange(x_start, x_end, dtype=np.int64),
+                                          np.arange(self.z_start, self.z_end, dtype=np.int64), indexing="ij")
+        if mesh.format == "rwg":
+            return (y_val * mesh.num_z * mesh.num_x + z_val * mesh.num_x + x_val).reshape(-1)
+        return (z_val * mesh.num_y * mesh.num_x + y_val * mesh.num_x + x_val).reshape(-1)
@@ -0,0 +1,177 @@
+"""
+Converts meshes between the AWP and RWG layouts without querying the models again.
+
+An AWP mesh is one file of interleaved Vp, Vs, and density values in m/s and kg/m^3, ordered
+(z, y, x) with x varying fastest. An RWG mesh is three files, one per property, in km/s and
+g/cm^3, ordered (y, z, x). Converting between the two swaps the two outermost axes and scales
+the values, which is done here in blocks that are read and written through memory maps, so the
+whole volume is read and written once in bounded memory.
+
+Copyright 2017 Southern California Earthquake Center
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# Python Imports
+import copy
+import multiprocessing
+import os
+from typing import List
+
+# Package Imports
+import humanize
+import numpy as np
+import psutil
+import xmltodict
+
+# UCVM Imports
+from ucvm.src.shared.constants import UCVM_ELEVATION
+from ucvm.src.framework.chunk_tuner import MAX_PERCENT_FREE
+
+RWG_EXTENSIONS = (".rwgvp", ".rwgvs", ".rwgdn")     #: tuple: The RWG files, in the order of the AWP properties.
+RWG_SCALE = 1000                                    #: int: AWP values are this many times the RWG values.
+BLOCK_COPIES = 3                                    #: int: The copies of a block held at once while converting it.
+
+
+def mesh_convert(information: dict, to_format: str, mesh_name: str=None, processes: int=1,
+                 memory_budget: int=None) -> dict:
+    """
+    Converts an existing AWP mesh to RWG or an RWG mesh to AWP. The converted mesh is written to the same output
+    directory, along with its configuration file.
+
+    Args:
+        information (dict): The configuration of the existing mesh.
+        to_format (str): The format to convert to, "awp" or "rwg".
+        mesh_name (str): The name of the converted mesh. By default the existing name followed by the new format.
+        processes (int): The number of processes that convert blocks at the same time.
+        memory_budget (int): The memory, in bytes, that each process may use for its block. By default a third of
+            the available memory, split between the processes.
+
+    Returns:
+        The configuration of the converted mesh.
+    """
+    from_format = information["format"]
+    if {from_format, to_format} != {"awp", "rwg"}:
+        raise ValueError("Meshes can only be converted from AWP to RWG or from RWG to AWP, not from %s to %s." %
+                         (from_format, to_format))
+
+    if memory_budget is None:
+        memory_budget = int(psutil.virtual_memory().available * MAX_PERCENT_FREE / processes)
+
+    if float(information["initial_point"]["z"]) != 0 or \
+       str(information["initial_point"]["depth_elev"]).strip().lower() in ("elevation", str(UCVM_ELEVATION)):
+        print("Warning: an RWG mesh is always extracted by depth from the surface, but this mesh does not start at "
+              "depth 0. The slices are converted one to one, so they keep the depths of the " + from_format.upper() +
+              " mesh.")
+
+    converted = copy.deepcopy(information)
+    converted["format"] = to_format
+    converted["mesh_name"] = mesh_name if mesh_name is not None else information["mesh_name"] + "_" + to_format
+
+    dims = (int(information["dimensions"]["z"]), int(information["dimensions"]["y"]),
+            int(information["dimensions"]["x"]))
+    awp_name = (information if from_format == "awp" else converted)["mesh_name"]
+    rwg_name = (information if from_format == "rwg" else converted)["mesh_name"]
+    paths = {
+        "awp": [os.path.join(information["out_dir"], awp_name + ".awp")],
+        "rwg": [os.path.join(information["out_dir"], rwg_name + extension) for extension in RWG_EXTENSIONS]
+    }
+
+    size = dims[0] * dims[1] * dims[2] * 4
+    for path in paths[to_format]:
+        with open(path, "wb") as fd:
+            fd.truncate(size * (3 if to_format == "awp" else 1))
+
+    blocks = get_conversion_blocks(dims, to_format, memory_budget)
+
+    print("\nConverting " + humanize.intcomma(dims[0] * dims[1] * dims[2]) + " grid points from " +
+          from_format.upper() + " to " + to_format.upper() + " in " + humanize.intcomma(len(blocks)) + " blocks "
+          "using " + str(processes) + " process(es).\n")
+
+    done = 0
+    if processes > 1:
+        with multiprocessing.get_context("fork").Pool(processes) as pool:
+            for count in pool.imap_unordered(_convert_blocks, [(paths, dims, to_format, blocks[i::processes])
+                                                               for i in range(processes)]):
+                done += count
+    else:
+        done = _convert_blocks((paths, dims, to_format, blocks))
+
+    with open(os.path.join(converted["out_dir"], converted["mesh_name"] + ".xml"), "w") as fd:
+        fd.write(xmltodict.unparse({"root": converted}, pretty=True))
+
+    print("Converted " + humanize.intcomma(done) + " grid points. The configuration of the converted mesh has "
+          "been written to " + os.path.join(converted["out_dir"], converted["mesh_name"] + ".xml") + ".")
+
+    return converted
+
+
+def get_conversion_blocks(dims: tuple, to_format: str, memory_budget: int) -> List[tuple]:
+    """
+    Splits the conversion into blocks that fit in the memory budget. Each block is a range of the outermost axis
+    of the converted mesh (y for RWG, z for AWP) and a range of the second axis, so that every block is written
+    as contiguous runs of the converted mesh.
+
+    Args:
+        dims (tuple): The (z, y, x) dimensions of the mesh.
+        to_format (str): The format being converted to, "awp" or "rwg".
+        memory_budget (int): The memory, in bytes, that one block may use.
+
+    Returns:
+        The list of ((outer_start, outer_end), (inner_start, inner_end)) blocks.
+    """
+    outer, inner = (dims[1], dims[0]) if to_format == "rwg" else (dims[0], dims[1])
+    row_bytes = dims[2] * 3 * 4 * BLOCK_COPIES
+
+    inner_size = max(1, min(inner, memory_budget // row_bytes))
+    outer_size = max(1, memory_budget // (row_bytes * inner)) if inner_size == inner else 1
+
+    return [((outer_start, min(outer_start + outer_size, outer)), (inner_start, min(inner_start + inner_size, inner)))
+            for outer_start in range(0, outer, outer_size) for inner_start in range(0, inner, inner_size)]
+
+
+def _convert_blocks(job: tuple) -> int:
+    """
+    Converts a list of blocks, reading and writing the meshes through memory maps. Internal method.
+
+    Args:
+        job (tuple): The (paths, dims, to_format, blocks) to convert, where paths holds the AWP file and the RWG
+            files, keyed by format.
+
+    Returns:
+        The number of grid points converted.
+    """
+    paths, dims, to_format, blocks = job
+
+    awp = np.memmap(paths["awp"][0], dtype="<f4", mode="r+" if to_format == "awp" else "r",
+                    shape=(dims[0], dims[1], dims[2], 3))
+    rwg = [np.memmap(path, dtype="<f4", mode="r+" if to_format == "rwg" else "r", shape=(dims[1], dims[0], dims[2]))
+           for path in paths["rwg"]]
+
+    count = 0
+    for (outer_start, outer_end), (inner_start, inner_end) in blocks:
+        if to_format == "rwg":
+            # Read the (z, y, x, property) block and write each property as (y, z, x).
+            block = np.asarray(awp[inner_start:inner_end, outer_start:outer_end]) / np.float32(RWG_SCALE)
+            for index, mesh in enumerate(rwg):
+                mesh[outer_start:outer_end, inner_start:inner_end] = block[..., index].transpose(1, 0, 2)
+        else:
+            block = np.stack([np.asarray(mesh[inner_start:inner_end, outer_start:outer_end]) for mesh in rwg],
+                             axis=-1) * np.float32(RWG_SCALE)
+            awp[outer_start:outer_end, inner_start:inner_end] = block.transpose(1, 0, 2, 3)
+        count += (outer_end - outer_start) * (inner_end - inner_start) * dims[2]
+
+    for mesh in [awp] + rwg:
+        if mesh.mode == "r+":
+            mesh.flush()
+
+    return count
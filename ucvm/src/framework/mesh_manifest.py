@@ -0,0 +1,408 @@
+"""
+Mesh checksum manifests.
+
+As a mesh is written, each chunk's CRC-32 and the minimum, maximum, sum, and NaN count of each of
+its properties are recorded. At the end of the extraction they are saved to a sidecar manifest,
+[mesh_name]_manifest.json, next to the mesh. A mesh can then be checked against its manifest by
+reading it once, in parallel and through memory maps. This confirms that every point was written
+and has not changed since, and gives the range of each property, without querying the models
+again.
+
+Copyright 2017 Southern California Earthquake Center
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# Python Imports
+import bisect
+import json
+import multiprocessing
+import os
+import zlib
+from typing import List
+
+# Package Imports
+import h5py
+import humanize
+import numpy as np
+
+# UCVM Imports
+from ucvm.src.framework.mesh_common import read_hdf5_points, HDF5_DATASETS
+
+MANIFEST_VERSION = 1                    #: int: The version of the manifest format.
+VERIFY_BATCH_SIZE = 256 * 1024 * 1024   #: int: The number of bytes each verification job reads.
+MAX_REPORTED_PROBLEMS = 20              #: int: The number of problems listed before the rest are only counted.
+
+#: dict: The properties stored in each mesh file, in the order they are interleaved, keyed by the file's name.
+FILE_PROPERTIES = {
+    "awp": ("vp", "vs", "density"),
+    "hdf5": ("vp", "vs", "density"),
+    "vp": ("vp",),
+    "vs": ("vs",),
+    "dn": ("density",)
+}
+
+
+class MeshManifest:
+    """
+    The checksums and statistics of the chunks written to a mesh. Each chunk is recorded as the file it was written
+    to, its byte offset and length within the file (within the uncompressed AWP-ordered points for HDF5 meshes), its
+    CRC-32, and the minimum, maximum, sum, and NaN count of each property. Keeping statistics per chunk means that
+    chunks can be replaced when part of a mesh is extracted again. Manifests from different processes can be merged.
+    """
+
+    def __init__(self, files: dict):
+        """
+        Sets up an empty manifest.
+
+        Args:
+            files (dict): The mesh file paths keyed by the names the chunks are written under.
+        """
+        self.files = {key: os.path.basename(path) for key, path in files.items()}
+        self.chunks = []
+        self.dimensions = None
+
+    def add(self, key: str, offset: int, buffer: np.ndarray) -> None:
+        """
+        Records one chunk as it is written.
+
+        Args:
+            key (str): The name of the file the chunk is written to.
+            offset (int): The byte offset of the chunk within the file.
+            buffer (np.ndarray): The values written, as 32-bit floats.
+
+        Returns:
+            Nothing
+        """
+        data = np.ascontiguousarray(buffer, dtype="<f4")
+        if data.size == 0:
+            return
+
+        values = data.reshape(-1, len(FILE_PROPERTIES[key]))
+        missing = np.isnan(values)
+        minimum = np.where(missing.all(axis=0), np.nan, np.where(missing, np.inf, values).min(axis=0))
+        maximum = np.where(missing.all(axis=0), np.nan, np.where(missing, -np.inf, values).max(axis=0))
+
+        self.chunks.append({
+            "file": key,
+            "offset": int(offset),
+            "bytes": data.nbytes,
+            "crc32": zlib.crc32(memoryview(data).cast("B")),
+            "min": _to_list(minimum),
+            "max": _to_list(maximum),
+            "sum": np.nansum(values, axis=0, dtype=np.float64).tolist(),
+            "nan": missing.sum(axis=0).tolist()
+        })
+
+    def merge(self, other: "MeshManifest") -> None:
+        """
+        Adds the chunks of another manifest of the same extraction, such as one kept by another process.
+
+        Args:
+            other (MeshManifest): The other manifest.
+
+        Returns:
+            Nothing
+        """
+        self.chunks.extend(other.chunks)
+
+    def get_statistics(self) -> dict:
+        """
+        Adds up the statistics of all the chunks, by property.
+
+        Returns:
+            A dictionary keyed by property of the point count, the minimum, maximum, and mean, and the NaN count.
+        """
+        statistics = {}
+        for chunk in self.chunks:
+            properties = FILE_PROPERTIES[chunk["file"]]
+            points = chunk["bytes"] // (4 * len(properties))
+            for index, name in enumerate(properties):
+                entry = statistics.setdefault(name, {"points": 0, "min": np.nan, "max": np.nan, "sum": 0.0,
+                                                     "nan": 0})
+                entry["points"] += points
+                entry["min"] = np.fmin(entry["min"], _from_none(chunk["min"][index]))
+                entry["max"] = np.fmax(entry["max"], _from_none(chunk["max"][index]))
+                entry["sum"] += chunk["sum"][index]
+                entry["nan"] += chunk["nan"][index]
+
+        for entry in statistics.values():
+            present = entry["points"] - entry["nan"]
+            entry["mean"] = entry["sum"] / present if present > 0 else np.nan
+
+        return statistics
+
+    def summary(self) -> str:
+        """
+        Returns the statistics of the mesh, one line per property, for printing.
+
+        Returns:
+            The summary as a string.
+        """
+        return "\n".join(
+            "    %-8s min %-12.6g max %-12.6g mean %-12.6g NaN %s of %s" % (
+                name, entry["min"], entry["max"], entry["mean"], humanize.intcomma(entry["nan"]),
+                humanize.intcomma(entry["points"])
+            ) for name, entry in self.get_statistics().items()
+        )
+
+    def save(self, path: str, information: dict) -> None:
+        """
+        Writes the manifest. If the mesh already has a manifest, for example because it is being extracted a few
+        slices at a time, the chunks recorded there that were not written over are kept.
+
+        Args:
+            path (str): The path to the manifest.
+            information (dict): The mesh information dictionary (from the XML config file).
+
+        Returns:
+            Nothing
+        """
+        dimensions = {key: int(information["dimensions"][key]) for key in ("x", "y", "z")}
+
+        if os.path.exists(path):
+            existing = MeshManifest.load(path)
+            if existing.files == self.files and existing.dimensions == dimensions:
+                # The chunks that this extraction wrote over are replaced.
+                written = {}
+                for chunk in sorted(self.chunks, key=lambda chunk: chunk["offset"]):
+                    ranges = written.setdefault(chunk["file"], [])
+                    if len(ranges) > 0 and chunk["offset"] <= ranges[-1][1]:
+                        ranges[-1] = (ranges[-1][0], max(ranges[-1][1], chunk["offset"] + chunk["bytes"]))
+                    else:
+                        ranges.append((chunk["offset"], chunk["offset"] + chunk["bytes"]))
+                self.chunks += [chunk for chunk in existing.chunks
+                                if not _overlaps(written.get(chunk["file"], []), chunk["offset"], chunk["bytes"])]
+
+        self.chunks.sort(key=lambda chunk: (chunk["file"], chunk["offset"]))
+
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "mesh_name": information["mesh_name"],
+            "format": information["format"],
+            "dimensions": dimensions,
+            "files": self.files,
+            "chunks": self.chunks
+        }
+
+        # Write the whole manifest before replacing the old one, so that it is never left half written.
+        with open(path + ".tmp", "w") as fd:
+            json.dump(manifest, fd)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path: str) -> "MeshManifest":
+        """
+        Reads a manifest.
+
+        Args:
+            path (str): The path to the manifest.
+
+        Returns:
+            The manifest.
+        """
+        with open(path, "r") as fd:
+            contents = json.load(fd)
+
+        if contents.get("version") != MANIFEST_VERSION:
+            raise ValueError("The manifest %s has an unsupported version." % path)
+
+        manifest = cls({})
+        manifest.files = contents["files"]
+        manifest.chunks = contents["chunks"]
+        manifest.dimensions = contents["dimensions"]
+        return manifest
+
+
+def get_manifest_path(information: dict) -> str:
+    """
+    Returns the path of the manifest of a mesh.
+
+    Args:
+        information (dict): The mesh information dictionary (from the XML config file).
+
+    Returns:
+        The path to [mesh_name]_manifest.json in the output directory.
+    """
+    return os.path.join(information["out_dir"], information["mesh_name"] + "_manifest.json")
+
+
+def verify_mesh(information: dict, processes: int=1) -> List[str]:
+    """
+    Checks a mesh against its manifest. The files must have the size of the mesh, the chunks in the manifest must
+    cover every file with no gaps, and the data of every chunk must still have its checksum. The chunks are read
+    by a pool of processes through memory maps.
+
+    Args:
+        information (dict): The mesh information dictionary (from the XML config file).
+        processes (int): The number of processes that read the mesh at the same time.
+
+    Returns:
+        The list of problems found. Empty if the mesh matches its manifest.
+    """
+    manifest = MeshManifest.load(get_manifest_path(information))
+    directory = information["out_dir"]
+    points = int(information["dimensions"]["x"]) * int(information["dimensions"]["y"]) * \
+        int(information["dimensions"]["z"])
+
+    problems = []
+    if manifest.dimensions != {key: int(information["dimensions"][key]) for key in ("x", "y", "z")}:
+        problems.append("The manifest was written for a mesh of dimensions %s." % manifest.dimensions)
+        return problems
+
+    for key, name in manifest.files.items():
+        path = os.path.join(directory, name)
+        size = points * 4 * len(FILE_PROPERTIES[key])
+        if not os.path.exists(path):
+            problems.append("%s does not exist." % name)
+        elif key != "hdf5" and os.path.getsize(path) != size:
+            problems.append("%s is %s bytes long rather than %s." % (name, humanize.intcomma(os.path.getsize(path)),
+                                                                      humanize.intcomma(size)))
+        else:
+            problems += _get_coverage_problems(manifest.chunks, key, name, size)
+
+    if len(problems) > 0:
+        return problems
+
+    batches = []
+    for key, name in manifest.files.items():
+        batch, batch_size = [], 0
+        for chunk in sorted((chunk for chunk in manifest.chunks if chunk["file"] == key),
+                            key=lambda chunk: chunk["offset"]):
+            batch.append(chunk)
+            batch_size += chunk["bytes"]
+            if batch_size >= VERIFY_BATCH_SIZE:
+                batches.append((os.path.join(directory, name), key, batch))
+                batch, batch_size = [], 0
+        if len(batch) > 0:
+            batches.append((os.path.join(directory, name), key, batch))
+
+    if processes > 1:
+        with multiprocessing.get_context("fork").Pool(processes) as pool:
+            for batch_problems in pool.imap_unordered(_verify_chunks, batches):
+                problems += batch_problems
+    else:
+        for batch in batches:
+            problems += _verify_chunks(batch)
+
+    return problems
+
+
+def _get_coverage_problems(chunks: List[dict], key: str, name: str, size: int) -> List[str]:
+    """
+    Checks that the chunks of one file cover it exactly once. Internal method.
+
+    Args:
+        chunks (list): All the chunks in the manifest.
+        key (str): The name the file's chunks are written under.
+        name (str): The file name, for the messages.
+        size (int): The size of the file in bytes.
+
+    Returns:
+        The list of gaps and overlaps, as messages.
+    """
+    point_size = 4 * len(FILE_PROPERTIES[key])
+    problems = []
+    current = 0
+
+    for chunk in sorted((chunk for chunk in chunks if chunk["file"] == key), key=lambda chunk: chunk["offset"]):
+        if chunk["offset"] > current:
+            problems.append("Points %d to %d of %s are not in the manifest." % (
+                current // point_size, chunk["offset"] // point_size - 1, name))
+        elif chunk["offset"] < current:
+            problems.append("Points %d to %d of %s were written more than once." % (
+                chunk["offset"] // point_size, min(current, chunk["offset"] + chunk["bytes"]) // point_size - 1, name))
+        current = max(current, chunk["offset"] + chunk["bytes"])
+
+    if current < size:
+        problems.append("Points %d to %d of %s are not in the manifest." % (
+            current // point_size, size // point_size - 1, name))
+
+    return problems
+
+
+def _verify_chunks(job: tuple) -> List[str]:
+    """
+    Checks the checksums of a batch of chunks of one file. Internal method.
+
+    Args:
+        job (tuple): The (path, key, chunks) to check.
+
+    Returns:
+        The list of chunks whose data does not match, as messages.
+    """
+    path, key, chunks = job
+    problems = []
+
+    if key == "hdf5":
+        # The checksum is of the (n, 3) values as written, so read them back the same way.
+        with h5py.File(path, "r") as handle:
+            datasets = [handle[name] for name in HDF5_DATASETS]
+            checksums = [zlib.crc32(memoryview(read_hdf5_points(datasets, chunk["offset"] // 12,
+                                                                (chunk["offset"] + chunk["bytes"]) // 12)).cast("B"))
+                         for chunk in chunks]
+    else:
+        data = np.memmap(path, dtype=np.uint8, mode="r")
+        checksums = [zlib.crc32(data[chunk["offset"]:chunk["offset"] + chunk["bytes"]]) for chunk in chunks]
+        del data
+
+    point_size = 4 * len(FILE_PROPERTIES[key])
+    for chunk, checksum in zip(chunks, checksums):
+        if checksum != chunk["crc32"]:
+            problems.append("Points %d to %d of %s do not match their checksum." % (
+                chunk["offset"] // point_size, (chunk["offset"] + chunk["bytes"]) // point_size - 1,
+                os.path.basename(path)))
+
+    return problems
+
+
+def _overlaps(ranges: List[tuple], offset: int, size: int) -> bool:
+    """
+    Returns True if a byte range overlaps any of a sorted list of separate ranges. Internal method.
+
+    Args:
+        ranges (list): The sorted, non-overlapping (start, end) ranges.
+        offset (int): The start of the range to check.
+        size (int): The length of the range to check.
+
+    Returns:
+        True if they overlap.
+    """
+    # The only range that can overlap is the last one that starts before the end of this one.
+    index = bisect.bisect_left(ranges, (offset + size,))
+    return index > 0 and ranges[index - 1][1] > offset
+
+
+def _to_list(values: np.ndarray) -> list:
+    """
+    Converts an array of floats to a list for JSON, with None for NaN. Internal method.
+
+    Args:
+        values (np.ndarray): The array.
+
+    Returns:
+        The list.
+    """
+    return [None if np.isnan(value) else float(value) for value in values]
+
+
+def _from_none(value) -> float:
+    """
+    Converts a value read from JSON back to a float, with NaN for None. Internal method.
+
+    Args:
+        value: The float or None.
+
+    Returns:
+        The float.
+    """
+    return np.nan if value is None else value
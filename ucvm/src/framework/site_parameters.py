@@ -0,0 +1,273 @@
+"""
+Site parameter query functions.
+
+Hazard codes need Vs30, Z1.0, Z2.5, and the surface elevation at the same set of sites. Querying the
+vs30-calc, z-calc, and DEM chains separately samples the same velocity column three times. The
+functions in this file sample each site's column once, in depth intervals shared across all the
+sites, and derive every requested site parameter from those shared samples.
+
+Copyright 2017 Southern California Earthquake Center
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+# Python Imports
+from typing import List
+
+# Package Imports
+import pyproj
+
+# UCVM Imports
+from ucvm.src.framework.ucvm import UCVM
+from ucvm.src.shared import ElevationProperties, Vs30Properties, ZProperties, UCVM_DEPTH, \
+                            UCVM_DEFAULT_PROJECTION
+from ucvm.src.shared.properties import SeismicData, Point
+
+SITE_PARAMETERS = ["elevation", "vs30", "z1.0", "z2.5"]    #: list: All the supported site parameters.
+VS30_DEPTHS = range(0, 30)                                  #: range: Depths averaged for Vs30 (as vs30-calc).
+Z_VELOCITIES = (1000, 2500)                                 #: tuple: Vs thresholds for Z1.0 and Z2.5.
+
+
+def query_site_parameters(points: List[SeismicData], model_string: str, parameters: List[str]=None,
+                          spacing: int=50, depth: int=70000, interval: int=1000, max_points: int=None) -> bool:
+    """
+    Given a list of SeismicData objects, each one being a site, fills in the elevation, Vs30, and Z1.0
+    and Z2.5 properties for each site from one pass over the velocity column beneath it. The material
+    properties at each site's own point are filled in as well.
+
+    Vs30 is the average slowness over the top 30 meters (as vs30-calc computes it). Z1.0 and Z2.5
+    are found with the same second occurrence search that z-calc uses, at the same vertical spacing.
+    The column is queried one depth interval at a time for all unresolved sites together, so sites
+    drop out of the query as soon as their Z2.5 has been found.
+
+    Args:
+        points (:obj:`list` of :obj:`SeismicData`): The sites at which to compute the parameters.
+        model_string (str): The velocity model string to sample (e.g. "cvms426.elygtl").
+        parameters (:obj:`list` of :obj:`str`): Any of "elevation", "vs30", "z1.0", and "z2.5". By
+            default all of them are computed.
+        spacing (int): The vertical spacing, in meters, of the Z1.0 and Z2.5 search.
+        depth (int): Search for Z1.0 and Z2.5 down to this depth in meters.
+        interval (int): The depth interval, in meters, queried for all the sites at once.
+        max_points (int): The most points passed to one query. By default, as many as fit in the share of the
+            available memory that UCVM gives its queries.
+
+    Returns:
+        True if successful. Raises an error if not.
+    """
+    if parameters is None:
+        parameters = SITE_PARAMETERS
+
+    for parameter in parameters:
+        if parameter not in SITE_PARAMETERS:
+            raise ValueError("Site parameter %s is not one of %s." % (parameter, ", ".join(SITE_PARAMETERS)))
+
+    model_string = model_string.replace(".vs30-calc", "").replace(".z-calc", "")
+    need_z = "z1.0" in parameters or "z2.5" in parameters
+
+    # The sites themselves carry the surface elevation that the columns below them re-use.
+    UCVM.query(points, model_string, ["velocity", "elevation"])
+
+    sites = _get_site_locations(points)
+    column_query = _get_column_model_query(model_string)
+
+    z_state = {
+        i: {"depths": {target: depth for target in Z_VELOCITIES},
+            "flags": {target: 0 for target in Z_VELOCITIES}}
+        for i in range(len(points))
+    }
+    slowness = {}
+    surface_vs = {}
+
+    current_interval = 0
+    remaining = list(range(len(points)))
+
+    while len(remaining) > 0 and current_interval < depth:
+        z_depths = [current_interval + z * spacing for z in range(0, int(interval / spacing) + 1)] \
+            if need_z else []
+        column_depths = sorted(set(z_depths) | set(VS30_DEPTHS)) if current_interval == 0 else z_depths
+
+        samples = _query_columns(points, sites, remaining, column_depths, column_query, max_points)
+
+        for site in remaining:
+            column = samples[site]
+
+            if current_interval == 0:
+                surface_vs[site] = column[0]
+                if column[0] is not None and column[0] != 0 and \
+                   None not in [column[column_depths.index(z)] for z in VS30_DEPTHS]:
+                    slowness[site] = sum(1.0 / float(column[column_depths.index(z)]) for z in VS30_DEPTHS)
+
+            if need_z:
+                _update_z_state(z_state[site], z_depths, [column[column_depths.index(z)] for z in z_depths])
+
+        if not need_z:
+            break
+
+        remaining = [x for x in remaining if z_state[x]["flags"][Z_VELOCITIES[1]] != 3 and
+                     surface_vs[x] is not None]
+        current_interval += interval
+
+    for i in range(len(points)):
+        if "elevation" in parameters and points[i].elevation_properties is None:
+            points[i].set_elevation_data(ElevationProperties(None, None))
+
+        if "vs30" in parameters:
+            if i in slowness:
+                points[i].set_vs30_data(Vs30Properties(1.0 / (slowness[i] / len(VS30_DEPTHS)), "vs30-calc"))
+            else:
+                points[i].set_vs30_data(Vs30Properties(None, None))
+
+        if need_z:
+            if surface_vs.get(i) is None:
+                points[i].set_z_data(ZProperties(None, None))
+            else:
+                points[i].set_z_data(ZProperties(
+                    z_state[i]["depths"][Z_VELOCITIES[0]] if "z1.0" in parameters else None,
+                    z_state[i]["depths"][Z_VELOCITIES[1]] if "z2.5" in parameters else None
+                ))
+
+    return True
+
+
+def _get_site_locations(points: List[SeismicData]) -> List[tuple]:
+    """
+    Converts all the site locations to the UCVM default projection, with one transform call for each
+    distinct input projection rather than one per site.
+
+    Args:
+        points (:obj:`list` of :obj:`SeismicData`): The sites.
+
+    Returns:
+        A list of (longitude, latitude) tuples in the same order as points.
+    """
+    locations = [None for _ in range(len(points))]
+    by_projection = {}
+
+    for i in range(len(points)):
+        by_projection.setdefault(points[i].original_point.projection, []).append(i)
+
+    for projection, indices in by_projection.items():
+        x_values = [points[i].original_point.x_value for i in indices]
+        y_values = [points[i].original_point.y_value for i in indices]
+
+        if projection != UCVM_DEFAULT_PROJECTION:
+            if projection not in Point.loaded_projections:
+                Point.loaded_projections[projection] = pyproj.Proj(projection)
+            if UCVM_DEFAULT_PROJECTION not in Point.loaded_projections:
+                Point.loaded_projections[UCVM_DEFAULT_PROJECTION] = pyproj.Proj(UCVM_DEFAULT_PROJECTION)
+            x_values, y_values = pyproj.transform(Point.loaded_projections[projection],
+                                                  Point.loaded_projections[UCVM_DEFAULT_PROJECTION],
+                                                  x_values, y_values)
+
+        for j in range(len(indices)):
+            locations[indices[j]] = (x_values[j], y_values[j])
+
+    return locations
+
+
+def _get_column_model_query(model_string: str) -> dict:
+    """
+    Builds the custom model query used for the column samples. The DEM is dropped since every
+    column sample is given its site's elevation and does not need to look it up again.
+
+    Args:
+        model_string (str): The velocity model string.
+
+    Returns:
+        The model query dictionary in the same format as UCVM.get_models_for_query.
+    """
+    models = UCVM.get_models_for_query(model_string, ["velocity"])
+    column_query = {}
+
+    for key, model_list in models.items():
+        column_query[key] = {}
+        for _, model in sorted(model_list.items()):
+            if UCVM.get_model_type(model.split(";-;")[0]) == "elevation":
+                continue
+            column_query[key][len(column_query[key])] = model
+
+    return column_query
+
+
+def _query_columns(points: List[SeismicData], sites: List[tuple], remaining: List[int], column_depths: list,
+                   column_query: dict, max_points: int=None) -> dict:
+    """
+    Queries the given depths beneath each of the remaining sites, in batches of at most max_points
+    points.
+
+    Args:
+        points (:obj:`list` of :obj:`SeismicData`): The sites.
+        sites (:obj:`list` of :obj:`tuple`): The site locations in the UCVM default projection.
+        remaining (:obj:`list` of :obj:`int`): The indices of the sites to query.
+        column_depths (list): The depths to query beneath each site.
+        column_query (dict): The model query to use.
+        max_points (int): The most points to query at once. By default, as many as fit in memory.
+
+    Returns:
+        A dictionary keyed by site index containing the list of Vs values at column_depths.
+    """
+    if max_points is None:
+        max_points = UCVM._get_max_query(len(remaining) * len(column_depths), 1)
+
+    samples = {}
+    sites_per_query = max(1, int(max_points / len(column_depths)))
+
+    for start in range(0, len(remaining), sites_per_query):
+        batch = remaining[start:start + sites_per_query]
+        query_points = []
+
+        for site in batch:
+            for z in column_depths:
+                sample = SeismicData(Point(sites[site][0], sites[site][1], z, UCVM_DEPTH, None,
+                                           UCVM_DEFAULT_PROJECTION))
+                if points[site].elevation_properties is not None:
+                    sample.set_elevation_data(points[site].elevation_properties)
+                query_points.append(sample)
+
+        UCVM.query(query_points, "", ["velocity"], column_query)
+
+        for i in range(len(batch)):
+            samples[batch[i]] = [
+                x.velocity_properties.vs if x.velocity_properties is not None else None
+                for x in query_points[i * len(column_depths):(i + 1) * len(column_depths)]
+            ]
+
+    return samples
+
+
+def _update_z_state(state: dict, column_depths: list, column: list) -> None:
+    """
+    Advances the Z1.0 and Z2.5 search for one site with the next interval of Vs samples. This is the
+    second occurrence search from z-calc: the depth is the first one at which Vs reaches the target,
+    unless Vs drops back below the target and reaches it again, in which case it is the second.
+
+    Args:
+        state (dict): The site's search state, with "depths" and "flags" keyed by target velocity.
+        column_depths (list): The depths of the samples.
+        column (list): The Vs samples at those depths.
+
+    Returns:
+        Nothing
+    """
+    for target in Z_VELOCITIES:
+        for i in range(len(column)):
+            if column[i] is None:
+                continue
+            if column[i] >= target and state["flags"][target] == 0:
+                state["depths"][target] = column_depths[i]
+                state["flags"][target] = 1
+            elif column[i] < target and state["flags"][target] == 1:
+                state["flags"][target] = 2
+            elif column[i] >= target and state["flags"][target] == 2:
+                state["depths"][target] = column_depths[i]
+                state["flags"][target] = 3
+                break
@@ -42,6 +42,7 @@ from ucvm.src.shared.constants import UCVM_MODEL_LIST_FILE, UCVM_MODELS_DIRECTOR
 from ucvm.src.shared.properties import SeismicData
 from ucvm.src.shared import display_and_raise_error, is_number
 from ucvm.src.model.model import Model
+from ucvm.src.framework.chunk_tuner import MAX_PERCENT_FREE, get_seismicdata_size
 
 
 class UCVM:
@@ -51,6 +52,9 @@ class UCVM:
     """
 
     instantiated_models = {}  #: dict: A dictionary of instantiated models.
+    #: dict: The model types whose properties depend only on the horizontal position, and the SeismicData
+    #: attribute that each one sets.
+    HORIZONTAL_PROPERTIES = {"elevation": "elevation_properties", "vs30": "vs30_properties"}
 
     @classmethod
     def bootstrap(cls) -> bool:
@@ -155,19 +159,19 @@ class UCVM:
             counter = 0
             while counter < len(queryable_models):
                 model_to_query = queryable_models[counter].split(";-;")
-                UCVM.get_model_instance(model_to_query[0])
+                model = UCVM.get_model_instance(model_to_query[0])
 
                 if len(model_to_query) == 1:
-                    UCVM.instantiated_models[model_to_query[0]].query(points, params=add_params)
+                    params = add_params
+                elif add_params != "":
+                    params = ",".join([model_to_query[1], add_params])
                 else:
-                    if add_params != "":
-                        UCVM.instantiated_models[model_to_query[0]].query(
-                            points, params=",".join([model_to_query[1], add_params])
-                        )
-                    else:
-                        UCVM.instantiated_models[model_to_query[0]].query(
-                            points, params=model_to_query[1]
-                        )
+                    params = model_to_query[1]
+
+                if model.get_metadata()["type"] in UCVM.HORIZONTAL_PROPERTIES:
+                    UCVM._query_by_column(model, points, params)
+                else:
+                    model.query(points, params=params)
 
                 for point in points:
                     if point.is_property_type_set("velocity"):
@@ -182,6 +186,42 @@ class UCVM:
 
         return True
 
+    @classmethod
+    def _query_by_column(cls, model: Model, points: List[SeismicData], params: str) -> None:
+        """
+        Queries a model whose properties depend only on the horizontal position, like a DEM or a Vs30 model. Runs of
+        consecutive points at the same position, such as the columns of a column-ordered mesh extraction, are
+        queried once and share the result. Points in any other order are queried as usual. Internal method.
+
+        Args:
+            model (Model): The elevation or Vs30 model.
+            points (:obj:`list` of :obj:`SeismicData`): The points to query.
+            params (str): The parameters to pass to the model.
+
+        Returns:
+            Nothing
+        """
+        starts = []
+        last_key = None
+        for index, point in enumerate(points):
+            key = (point.original_point.x_value, point.original_point.y_value, point.original_point.projection,
+                   point.model_string)
+            if key != last_key:
+                starts.append(index)
+                last_key = key
+
+        if len(starts) == len(points):
+            model.query(points, params=params)
+            return
+
+        heads = [points[index] for index in starts]
+        model.query(heads, params=params)
+
+        attribute = UCVM.HORIZONTAL_PROPERTIES[model.get_metadata()["type"]]
+        for head, start, end in zip(heads, starts, starts[1:] + [len(points)]):
+            for point in points[start + 1:end]:
+                setattr(point, attribute, getattr(head, attribute))
+
     @classmethod
     def get_model_type(cls, model: str) -> str:
         """
@@ -573,11 +613,9 @@ class UCVM:
 
     @classmethod
     def _get_max_query(cls, total_points: int, processes: int) -> int:
-        _MAX_PERCENT_FREE = 0.33
-        _SD_SIZE = 200
-        free_mem = psutil.virtual_memory().free
+        free_mem = psutil.virtual_memory().available
         return min(
-            math.floor((free_mem * _MAX_PERCENT_FREE) / _SD_SIZE / processes),
+            math.floor((free_mem * MAX_PERCENT_FREE) / get_seismicdata_size() / processes),
             total_points
         )
 
@@ -18,7 +18,7 @@ from abc import abstractmethod
 from typing import List
 
 from ucvm.src.shared import UCVM_DEFAULT_PROJECTION, UCVM_DEPTH, UCVM_ELEVATION, UCVM_ELEV_ANY
-from ucvm.src.shared.properties import SeismicData
+from ucvm.src.shared.properties import SeismicData, Point
 
 
 class Model:
@@ -145,8 +145,19 @@ class Model:
         if not isinstance(data, List[SeismicData]):
             raise TypeError("Points parameter must be a list of Point classes.")
 
+        projection = self._private_metadata["projection"]
+        last_key = None
         for datum in data:
-            datum.convert_point_to_projection(self._private_metadata["projection"])
+            # Consecutive points at the same horizontal position, like the points of a column, are only
+            # projected once.
+            key = (datum.original_point.x_value, datum.original_point.y_value, datum.original_point.projection)
+            if key == last_key:
+                datum.converted_point = Point(last_point.x_value, last_point.y_value, datum.original_point.z_value,
+                                              datum.original_point.depth_elev, datum.original_point.metadata,
+                                              last_point.projection)
+            else:
+                datum.convert_point_to_projection(projection)
+                last_key, last_point = key, datum.converted_point
             datum.set_point_to_depth_or_elev(self._private_metadata["query_by"])
 
         # Now that we have converted all of the points to the model projection, let's pass them
@@ -24,6 +24,7 @@ import unittest
 
 # UCVM Imports
 from ucvm.src.framework.ucvm import UCVM
+from ucvm.src.framework.site_parameters import query_site_parameters
 from ucvm.src.shared.properties import SeismicData, Point
 from ucvm.src.shared.constants import UCVM_ELEVATION
 from ucvm.src.shared.errors import UCVMError
@@ -281,6 +282,34 @@ class UCVMFrameworkTest(unittest.TestCase):
         self.assertIsNone(s.velocity_properties.vs)
         self.assertIsNone(s.velocity_properties.density)
 
+    def test_ucvm_site_parameters_match_separate_queries(self):
+        """
+        Tests that the fused site parameter query returns the same Vs30, Z1.0, and Z2.5 as querying the vs30-calc
+        and z-calc chains separately.
+        """
+        fused = [SeismicData(Point(-118, 34, 0)), SeismicData(Point(-117, 35, 0))]
+        query_site_parameters(fused, "1d[SCEC]")
+
+        for datum in fused:
+            vs30 = SeismicData(Point(datum.original_point.x_value, datum.original_point.y_value, 0))
+            UCVM.query([vs30], "1d[SCEC].vs30-calc")
+            z = SeismicData(Point(datum.original_point.x_value, datum.original_point.y_value, 0))
+            UCVM.query([z], "1d[SCEC].z-calc")
+
+            self.assertAlmostEqual(datum.vs30_properties.vs30, vs30.vs30_properties.vs30, 4)
+            self.assertEqual(datum.z_properties.z10, z.z_properties.z10)
+            self.assertEqual(datum.z_properties.z25, z.z_properties.z25)
+            self.assertEqual(datum.velocity_properties.vs, vs30.velocity_properties.vs)
+            self.assertIsNotNone(datum.elevation_properties)
+
+        # Querying the columns one site at a time must not change the results.
+        batched = [SeismicData(Point(-118, 34, 0)), SeismicData(Point(-117, 35, 0))]
+        query_site_parameters(batched, "1d[SCEC]", max_points=1)
+        for datum, single in zip(fused, batched):
+            self.assertEqual(datum.vs30_properties.vs30, single.vs30_properties.vs30)
+            self.assertEqual(datum.z_properties.z10, single.z_properties.z10)
+            self.assertEqual(datum.z_properties.z25, single.z_properties.z25)
+
 
 def make_suite() -> unittest.TestSuite:
     suite = unittest.TestSuite()
@@ -15,13 +15,26 @@ import os
 import struct
 import inspect
 import math
+import tracemalloc
+from functools import cmp_to_key
+import numpy as np
 from contextlib import redirect_stdout
+from unittest.mock import patch
 
 # UCVM Imports
 from ucvm.src.framework.ucvm import UCVM
-from ucvm.src.framework.mesh_common import InternalMesh, AWPInternalMeshIterator, RWGInternalMeshIterator
-from ucvm.src.shared.properties import SeismicData, Point
-from ucvm.src.framework.awp_mesh import mesh_extract_single
+from ucvm.src.framework.mesh_common import InternalMesh, AWPInternalMeshIterator, RWGInternalMeshIterator, \
+    HDF5MeshReader, get_hdf5_hyperslabs, \
+    MeshWriter, MeshQA, get_aligned_chunk_size
+from ucvm.src.shared.properties import SeismicData, Point, VelocityProperties
+from ucvm.src.framework.awp_mesh import mesh_extract_single, mesh_extract_multiprocess
+from ucvm.src.framework.journal import ExtractionJournal, subtract_ranges
+from ucvm.src.framework.mesh_convert import mesh_convert
+from ucvm.src.framework.mesh_manifest import MeshManifest, verify_mesh, get_manifest_path
+from ucvm.src.framework.chunk_tuner import ChunkTuner, WARM_UP_POINTS, MIN_CHUNK_SIZE, resize_seismicdata_array
+from ucvm.src.framework.etree import OctantBuffer, etree_xy2geo, get_morton_order, _calculate_etree_stats, \
+    _extract_column
+from ucvm_c_common import UCVMCCommon
 
 import ucvm.tests
 
@@ -130,6 +143,121 @@ class UCVMMeshTest(unittest.TestCase):
         with self.assertRaises(StopIteration):
             next(self.im_3_iterator_2)
 
+    def test_mesh_writer_out_of_order(self):
+        """
+        Tests that the background mesh writer places chunks at their offsets regardless of the order they are queued.
+        """
+        file_out = os.path.join(self.dir, "scratch", "mesh_writer_test.bin")
+        with MeshWriter({"test": file_out}, 4000, max_pending=1, truncate=True) as writer:
+            for chunk in (3, 0, 2, 1):
+                writer.write("test", chunk * 1000, np.arange(chunk * 250, (chunk + 1) * 250, dtype=np.float32))
+
+        self.assertTrue(np.array_equal(np.fromfile(file_out, dtype=np.float32), np.arange(0, 1000, dtype=np.float32)))
+        os.remove(file_out)
+
+    def test_aligned_chunk_size(self):
+        """
+        Tests that aligned chunk sizes are whole stripes for both the AWP and RWG point sizes.
+        """
+        for point_size in (12, 4):
+            for chunk_size in (1, 250000, 1000000):
+                aligned = get_aligned_chunk_size(chunk_size, point_size, 1048576)
+                self.assertEqual(aligned * point_size % 1048576, 0)
+                self.assertLessEqual(aligned, max(chunk_size, 1048576))
+
+    def test_mesh_qa_post_processing(self):
+        """
+        Tests that the post-processing stage applies the minimums, fills missing values with NaN, and counts the
+        affected points.
+        """
+        sd_array = [SeismicData(Point(-118, 34, 0)) for _ in range(0, 4)]
+        sd_array[0].set_velocity_data(VelocityProperties(1000, 300, 2000, None, None, "", "", "", "", ""))
+        sd_array[1].set_velocity_data(VelocityProperties(600, 500, 1800, None, None, "", "", "", "", ""))
+        sd_array[3].set_velocity_data(VelocityProperties(3000, 1500, 2500, None, None, "", "", "", "", ""))
+
+        qa = MeshQA({"vp": 1700, "vs": 400}, keep_indices=True)
+        values = qa.process(sd_array, 10)
+
+        self.assertEqual(list(values[0]), [1700, 400, 2000])
+        self.assertTrue(np.isnan(values[2]).all())
+        self.assertEqual(qa.counts, {"missing": 1, "vs_floor": 1, "low_ratio": 1})
+        self.assertEqual([list(qa.indices[x][0]) for x in MeshQA.CATEGORIES], [[12], [10], [11]])
+        self.assertEqual(list(qa.minimum), [600, 400, 1800])
+
+        # RWG meshes are checked against a Vp/Vs ratio of 1.45 rather than sqrt(2).
+        for mesh_format, low_ratio in (("awp", 0), ("rwg", 1)):
+            sd_array = [SeismicData(Point(-118, 34, 0))]
+            sd_array[0].set_velocity_data(VelocityProperties(1420, 1000, 2000, None, None, "", "", "", "", ""))
+            qa = MeshQA({"vp": 1700, "vs": 400}, mesh_format=mesh_format)
+            qa.process(sd_array, 0)
+            self.assertEqual(qa.counts["low_ratio"], low_ratio)
+
+    def test_chunk_tuner(self):
+        """
+        Tests that the chunk tuner grows the chunk while the throughput improves, stops when it does not, and keeps
+        the chunk within the memory budget.
+        """
+        tuner = ChunkTuner(memory_budget=2 ** 40)
+        self.assertEqual(tuner.next_size(), WARM_UP_POINTS)
+        sd_array = resize_seismicdata_array([], tuner.size)
+        tuner.record(len(sd_array), 1.0)
+        self.assertGreater(tuner.bytes_per_point, 0)
+        self.assertEqual(tuner.next_size(), WARM_UP_POINTS * 2)
+        tuner.record(tuner.size, 1.0)
+        self.assertEqual(tuner.next_size(), WARM_UP_POINTS * 4)
+        tuner.record(tuner.size, 4.0)
+        self.assertEqual(tuner.next_size(), WARM_UP_POINTS * 4)
+        tuner.record(tuner.size, 0.1)
+        self.assertEqual(tuner.next_size(), WARM_UP_POINTS * 4)
+        self.assertEqual(len(tuner.decisions), 3)
+        self.assertEqual(len(resize_seismicdata_array(sd_array, 10)), 10)
+
+        tuner = ChunkTuner(memory_budget=1, maximum=WARM_UP_POINTS * 10)
+        tuner.next_size()
+        tuner.record(WARM_UP_POINTS, 1.0)
+        self.assertEqual(tuner.next_size(), MIN_CHUNK_SIZE)
+        self.assertIn("memory budget", tuner.report())
+
+    def test_chunk_tuner_untraced_baseline(self):
+        """
+        Tests that the throughput the chunk tuner compares against comes from the first chunk after the warm-up,
+        which runs without the memory tracing, rather than from the traced and much slower warm-up.
+        """
+        tuner = ChunkTuner(memory_budget=2 ** 40)
+        tuner.next_size()
+        self.assertTrue(tracemalloc.is_tracing())
+        tuner.record(WARM_UP_POINTS, 10.0)
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertEqual(tuner.best_throughput, 0)
+
+        # The first untraced chunk sets the baseline, so a larger chunk that is no faster stops the growth.
+        self.assertFalse(tracemalloc.is_tracing())
+        tuner.record(tuner.next_size(), 1.0)
+        self.assertEqual(tuner.best_throughput, WARM_UP_POINTS * 2)
+        tuner.record(tuner.next_size(), 2.0)
+        self.assertFalse(tuner.growing)
+        self.assertEqual(tuner.next_size(), WARM_UP_POINTS * 4)
+
+    def test_extraction_journal_resume(self):
+        """
+        Tests that a journal only returns the committed units, and that the completed ranges are removed from the
+        range left to extract.
+        """
+        file_out = os.path.join(self.dir, "scratch", "journal_test.journal")
+        information = {"mesh_name": "journal_test"}
+
+        journal = ExtractionJournal(file_out, information)
+        journal.start()
+        journal.record(0, 100, 1)
+        journal.record(200, 300, 2)
+        journal.commit()
+        journal.record(300, 400, 3)
+
+        self.assertEqual(ExtractionJournal(file_out, information).load(), [(0, 100, 1), (200, 300, 2)])
+        self.assertEqual(subtract_ranges((0, 500), [(200, 300), (0, 100)]), [(100, 200), (300, 500)])
+        self.assertRaises(ValueError, ExtractionJournal(file_out, {"mesh_name": "other"}).load)
+        os.remove(file_out)
+
     def test_awp_rwg_equivalent(self):
         """
         Quick verification that the AWP and RWG formats are equivalent (i.e. same material properties).
@@ -204,6 +332,334 @@ class UCVMMeshTest(unittest.TestCase):
                                                ((start_point[1] + y_val * spacing) +
                                                (start_point[0] + x_val * spacing)) / 2, places=4)
 
+    def test_generate_simple_mesh_ijk12_multiprocess(self):
+        """
+        Generates the simple IJK-12 Cartesian mesh with several local processes and makes sure that it is identical to
+        the mesh generated by a single process.
+        """
+        UCVM.instantiated_models["testvelocitymodel"] = test_model.TestVelocityModel()
+        with open(os.path.join(self.dir, "data", "simple_mesh_ijk12_unrotated.xml")) as fd:
+            simple_mesh_ijk12_xml = xmltodict.parse(fd.read())["root"]
+        simple_mesh_ijk12_xml["out_dir"] = os.path.join(self.dir, "scratch")
+        with redirect_stdout(open(os.devnull, "w")):
+            self.assertTrue(mesh_extract_single(simple_mesh_ijk12_xml))
+            simple_mesh_ijk12_xml["mesh_name"] = "simple_mesh_unrotated_multiprocess"
+            self.assertTrue(mesh_extract_multiprocess(simple_mesh_ijk12_xml, 3))
+
+        with open(os.path.join(self.dir, "scratch", "simple_mesh_unrotated.awp"), "rb") as fd:
+            single = fd.read()
+        with open(os.path.join(self.dir, "scratch", "simple_mesh_unrotated_multiprocess.awp"), "rb") as fd:
+            self.assertEqual(fd.read(), single)
+
+    def test_generate_simple_mesh_columns(self):
+        """
+        Generates the simple AWP and RWG meshes column by column, and makes sure that they are identical to the
+        meshes generated slice by slice.
+        """
+        UCVM.instantiated_models["testvelocitymodel"] = test_model.TestVelocityModel()
+        for xml_file, extensions in [("simple_mesh_ijk12_unrotated.xml", [".awp"]),
+                                     ("simple_mesh_rwg_unrotated.xml", [".rwgvp", ".rwgvs", ".rwgdn"])]:
+            with open(os.path.join(self.dir, "data", xml_file)) as fd:
+                mesh_xml = xmltodict.parse(fd.read())["root"]
+            mesh_xml["out_dir"] = os.path.join(self.dir, "scratch")
+            mesh_name = mesh_xml["mesh_name"]
+            with redirect_stdout(open(os.devnull, "w")):
+                self.assertTrue(mesh_extract_single(mesh_xml))
+                mesh_xml["mesh_name"] = mesh_name + "_columns"
+                self.assertTrue(mesh_extract_single(mesh_xml, columns=True))
+
+            for extension in extensions:
+                with open(os.path.join(self.dir, "scratch", mesh_name + extension), "rb") as fd:
+                    slices = fd.read()
+                with open(os.path.join(self.dir, "scratch", mesh_name + "_columns" + extension), "rb") as fd:
+                    self.assertEqual(fd.read(), slices)
+
+    def test_generate_simple_mesh_hdf5(self):
+        """
+        Generates the simple IJK-12 Cartesian mesh in HDF5 format, a few slices at a time, and makes sure that it
+        holds the same values as the AWP mesh, whether it is read whole or a few points at a time.
+        """
+        UCVM.instantiated_models["testvelocitymodel"] = test_model.TestVelocityModel()
+        with open(os.path.join(self.dir, "data", "simple_mesh_ijk12_unrotated.xml")) as fd:
+            simple_mesh_ijk12_xml = xmltodict.parse(fd.read())["root"]
+        simple_mesh_ijk12_xml["out_dir"] = os.path.join(self.dir, "scratch")
+        with redirect_stdout(open(os.devnull, "w")):
+            self.assertTrue(mesh_extract_single(simple_mesh_ijk12_xml))
+            simple_mesh_ijk12_xml["mesh_name"] = "simple_mesh_unrotated_hdf5"
+            simple_mesh_ijk12_xml["format"] = "hdf5"
+            hdf5_path = os.path.join(self.dir, "scratch", "simple_mesh_unrotated_hdf5.h5")
+            if os.path.exists(hdf5_path):
+                os.remove(hdf5_path)
+            self.assertTrue(mesh_extract_single(simple_mesh_ijk12_xml, "1-2"))
+            self.assertTrue(mesh_extract_single(simple_mesh_ijk12_xml, "3-5"))
+
+        awp = np.fromfile(os.path.join(self.dir, "scratch", "simple_mesh_unrotated.awp"), dtype="<f4").reshape(-1, 3)
+
+        reader = HDF5MeshReader(hdf5_path, 1024 * 1024)
+        self.assertEqual(reader.file["vp"].shape, (5, 101, 201))
+        self.assertTrue(np.array_equal(reader[0:len(awp)], awp))
+        indices = np.array([0, 200, 201, 20300, 101504, 5, 60000])
+        self.assertTrue(np.array_equal(reader[indices], awp[indices]))
+        reader.close()
+
+        covered = []
+        for offset, (z_range, y_range, x_range) in get_hdf5_hyperslabs(150, 41000, (5, 101, 201)):
+            self.assertEqual(offset, sum(covered))
+            covered.append((z_range[1] - z_range[0]) * (y_range[1] - y_range[0]) * (x_range[1] - x_range[0]))
+        self.assertEqual(sum(covered), 41000 - 150)
+
+    def test_mesh_manifest(self):
+        """
+        Generates the simple IJK-12 Cartesian mesh a few slices at a time and makes sure that its manifest covers the
+        whole mesh, has the right statistics, and catches a changed value.
+        """
+        UCVM.instantiated_models["testvelocitymodel"] = test_model.TestVelocityModel()
+        with open(os.path.join(self.dir, "data", "simple_mesh_ijk12_unrotated.xml")) as fd:
+            mesh_xml = xmltodict.parse(fd.read())["root"]
+        mesh_xml["out_dir"] = os.path.join(self.dir, "scratch")
+        mesh_xml["mesh_name"] = "simple_mesh_unrotated_manifest"
+        mesh_path = os.path.join(self.dir, "scratch", "simple_mesh_unrotated_manifest.awp")
+        for path in (mesh_path, get_manifest_path(mesh_xml)):
+            if os.path.exists(path):
+                os.remove(path)
+
+        with redirect_stdout(open(os.devnull, "w")):
+            self.assertTrue(mesh_extract_single(mesh_xml, "1-2"))
+            self.assertEqual(len(verify_mesh(mesh_xml)), 1)
+            self.assertTrue(mesh_extract_multiprocess(mesh_xml, 2, "3-5"))
+        self.assertEqual(verify_mesh(mesh_xml), [])
+        self.assertEqual(verify_mesh(mesh_xml, 2), [])
+
+        awp = np.fromfile(mesh_path, dtype="<f4").reshape(-1, 3)
+        statistics = MeshManifest.load(get_manifest_path(mesh_xml)).get_statistics()
+        self.assertEqual(statistics["vp"]["points"], 101505)
+        self.assertAlmostEqual(statistics["vp"]["min"], awp[:, 0].min(), places=4)
+        self.assertAlmostEqual(statistics["vs"]["max"], awp[:, 1].max(), places=4)
+        self.assertAlmostEqual(statistics["density"]["mean"], awp[:, 2].mean(dtype=np.float64), places=3)
+
+        with open(mesh_path, "r+b") as fd:
+            fd.seek(60000 * 12 + 4)
+            fd.write(struct.pack("f", 1.5))
+        problems = verify_mesh(mesh_xml)
+        self.assertEqual(len(problems), 1)
+        self.assertIn("checksum", problems[0])
+
+    def test_generate_discontinuous_mesh(self):
+        """
+        Generates a mesh whose top block has finer vertical spacing near the surface, above a coarser second block,
+        and makes sure that each block is queried at the right points.
+        """
+        UCVM.instantiated_models["testvelocitymodel"] = test_model.TestVelocityModel()
+        with open(os.path.join(self.dir, "data", "simple_mesh_ijk12_unrotated.xml")) as fd:
+            mesh_xml = xmltodict.parse(fd.read())["root"]
+        mesh_xml["out_dir"] = os.path.join(self.dir, "scratch")
+        mesh_xml["z_spacing"] = {"layer": [{"count": 2, "spacing": 0.01}, {"count": 3, "spacing": 0.02}]}
+        mesh_xml["blocks"] = {"block": {"spacing": 0.04, "dimensions": {"z": 2}}}
+        with redirect_stdout(open(os.devnull, "w")):
+            self.assertTrue(mesh_extract_single(mesh_xml, custom_model_order={0: {0: "testvelocitymodel"}}))
+
+        with open(os.path.join(self.dir, "scratch", "simple_mesh_unrotated_blocks.xml")) as fd:
+            blocks = xmltodict.parse(fd.read())["root"]["blocks"]["block"]
+        self.assertEqual([float(block["top"]) for block in blocks], [0, 0.1])
+
+        for block, spacing, shape, depths in [(blocks[0], 0.01, (5, 101, 201), [0, 0.01, 0.02, 0.04, 0.06]),
+                                              (blocks[1], 0.04, (2, 26, 51), [0.1, 0.14])]:
+            mesh = np.fromfile(os.path.join(self.dir, "scratch", block["mesh_name"] + ".awp"), dtype="<f4")
+            mesh = mesh.reshape(shape + (3,))
+            z_val, y_val, x_val = np.meshgrid(np.array(depths), 34 + np.arange(shape[1]) * spacing,
+                                              -118 + np.arange(shape[2]) * spacing, indexing="ij")
+            self.assertTrue(np.allclose(mesh[..., 0], y_val + x_val + z_val, atol=1e-4))
+
+    def test_query_stretched_and_uniform_meshes(self):
+        """
+        Generates a mesh with finer vertical spacing near the surface and one with uniform spacing, and queries them
+        in turn through the same data product reader, to make sure that each is located with its own z spacing.
+        """
+        UCVM.instantiated_models["testvelocitymodel"] = test_model.TestVelocityModel()
+        stretched = {"layer": [{"count": 2, "spacing": 0.01}, {"count": 3, "spacing": 0.02}]}
+        paths = {}
+        for name, z_spacing in [("stretched", stretched), ("uniform", None)]:
+            with open(os.path.join(self.dir, "data", "simple_mesh_ijk12_unrotated.xml")) as fd:
+                mesh_xml = xmltodict.parse(fd.read())["root"]
+            mesh_xml["out_dir"] = os.path.join(self.dir, "scratch")
+            mesh_xml["mesh_name"] = "simple_mesh_unrotated_" + name
+            if z_spacing is not None:
+                mesh_xml["z_spacing"] = z_spacing
+            with redirect_stdout(open(os.devnull, "w")):
+                self.assertTrue(mesh_extract_single(mesh_xml))
+            paths[name] = os.path.join(self.dir, "scratch", mesh_xml["mesh_name"] + ".xml")
+            with open(paths[name], "w") as fd:
+                fd.write(xmltodict.unparse({"root": mesh_xml}, pretty=True))
+
+        reader = UCVM.get_model_instance("dataproductreader")
+        for name, depth in [("stretched", 0.04), ("uniform", 0.035), ("stretched", 0.05), ("uniform", 0.015)]:
+            data = [SeismicData(Point(-118, 34, depth))]
+            reader.query(data, params=paths[name])
+            self.assertAlmostEqual(data[0].velocity_properties.vp, 34 - 118 + depth, places=4)
+
+    def test_etree_column_refinement(self):
+        """
+        Extracts one e-tree column around a pocket of slow material and makes sure that the octants cover the column
+        exactly, with none repeated or inside another, and that only the octants around the pocket are refined to the
+        finest level.
+        """
+        cfg = {"corners": {"bl": {"x": -118.0, "y": 34.0}, "ul": {"x": -118.0, "y": 34.4},
+                           "ur": {"x": -117.5, "y": 34.4}, "br": {"x": -117.5, "y": 34.0}},
+               "dimensions": {"x": 40960, "y": 40960, "z": 10240}, "minimums": {"vs": 300}, "cvm_list": "pocket",
+               "properties": {"parts_per_wavelength": 4, "max_frequency": 0.25, "max_octant_size": 5120}}
+        stats = _calculate_etree_stats(cfg, 2, 2)
+
+        def query(sd_array, cvm_list, properties):
+            for datum in sd_array:
+                point = datum.original_point
+                slow = math.hypot(point.x_value + 117.9, point.y_value - 34.1) < 0.03 and point.z_value < 2000
+                vs = 300.0 if slow else 1000.0 + point.z_value * 0.5
+                datum.set_velocity_data(VelocityProperties(vs * 1.7, vs, 2000.0, None, None, "", "", "", "", ""))
+            return True
+
+        octants = []
+        sd_array = [SeismicData(Point(-118, 34, 0)) for _ in range(0, stats["max_points"])]
+        with patch.object(UCVM, "query", query), redirect_stdout(open(os.devnull, "w")):
+            count = _extract_column(sd_array, cfg, stats, 0, 0, lambda p, e, n: octants.append(e[0:n]), "")
+
+        etree_pnts = np.concatenate(octants)
+        self.assertEqual(count, len(etree_pnts))
+        edges = np.left_shift(1, 31 - etree_pnts[:, 3])
+        for axis, ticks in enumerate([stats["column_ticks"], stats["row_ticks"], stats["max_ticks"]["depth"]]):
+            self.assertTrue(np.all(etree_pnts[:, axis] >= 0))
+            self.assertTrue(np.all(etree_pnts[:, axis] + edges <= ticks))
+
+        # Octants inside the column that do not overlap and add up to its volume cover it exactly.
+        addresses = set(map(tuple, etree_pnts.tolist()))
+        self.assertEqual(len(addresses), len(etree_pnts))
+        for x, y, z, level in etree_pnts.tolist():
+            for parent_level in range(int(stats["min_level"]), level):
+                mask = ~((1 << (31 - parent_level)) - 1)
+                self.assertNotIn((x & mask, y & mask, z & mask, parent_level), addresses)
+        self.assertEqual(sum(int(edge) ** 3 for edge in edges),
+                         int(stats["column_ticks"]) * int(stats["row_ticks"]) * int(stats["max_ticks"]["depth"]))
+
+        finest = etree_pnts[etree_pnts[:, 3] == stats["max_level"]]
+        self.assertGreater(len(finest), 0)
+        edge = 1 << (31 - int(stats["max_level"]))
+        lons, lats = etree_xy2geo(cfg, (finest[:, 0] + edge / 2) * stats["tick_size"],
+                                  (finest[:, 1] + edge / 2) * stats["tick_size"])
+        self.assertTrue(np.all(np.hypot(lons + 117.9, lats - 34.1) < 0.04))
+        self.assertTrue(np.all(finest[:, 2] * stats["tick_size"] < 2000 + 640))
+
+    def test_etree_xy2geo(self):
+        """
+        Tests that etree_xy2geo maps points in a rotated e-tree to exactly the same longitudes and latitudes as
+        UCVMCCommon.c_etree_bilinear_xy2geo, which returns the latitude first.
+        """
+        cfg = {"corners": {"bl": {"x": "-118.0", "y": "34.0"}, "ul": {"x": "-118.3", "y": "34.9"},
+                           "ur": {"x": "-117.1", "y": "35.2"}, "br": {"x": "-116.8", "y": "34.3"}},
+               "dimensions": {"x": "120000", "y": "90000", "z": "30000"}}
+        corners = tuple((float(cfg["corners"][corner]["x"]), float(cfg["corners"][corner]["y"]))
+                        for corner in ("bl", "ul", "ur", "br"))
+        dims = (float(cfg["dimensions"]["x"]), float(cfg["dimensions"]["y"]))
+
+        y_values, x_values = np.meshgrid(np.linspace(0, 90000, 13) + 0.37, np.linspace(0, 120000, 17) + 0.61,
+                                         indexing="ij")
+        x_values = np.append(x_values.ravel(), 0)
+        y_values = np.append(y_values.ravel(), 0)
+        lons, lats = etree_xy2geo(cfg, x_values, y_values)
+
+        for x_value, y_value, lon, lat in zip(x_values.tolist(), y_values.tolist(), lons.tolist(), lats.tolist()):
+            c_lat, c_lon = UCVMCCommon.c_etree_bilinear_xy2geo(x_value, y_value, corners, dims)
+            self.assertEqual(lon, c_lon)
+            self.assertEqual(lat, c_lat)
+        self.assertAlmostEqual(lons[-1], -118.0, places=4)
+        self.assertAlmostEqual(lats[-1], 34.0, places=4)
+
+    def test_etree_morton_order(self):
+        """
+        Tests that get_morton_order sorts octants as the locational code comparison that ucvm_etree_merge uses does,
+        with parents before their children and with ticks that need more than 16 bits.
+        """
+        def less_msb(a, b):
+            return a < b and a < (a ^ b)
+
+        def compare_locational(a, b):
+            # A port of _compare_locational in common.pyx.
+            a_tick, b_tick, difference = a[2], b[2], a[2] ^ b[2]
+            for axis in (1, 0):
+                if less_msb(difference, a[axis] ^ b[axis]):
+                    a_tick, b_tick, difference = a[axis], b[axis], a[axis] ^ b[axis]
+            if difference != 0:
+                return -1 if a_tick < b_tick else 1
+            return a[3] - b[3]
+
+        random = np.random.RandomState(46)
+        levels = random.randint(1, 31, 3000)
+        edges = np.left_shift(1, 31 - levels)
+        etree_pnts = np.column_stack([random.randint(0, 1 << 31, 3000) // edges * edges for _ in range(3)] +
+                                     [levels]).astype(np.int64)
+
+        # Add the ancestors of some octants, which share their corner and must come first.
+        parents = etree_pnts[0:300].copy()
+        parents[:, 3] = np.maximum(parents[:, 3] - random.randint(1, 4, 300), 0)
+        edges = np.left_shift(1, 31 - parents[:, 3])
+        parents[:, 0:3] = parents[:, 0:3] // edges[:, None] * edges[:, None]
+        etree_pnts = np.unique(np.concatenate((etree_pnts, parents, [[0, 0, 0, 2], [0, 0, 0, 1]])), axis=0)
+        self.assertTrue(np.any(etree_pnts[:, 0:3] >= 1 << 16))
+
+        expected = sorted(map(tuple, etree_pnts.tolist()), key=cmp_to_key(compare_locational))
+        self.assertEqual(list(map(tuple, etree_pnts[get_morton_order(etree_pnts)].tolist())), expected)
+        self.assertLess(expected.index((0, 0, 0, 1)), expected.index((0, 0, 0, 2)))
+
+    def test_octant_buffer_flush(self):
+        """
+        Tests that the octant buffer holds octants until it reaches its size, then inserts them all in Morton order.
+        """
+        written = []
+
+        def writer(ep, props, etree_pnts, n):
+            written.append((props[0:n].copy(), etree_pnts[0:n].copy()))
+            return 0
+
+        edge = 1 << 21
+        etree_pnts = np.array([[edge, 0, 0, 10], [0, 0, 0, 10], [0, edge, 0, 10], [0, 0, edge, 10], [0, 0, 0, 9]],
+                              dtype=np.int64)
+        props = np.arange(15, dtype=np.float32).reshape(5, 3)
+
+        with patch("ucvm.src.framework.etree._etree_writer", writer):
+            octants = OctantBuffer(0, size=5)
+            octants.add(props[0:3], etree_pnts[0:3], 3)
+            self.assertEqual(len(written), 0)
+            octants.add(props[3:5], etree_pnts[3:5], 2)
+            self.assertEqual(len(written), 1)
+            self.assertEqual(octants.count, 0)
+
+        order = [4, 1, 0, 2, 3]
+        self.assertEqual(written[0][1].tolist(), etree_pnts[order].tolist())
+        self.assertEqual(written[0][0].tolist(), props[order].tolist())
+
+    def test_mesh_convert(self):
+        """
+        Converts the simple IJK-12 mesh to RWG format and back, in blocks small enough that both axes are split, and
+        makes sure that the values are the same.
+        """
+        UCVM.instantiated_models["testvelocitymodel"] = test_model.TestVelocityModel()
+        with open(os.path.join(self.dir, "data", "simple_mesh_ijk12_unrotated.xml")) as fd:
+            simple_mesh_ijk12_xml = xmltodict.parse(fd.read())["root"]
+        simple_mesh_ijk12_xml["out_dir"] = os.path.join(self.dir, "scratch")
+        with redirect_stdout(open(os.devnull, "w")):
+            self.assertTrue(mesh_extract_single(simple_mesh_ijk12_xml))
+            rwg_xml = mesh_convert(simple_mesh_ijk12_xml, "rwg", memory_budget=201 * 12 * 3 * 2)
+            awp_xml = mesh_convert(rwg_xml, "awp", "simple_mesh_unrotated_converted", processes=2,
+                                   memory_budget=201 * 12 * 3 * 150)
+
+        awp = np.fromfile(os.path.join(self.dir, "scratch", "simple_mesh_unrotated.awp"), dtype="<f4")
+        awp = awp.reshape((5, 101, 201, 3))
+        for index, extension in enumerate([".rwgvp", ".rwgvs", ".rwgdn"]):
+            rwg = np.fromfile(os.path.join(self.dir, "scratch", rwg_xml["mesh_name"] + extension), dtype="<f4")
+            self.assertTrue(np.array_equal(rwg.reshape((101, 5, 201)),
+                                           (awp[..., index] / np.float32(1000)).transpose(1, 0, 2)))
+
+        converted = np.fromfile(os.path.join(self.dir, "scratch", awp_xml["mesh_name"] + ".awp"), dtype="<f4")
+        self.assertTrue(np.allclose(converted.reshape(awp.shape), awp, rtol=1e-6))
+
     def test_generate_simple_mesh_ijk12_rotated(self):
         """
         Generates a simple IJK-12 Cartesian mesh, rotated, and makes sure that the material properties are correct.